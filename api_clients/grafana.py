@@ -4,13 +4,16 @@ These functions are intended to be called from the Control Center.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from typing import Literal, TypeAlias
+from typing import Any, Iterable, Literal, TypeAlias
 from enum import Enum
 from pathlib import Path
 import json
 import os
 import logging
+import threading
+import time
 from functools import lru_cache
 log = logging.getLogger(__name__)
 
@@ -29,6 +32,23 @@ ADMIN_PASSWORD = os.getenv('GRAFANA_ADMIN_PASSWORD', 'admin')
 ORG_NAME = os.getenv('GRAFANA_ORG_NAME', 'Main Org.')
 INFLUXDB_SOURCE_NAME = os.getenv('INFLUXDB_SOURCE_NAME', 'influxdb')
 AUTH = HTTPBasicAuth(ADMIN_USERNAME, ADMIN_PASSWORD)
+CACHE_TTL = float(os.getenv('GRAFANA_CACHE_TTL', 60)) # seconds folders and users are cached for
+USERS_PAGE_SIZE = 1000
+
+# Dashboard query of projects with rollups, selects the rollup bucket by the time per point of the panel
+ROLLUP_DASHBOARD_QUERY = '''period = int(v: v.windowPeriod)
+bucket = if period >= int(v: 1h) then "{{ bucket_1h }}"
+    else if period >= int(v: 1m) then "{{ bucket_1m }}"
+    else if period >= int(v: 1s) then "{{ bucket_1s }}"
+    else "{{ bucket }}"
+
+from(bucket: bucket)
+  |> range(start: v.timeRangeStart, stop: v.timeRangeStop)
+  |> filter(fn: (r) => not exists r.stat or r.stat == "mean")
+  |> drop(fn: (column) => column == "stat")
+  |> aggregateWindow(every: v.windowPeriod, fn: mean, createEmpty: false)
+  |> yield(name: "mean")
+'''
 
 Role:TypeAlias = Literal['Viewer', 'Editor', 'Admin']
 TeamPermission:TypeAlias = Literal['Member', 'Admin']
@@ -39,6 +59,39 @@ class FolderPermission(Enum):
     EDIT = 2
     ADMIN = 4
 
+class TTLCache:
+    """Thread-safe cache of values which expire after `ttl` seconds"""
+    def __init__(self, ttl:float) -> None:
+        self.ttl = ttl
+        self._items:dict[Any, tuple[float, Any]] = dict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Any:
+        with self._lock:
+            expires, value = self._items.get(key, (0.0, None))
+        return value if expires > time.monotonic() else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+# Keep-alive connections to Grafana are reused by all calls
+session = requests.Session()
+session.auth = AUTH
+session.mount('http://', HTTPAdapter(pool_maxsize=16))
+session.mount('https://', HTTPAdapter(pool_maxsize=16))
+
+folders_cache = TTLCache(CACHE_TTL) # the folder list under the key `None`
+users_cache = TTLCache(CACHE_TTL) # users by login
+
 class ResponseException(Exception):
     def __init__(self, response:requests.Response) -> None:
         message = f"Error: {response.status_code} - {response.json()['message']}"
@@ -58,14 +111,14 @@ def is_response_ok(response:requests.Response, raise_exception:bool = False) ->
 @lru_cache
 def get_org_id(name:str = ORG_NAME) -> str:
     url = f'{GRAFANA_URL}/api/orgs/name/{name}'
-    response = requests.get(url, auth=AUTH)
+    response = session.get(url)
     is_response_ok(response, True)
     return response.json()['id']
 
 @lru_cache
 def get_source(source_name:str = INFLUXDB_SOURCE_NAME) -> dict:
     url = f'{GRAFANA_URL}/api/datasources/name/{source_name}'
-    response = requests.get(url, auth=AUTH)
+    response = session.get(url)
     is_response_ok(response, True)
     return response.json()
 
@@ -90,14 +143,14 @@ def add_influxdb_source(name:str):
     }
 
     url = f'{GRAFANA_URL}/api/datasources'
-    response = requests.post(url, auth=AUTH, json=source)
+    response = session.post(url, json=source)
     if is_response_ok(response, True):
         return response.json()
 
 
 def delete_source(source_name:str):
     url = f'{GRAFANA_URL}/api/datasources/name/{source_name}'
-    response = requests.delete(url, auth=AUTH)
+    response = session.delete(url)
     if is_response_ok(response, True):
         return response.json()
 
@@ -113,7 +166,8 @@ def create_user(name:str, password:str, role:Role = 'Viewer') -> int: # type: ig
         'role': role,
     }
 
-    response = requests.post(url, auth=AUTH, json=user)
+    response = session.post(url, json=user)
+    users_cache.pop(name)
     if response.status_code == 412:
         log.warning(f"Grafana User with email '{user['email']}' or username '{user['name']}' already exists")
         return -1
@@ -121,24 +175,52 @@ def create_user(name:str, password:str, role:Role = 'Viewer') -> int: # type: ig
         return response.json()['id']
 
 def get_user(name:str) -> dict|None:
+    user = users_cache.get(name)
+    if user:
+        return user
+
     url = f"{GRAFANA_URL}/api/users?query={name}"
 
-    response = requests.get(url, auth=AUTH)
+    response = session.get(url)
 
     if is_response_ok(response, True):
-        return response.json()[0] if response.json() else None
+        user = response.json()[0] if response.json() else None
+        if user:
+            users_cache.set(name, user)
+        return user
+
+def get_users(names:Iterable[str]) -> dict[str, dict]:
+    """Return users by login, users which are not cached are looked up by listing all users"""
+    names = set(names)
+    users = {name: user for name in names if (user := users_cache.get(name))}
+    missing = names - users.keys()
+    page = 1
+    while missing:
+        url = f'{GRAFANA_URL}/api/users'
+        response = session.get(url, params={'perpage': USERS_PAGE_SIZE, 'page': page})
+        is_response_ok(response, True)
+        for user in response.json():
+            users_cache.set(user['login'], user)
+            if user['login'] in missing:
+                users[user['login']] = user
+                missing.remove(user['login'])
+        if len(response.json()) < USERS_PAGE_SIZE:
+            break
+        page += 1
+    return users
     
 def delete_user(name:str) -> bool:
     user = get_user(name)
     if user:
-        url = f'{GRAFANA_URL}/api/admin/users/{user['id']}'
-        response = requests.delete(url, auth=AUTH)
+        url = f'{GRAFANA_URL}/api/admin/users/{user["id"]}'
+        response = session.delete(url)
+        users_cache.pop(name)
         return is_response_ok(response, True)
     return False
 
 def get_org_users():
     url = f'{GRAFANA_URL}/api/orgs/{get_org_id()}/users'
-    response = requests.get(url, auth=AUTH)
+    response = session.get(url)
     if is_response_ok(response):
         return response.json()
     
@@ -148,7 +230,7 @@ def create_team(name:str) -> int|None:
         "name": name,
         "orgId": get_org_id()
     }
-    response = requests.post(url, auth=AUTH, json=team)
+    response = session.post(url, json=team)
     if is_response_ok(response, True):
         return response.json()['teamId']
     else:
@@ -157,23 +239,23 @@ def create_team(name:str) -> int|None:
 def get_team(team_name:str):
     url = f'{GRAFANA_URL}/api/teams/search?name={team_name}&perpage=1'
 
-    response = requests.get(url, auth=AUTH)
+    response = session.get(url)
     if is_response_ok(response, True):
         return response.json()['teams'][0] if response.json()['totalCount'] > 0 else None
 
 def get_team_members(team_name:str):
     team = get_team(team_name)
     if team:
-        url = f'{GRAFANA_URL}/api/teams/{team['id']}/members'
-        response = requests.get(url, auth=AUTH)
+        url = f'{GRAFANA_URL}/api/teams/{team["id"]}/members'
+        response = session.get(url)
         return response.json()
     return False
 
 def delete_team(team_name:str):
     team = get_team(team_name)
     if team:
-        url = f'{GRAFANA_URL}/api/teams/{team['id']}'
-        response = requests.delete(url, auth=AUTH)
+        url = f'{GRAFANA_URL}/api/teams/{team["id"]}'
+        response = session.delete(url)
         if is_response_ok(response, True):
             return True
     return False
@@ -181,8 +263,8 @@ def delete_team(team_name:str):
 def update_team_members(team_name:str, members:TeamMembers) -> bool:
     team = get_team(team_name)
     if team:
-        url = f'{GRAFANA_URL}/api/teams/{team['id']}/members'
-        response = requests.put(url, auth=AUTH, json=members)
+        url = f'{GRAFANA_URL}/api/teams/{team["id"]}/members'
+        response = session.put(url, json=members)
         if is_response_ok(response, True):
             return True
     return False
@@ -191,9 +273,9 @@ def add_team_member(team_name:str, username:str):
     team = get_team(team_name)
     user = get_user(username)
     if team and user:
-        url = f'{GRAFANA_URL}/api/teams/{team['id']}/members'
+        url = f'{GRAFANA_URL}/api/teams/{team["id"]}/members'
         data = {"userId": user['id']}
-        response = requests.post(url, auth=AUTH, json=data)
+        response = session.post(url, json=data)
         if is_response_ok(response, True):
             return True
     return False
@@ -202,8 +284,8 @@ def remove_team_member(team_name:str, username:str):
     team = get_team(team_name)
     user = get_user(username)
     if team and user:
-        url = f'{GRAFANA_URL}/api/teams/{team['id']}/members/{user['id']}'
-        response = requests.delete(url, auth=AUTH)
+        url = f'{GRAFANA_URL}/api/teams/{team["id"]}/members/{user["id"]}'
+        response = session.delete(url)
         if is_response_ok(response, True):
             return True
     return False
@@ -216,7 +298,7 @@ def change_user_password(username:str, new_password:str) -> bool:
     if user:
         data = {'password': new_password}
         url = f"{GRAFANA_URL}/api/admin/users/{user['id']}/password"
-        response = requests.put(url, auth=AUTH, json=data)
+        response = session.put(url, json=data)
         if is_response_ok(response, False):
             return True
         else:
@@ -228,7 +310,7 @@ def change_user_email(username:str, new_email:str) -> bool:
     if user:
         data = {'email': new_email}
         url = f"{GRAFANA_URL}/api/users/{user['id']}"
-        response = requests.put(url, auth=AUTH, json=data)
+        response = session.put(url, json=data)
         if is_response_ok(response, True):
             return True
     return False
@@ -237,24 +319,27 @@ def change_user_role(username:str, role:Role):
     user = get_user(username)
     if user:
         data = {'role': role}
-        url = f'{GRAFANA_URL}/api/orgs/{get_org_id()}/users/{user['id']}'
-        response = requests.patch(url, auth=AUTH, json=data)
+        url = f'{GRAFANA_URL}/api/orgs/{get_org_id()}/users/{user["id"]}'
+        response = session.patch(url, json=data)
         if is_response_ok(response, True):
             return True
     return False
 
-def get_folders() -> list[dict]:
+def get_folders(refresh:bool = False) -> list[dict]:
+    folders = None if refresh else folders_cache.get(None)
+    if folders is not None:
+        return folders
     url = f'{GRAFANA_URL}/api/folders'
-    response = requests.get(url, auth=AUTH)
+    response = session.get(url)
     if is_response_ok(response, True):
+        folders_cache.set(None, response.json())
         return response.json()
     return []
 
 def get_folder(folder_name:str):
-    url = f'{GRAFANA_URL}/api/folders'
-    response = requests.get(url, auth=AUTH)
-    if is_response_ok(response, True):
-        for folder in response.json():
+    # A cached folder list may not contain a folder created meanwhile
+    for refresh in (False, True):
+        for folder in get_folders(refresh):
             if folder['title'] ==  folder_name:
                 return folder
     return False
@@ -262,29 +347,32 @@ def get_folder(folder_name:str):
 def create_folder(folder_name:str):
     url = f'{GRAFANA_URL}/api/folders'
     folder = {'title': folder_name}
-    response = requests.post(url, auth=AUTH, json=folder)
+    response = session.post(url, json=folder)
     if is_response_ok(response, True):
+        # Add the folder to the cached list instead of downloading the list again
+        folders = folders_cache.get(None)
+        if folders is not None:
+            folders_cache.set(None, [*folders, response.json()])
         return True
+    folders_cache.clear()
     return False
 
 def delete_folder(folder_name:str):
     folder = get_folder(folder_name)
     if folder:
-        url = f'{GRAFANA_URL}/api/folders/{folder['uid']}'
-        response = requests.delete(url, auth=AUTH)
+        url = f'{GRAFANA_URL}/api/folders/{folder["uid"]}'
+        response = session.delete(url)
+        folders_cache.clear()
         if is_response_ok(response, True):
             return True
     return False
 
 def update_folder_permissions(folder_name:str, members:dict[str, FolderPermission]):
     folder = get_folder(folder_name)
-    member_ids:dict[int, FolderPermission] = dict()
-    for name, perm in members.items():
-        user = get_user(name)
-        if user:
-            member_ids[user['id']] = perm
+    users = get_users(members.keys())
+    member_ids:dict[int, FolderPermission] = {users[name]['id']: perm for name, perm in members.items() if name in users}
     if folder and member_ids:
-        url = f'{GRAFANA_URL}/api/folders/{folder['uid']}/permissions'
+        url = f'{GRAFANA_URL}/api/folders/{folder["uid"]}/permissions'
         permissions:dict[str, list[dict[str, str|int]]] = {
             'items': [
                 {
@@ -296,7 +384,7 @@ def update_folder_permissions(folder_name:str, members:dict[str, FolderPermissio
         for id, perm in member_ids.items():
             permissions['items'].append({"userId": id, 'permission': perm.value})
         
-        response = requests.post(url, auth=AUTH, json=permissions)
+        response = session.post(url, json=permissions)
         if is_response_ok(response, True):
             return True
     return False
@@ -304,17 +392,29 @@ def update_folder_permissions(folder_name:str, members:dict[str, FolderPermissio
 def rename_folder(old_folder_name:str, new_folder_name:str):
     folder = get_folder(old_folder_name)
     if folder:
-        url = f'{GRAFANA_URL}/api/folders/{folder['uid']}'
+        url = f'{GRAFANA_URL}/api/folders/{folder["uid"]}'
         data = {
             'title': new_folder_name,
             'overwrite': True
         }
-        response = requests.put(url, auth=AUTH, json=data)
+        response = session.put(url, json=data)
+        folders_cache.clear()
         if is_response_ok(response, True):
             return True
     return False
 
-def create_dashboard(project_name : str):
+def dashboard_query(project_name : str, rollups : bool = False) -> str:
+    """Return the query of the generated project dashboard"""
+    if rollups:
+        query = ROLLUP_DASHBOARD_QUERY
+        for resolution in influxdb.ROLLUPS:
+            query = query.replace(f'{{{{ bucket_{resolution} }}}}', influxdb.rollup_bucket_name(project_name, resolution))
+    else:
+        with open(NEW_DASHBOARD_TEMPLATE_PATH, 'rb') as file:
+            query = json.load(file)['panels'][0]['targets'][0]['query']
+    return query.replace(r'{{ bucket }}', project_name)
+
+def create_dashboard(project_name : str, rollups : bool = False):
     folder = get_folder(project_name)
 
     if folder:
@@ -324,8 +424,7 @@ def create_dashboard(project_name : str):
 
         dashboard['panels'][0]['datasource']['uid'] = get_source()['uid']
         dashboard['panels'][0]['targets'][0]['datasource']['uid'] = get_source()['uid']
-        query = dashboard['panels'][0]['targets'][0]['query'].replace(r'{{ bucket }}', project_name)
-        dashboard['panels'][0]['targets'][0]['query'] = query
+        dashboard['panels'][0]['targets'][0]['query'] = dashboard_query(project_name, rollups)
         
         data = {
             "dashboard": dashboard,
@@ -333,10 +432,39 @@ def create_dashboard(project_name : str):
             "overwrite": False
         }
         
-        response = requests.post(url, auth=AUTH, json=data)
+        response = session.post(url, json=data)
         return True
     return False 
 
+def replace_dashboard_query(folder_name:str, old_query:str, new_query:str) -> bool:
+    """Replace queries of panels in the folder's dashboards which are still the same as `old_query` (not edited by users)"""
+    folder = get_folder(folder_name)
+    if not folder:
+        return False
+
+    url = f'{GRAFANA_URL}/api/search'
+    response = session.get(url, params={'folderUIDs': folder['uid'], 'type': 'dash-db'})
+    if not is_response_ok(response, True):
+        return False
+    for item in response.json():
+        url = f'{GRAFANA_URL}/api/dashboards/uid/{item["uid"]}'
+        response = session.get(url)
+        if not is_response_ok(response):
+            continue
+        dashboard = response.json()['dashboard']
+        targets = [target for panel in dashboard.get('panels', []) for target in panel.get('targets', []) if target.get('query') == old_query]
+        for target in targets:
+            target['query'] = new_query
+        if targets:
+            url = f'{GRAFANA_URL}/api/dashboards/db'
+            data = {
+                "dashboard": dashboard,
+                "folderUid": folder['uid'],
+                "overwrite": True
+            }
+            is_response_ok(session.post(url, json=data))
+    return True
+
 try:
     get_org_id(ORG_NAME)
 except requests.exceptions.ConnectionError:
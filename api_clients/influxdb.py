@@ -5,11 +5,19 @@ These functions are intended to be called from the Control Center, Receiver serv
 
 from influxdb_client import InfluxDBClient, Point, Bucket, Authorization, User, Organization, Buckets, WriteOptions, Dialect
 from influxdb_client import AddResourceMemberRequestBody
-from typing import Iterable, TypeAlias, Literal
+from influxdb_client.client.write_api import SYNCHRONOUS
+from typing import Iterable, Iterator, TypeAlias, Literal, Sequence
 from datetime import datetime, tzinfo, timezone, timedelta
 from pathlib import Path
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from math import isfinite
 import os
+import re
+import time
 import logging
+import numpy as np
 from datetime import datetime
 log = logging.getLogger(__name__)
 
@@ -26,18 +34,51 @@ client = InfluxDBClient(url=URL, token=TOKEN, org=ORG_NAME)
 if not client.ping():
     log.error('Failed to establish connection with Influxdb')
 
+# Rollup resolution: (task period, time range re-aggregated by each run to include late data)
+ROLLUPS = {
+    '1s': ('1m', '5m'),
+    '1m': ('10m', '30m'),
+    '1h': ('1h', '3h'),
+}
+ROLLUP_STATS = ('min', 'max', 'mean', 'count')
+ROLLUP_BACKFILL = '1h' # Period of a backfill query, a multiple of all resolutions
+
 TimePrecision: TypeAlias = Literal['s', 'ms', 'us', 'ns']
 DateTimePrecisions: TypeAlias = Literal['hours', 'minutes', 'seconds', 'milliseconds', 'microseconds']
+SensorBatch: TypeAlias = Iterable[tuple[str, Sequence[int], Sequence[float]]] # [(sensor name, timestamps, values), ...]
+
+# Line protocol special characters, same as in `influxdb_client.client.write.point`
+_ESCAPE_MEASUREMENT = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+_ESCAPE_KEY = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
 
 
 class Api:
-    users = client.users_api()
-    auth = client.authorizations_api()
-    org = client.organizations_api()
-    write = client.write_api(WriteOptions(flush_interval=100))
-    bucket = client.buckets_api()
-    query = client.query_api()
-    delete = client.delete_api()
+    """APIs of `client`, created again by `reconnect`"""
+    @classmethod
+    def create(cls, client: InfluxDBClient):
+        cls.users = client.users_api()
+        cls.auth = client.authorizations_api()
+        cls.org = client.organizations_api()
+        cls.write = client.write_api(WriteOptions(flush_interval=100))
+        cls.write_sync = client.write_api(SYNCHRONOUS)
+        cls.bucket = client.buckets_api()
+        cls.query = client.query_api()
+        cls.delete = client.delete_api()
+        cls.tasks = client.tasks_api()
+
+Api.create(client)
+
+
+def reconnect():
+    """Replace the client and its APIs, has to be called in a forked process before using them.
+
+    The batching write API of the parent process has no flush thread in the forked process
+    (its writes would never be sent) and pooled connections must not be shared with the parent.
+    The old client is not closed, closing it would flush data buffered by the parent again.
+    """
+    global client
+    client = InfluxDBClient(url=URL, token=TOKEN, org=ORG_NAME)
+    Api.create(client)
 
 def get_auth_by_name(name: str) -> Authorization | None:
     """Find authorizations by name."""
@@ -80,8 +121,157 @@ def delete_bucket(bucket_name: str) -> Bucket | None:
         return Api.bucket.delete_bucket(bucket)
 
 
-def write(bucket_name: str, points: Iterable[Point]):
-    Api.write.write(bucket=bucket_name, org=ORG_NAME, record=points)
+def rollup_bucket_name(bucket_name: str, resolution: str) -> str:
+    return f'{bucket_name}_rollup_{resolution}'
+
+
+def rollup_task_name(bucket_name: str, resolution: str) -> str:
+    return f'rollup {bucket_name} {resolution}'
+
+
+def rollup_flux(bucket_name: str, resolution: str, start: str, stop: str) -> str:
+    """Flux which aggregates raw data between the Flux time expressions `start` and `stop` into the rollup bucket.
+
+    Each statistic is stored under the sensor's field with a `stat` tag, counts are stored as floats
+    so all values of a field have the same type.
+    """
+    stats = '\n'.join(
+        f'''data |> aggregateWindow(every: {resolution}, fn: {stat}, timeSrc: "_start", createEmpty: false)
+    |> map(fn: (r) => ({{r with _value: float(v: r._value)}}))
+    |> set(key: "stat", value: "{stat}")
+    |> to(bucket: "{rollup_bucket_name(bucket_name, resolution)}", org: "{ORG_NAME}", tagColumns: ["sensor_node", "stat"])'''
+        for stat in ROLLUP_STATS
+    )
+    return f'''import "date"
+
+stop = {stop}
+data = from(bucket: "{bucket_name}")
+    |> range(start: {start}, stop: stop)
+    |> filter(fn: (r) => r["_measurement"] != "-1") // test measurement
+
+{stats}
+'''
+
+
+def rollup_task_flux(bucket_name: str, resolution: str) -> str:
+    """Flux of a task which aggregates complete windows of raw data into the rollup bucket"""
+    _, lookback = ROLLUPS[resolution]
+    return rollup_flux(bucket_name, resolution, f'date.sub(d: {lookback}, from: stop)', f'date.truncate(t: now(), unit: {resolution})')
+
+
+def backfill_rollups(bucket_name: str):
+    """Aggregate raw data written before the rollup tasks existed into the rollup buckets.
+
+    Data is aggregated by a query per `ROLLUP_BACKFILL` period which contains records, to keep the queries short.
+    The period is a multiple of all resolutions, so no window is split between two queries.
+    Windows which are not complete yet are left to the tasks.
+    """
+    query = f'''
+    from(bucket: "{bucket_name}")
+    |> range(start: 0)
+    |> filter(fn: (r) => r["_measurement"] != "-1")
+    |> aggregateWindow(every: {ROLLUP_BACKFILL}, fn: count, timeSrc: "_start", createEmpty: false)
+    |> map(fn: (r) => ({{time: int(v: r._time)}}))
+    '''
+    periods = sorted({record['time'] for table in Api.query.query(query, ORG_NAME) for record in table.records})
+    period_ns = _duration_ns(ROLLUP_BACKFILL)
+    now = time.time_ns()
+    for resolution in ROLLUPS:
+        resolution_ns = _duration_ns(resolution)
+        complete = now // resolution_ns * resolution_ns
+        for start in periods:
+            stop = min(start + period_ns, complete)
+            if start >= stop:
+                continue
+            response = Api.query.query_raw(rollup_flux(bucket_name, resolution, f'time(v: {start})', f'time(v: {stop})'), ORG_NAME)
+            try:
+                # The written records are returned, they are not needed
+                for _ in response.stream():
+                    pass
+            finally:
+                response.release_conn()
+
+
+def _duration_ns(duration: str) -> int:
+    """Nanoseconds of a Flux duration with a single unit like `10m`"""
+    return int(duration[:-1]) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[duration[-1]] * 1_000_000_000
+
+
+def create_rollups(bucket_name: str, backfill: bool = True):
+    """Create rollup buckets of the bucket and tasks which fill them, existing tasks are replaced.
+
+    With `backfill` existing raw data is aggregated too, after the tasks are created so no window is missed.
+    """
+    delete_rollup_tasks(bucket_name)
+    org = get_org_by_name(ORG_NAME)
+    for resolution, (period, _) in ROLLUPS.items():
+        if not Api.bucket.find_bucket_by_name(rollup_bucket_name(bucket_name, resolution)):
+            create_bucket(rollup_bucket_name(bucket_name, resolution))
+        Api.tasks.create_task_every(rollup_task_name(bucket_name, resolution), rollup_task_flux(bucket_name, resolution), period, org)
+    if backfill:
+        backfill_rollups(bucket_name)
+
+
+def delete_rollups(bucket_name: str):
+    """Delete rollup tasks and buckets of the bucket"""
+    delete_rollup_tasks(bucket_name)
+    for resolution in ROLLUPS:
+        delete_bucket(rollup_bucket_name(bucket_name, resolution))
+
+
+def delete_rollup_tasks(bucket_name: str):
+    for resolution in ROLLUPS:
+        for task in Api.tasks.find_tasks(name=rollup_task_name(bucket_name, resolution)):
+            Api.tasks.delete_task(task.id)
+
+
+def rename_rollups(current_name: str, new_name: str):
+    """Rename rollup buckets, tasks are recreated because their Flux contains the bucket names"""
+    delete_rollup_tasks(current_name)
+    for resolution in ROLLUPS:
+        rename_bucket(rollup_bucket_name(current_name, resolution), rollup_bucket_name(new_name, resolution))
+    create_rollups(new_name, backfill=False)
+
+
+def write(bucket_name: str, record: Iterable[Point] | bytes, write_precision: TimePrecision = 'ns'):
+    """Write `Point`s or a line protocol payload created by `encode_lines`.
+
+    `write_precision` applies to the payload, `Point`s use their own precision.
+    """
+    Api.write.write(bucket=bucket_name, org=ORG_NAME, record=record, write_precision=write_precision)
+
+
+def write_sync(bucket_name: str, record: Iterable[Point] | bytes, write_precision: TimePrecision = 'ns'):
+    """Same as `write`, but return after InfluxDB accepted the data and raise an exception if it failed"""
+    Api.write_sync.write(bucket=bucket_name, org=ORG_NAME, record=record, write_precision=write_precision)
+
+
+@lru_cache(maxsize=4096)
+def line_prefix(sensor_node_name: str, sensor_name: str) -> str:
+    """Return the escaped line protocol tags and field key (`,sensor_node=... sensor=`) for samples of one sensor"""
+    return f',sensor_node={sensor_node_name.translate(_ESCAPE_KEY)} {sensor_name.translate(_ESCAPE_KEY)}='
+
+
+def encode_lines(sensor_node_name: str, batch: SensorBatch) -> bytes:
+    """Encode samples into line protocol without the measurement name and without creating a `Point` per sample.
+
+    The result is encoded once per batch and completed for each measurement by `with_measurement`.
+    Produces the same points as `create_point`, values which are not finite are skipped.
+    """
+    lines: list[str] = []
+    for sensor_name, timestamps, values in batch:
+        prefix = line_prefix(sensor_node_name, sensor_name)
+        lines.extend(f'{prefix}{value!r} {timestamp}' for timestamp, value in zip(timestamps, values) if isfinite(value))
+    return '\n'.join(lines).encode()
+
+
+def with_measurement(measurement_id, lines: bytes) -> bytes:
+    """Prepend the measurement name to each line created by `encode_lines`"""
+    if not lines:
+        return lines
+    # Escaped tags and fields contain no line breaks, so each one separates lines
+    measurement = str(measurement_id).translate(_ESCAPE_MEASUREMENT).encode()
+    return measurement + lines.replace(b'\n', b'\n' + measurement)
 
 
 def create_point(measurement_id, sensor_node_name: str, sensor_name: str, timestamp: int, value: float, write_precision: TimePrecision) -> Point:
@@ -94,12 +284,22 @@ def create_point(measurement_id, sensor_node_name: str, sensor_name: str, timest
     )
 
 
-def query_select(bucket_name: str, measurement_id, sensor_node_name: str, sensor_name: str, limit_n: int, page: int):
+def query_select(bucket_name: str, measurement_id, sensor_node_name: str, sensor_name: str, limit_n: int, start: datetime | int = 0, offset: int = 0):
+    """Select `limit_n` records from `start` (inclusive), skipping `offset` records.
+
+    Pages should start at the time after the last record of the previous page (keyset pagination),
+    so `offset` stays small and late pages do not scan the series from the beginning.
+    """
+    if isinstance(start, datetime):
+        timestamp = start.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        start_literal = f'time(v: "{timestamp}")'
+    else:
+        start_literal = start
     query = f'''
     from(bucket: "{bucket_name}")
-    |> range(start: 0)
+    |> range(start: {start_literal})
     |> filter(fn: (r) => r["_measurement"] == "{measurement_id}" and r["sensor_node"] == "{sensor_node_name}" and r["_field"] == "{sensor_name}")
-    |> limit(n:{limit_n}, offset: {page*limit_n})
+    |> limit(n:{limit_n}, offset: {offset})
     '''
     result = Api.query.query(query, ORG_NAME)
     return result[0].records if result else []
@@ -118,55 +318,161 @@ def query_count(bucket_name: str, measurement_id, sensor_node_name: str, sensor_
     return result[0].records[0].get_value() if result else 0
 
 
-def query_select_all(bucket_name: str, measurement_id, sensor_node_name: str, sensor_name: str, batch_size: int = 100_000):
-    """Generator for safely selecting all data for a measurement.  
-
-    This function retrieves data in batches, preventing excessive memory usage  
-    by avoiding loading the entire dataset at once.
-    """
-    page = 0
-    while True:
-        query = f'''
-        from(bucket: "{bucket_name}")
+def query_time_range(bucket_name: str, measurement_id, sensor_node_name: str, sensor_name: str) -> tuple[int, int] | None:
+    """Return the time (ns) of the first record and the time after the last record, `None` if there are no records"""
+    query = f'''
+    data = from(bucket: "{bucket_name}")
         |> range(start: 0)
         |> filter(fn: (r) => r["_measurement"] == "{measurement_id}" and r["sensor_node"] == "{sensor_node_name}" and r["_field"] == "{sensor_name}")
-        |> limit(n:{batch_size}, offset: {page*batch_size})
-        '''
+        |> keep(columns: ["_time", "_value"])
+    union(tables: [data |> first(), data |> last()])
+        |> map(fn: (r) => ({{time: int(v: r._time)}}))
+    '''
+    times = [record['time'] for table in Api.query.query(query, ORG_NAME) for record in table.records]
+    return (min(times), max(times) + 1) if times else None
 
-        result = Api.query.query(query, ORG_NAME)
 
-        if result:
-            yield from result[0].records
-            page += 1
-        else:
-            return
+def query_window(bucket_name: str, measurement_id, sensor_node_name: str, sensor_name: str, start: int, stop: int, limit: int) -> tuple[np.ndarray, np.ndarray]:
+    """Select the first `limit` records between `start` (inclusive) and `stop` (exclusive) times in ns as arrays of timestamps (ns) and values"""
+    query = f'''
+    from(bucket: "{bucket_name}")
+    |> range(start: time(v: {start}), stop: time(v: {stop}))
+    |> filter(fn: (r) => r["_measurement"] == "{measurement_id}" and r["sensor_node"] == "{sensor_node_name}" and r["_field"] == "{sensor_name}")
+    |> keep(columns: ["_time", "_value"])
+    |> limit(n: {limit})
+    |> map(fn: (r) => ({{time: int(v: r._time), value: float(v: r._value)}}))
+    '''
+    response = Api.query.query_raw(query, ORG_NAME, dialect=Dialect(header=True, annotations=[]))
+    try:
+        lines = response.data.splitlines()
+    finally:
+        response.release_conn()
+    # Raw CSV `,result,table,time,value` with empty lines between tables
+    header = lines[0].split(b',') if lines else []
+    if b'time' not in header:
+        return np.empty(0, np.int64), np.empty(0, np.float64)
+    rows = np.loadtxt(
+        (line for line in lines[1:] if line and line != lines[0]),
+        delimiter=',',
+        usecols=(header.index(b'time'), header.index(b'value')),
+        dtype=[('time', np.int64), ('value', np.float64)],
+        ndmin=1,
+    )
+    return rows['time'], rows['value']
+
+
+def query_aggregate_windows(bucket_name: str, measurement_id, sensor_node_name: str, sensor_name: str, start: int, stop: int, window: int) -> dict[str, list]:
+    """Aggregate records between `start` and `stop` (ns) into windows of `window` ns.
 
-def export_csv(
+    Windows start at `start` (not at multiples of `window` since the epoch), so there are at most
+    `ceil((stop - start)/window)` of them. Return columns `time` (window start in ns), `min`, `max`
+    and `mean` of windows which contain records.
+    """
+    offset = start % window
+    query = f'''
+    data = from(bucket: "{bucket_name}")
+        |> range(start: time(v: {start}), stop: time(v: {stop}))
+        |> filter(fn: (r) => r["_measurement"] == "{measurement_id}" and r["sensor_node"] == "{sensor_node_name}" and r["_field"] == "{sensor_name}")
+        |> keep(columns: ["_time", "_value"])
+    data |> aggregateWindow(every: {window}ns, offset: {offset}ns, fn: min, timeSrc: "_start", createEmpty: false) |> map(fn: (r) => ({{r with time: int(v: r._time)}})) |> yield(name: "min")
+    data |> aggregateWindow(every: {window}ns, offset: {offset}ns, fn: max, timeSrc: "_start", createEmpty: false) |> map(fn: (r) => ({{r with time: int(v: r._time)}})) |> yield(name: "max")
+    data |> aggregateWindow(every: {window}ns, offset: {offset}ns, fn: mean, timeSrc: "_start", createEmpty: false) |> map(fn: (r) => ({{r with time: int(v: r._time)}})) |> yield(name: "mean")
+    '''
+    columns: dict[str, dict[int, float]] = {'min': {}, 'max': {}, 'mean': {}}
+    for table in Api.query.query(query, ORG_NAME):
+        for record in table.records:
+            columns[record['result']][record['time']] = record.get_value()
+    times = sorted(columns['mean'])
+    return {
+        'time': times,
+        **{name: [values.get(time) for time in times] for name, values in columns.items()},
+    }
+
+
+def query_select_all(
+    bucket_name: str,
+    measurement_id,
+    sensor_node_name: str,
+    sensor_name: str,
+    batch_size: int = 100_000,
+    window_count: int = 16,
+    max_workers: int = 4,
+    ) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """Generator for safely selecting all data for a measurement.
+
+    The time range of the data is split into `window_count` windows, which are queried concurrently by up to
+    `max_workers` threads and yielded in order as arrays of timestamps (ns, `int64`) and values (`float64`).
+    A query returns at most `batch_size` records, the rest of a window is queried after the last returned timestamp,
+    so at most `max_workers` batches of `batch_size` records are held in memory whatever the sample rate.
+    """
+    time_range = query_time_range(bucket_name, measurement_id, sensor_node_name, sensor_name)
+    if not time_range:
+        return
+    start, stop = time_range
+    window_ns = max(-(-(stop - start) // window_count), 1)
+    windows = ((window_start, min(window_start + window_ns, stop)) for window_start in range(start, stop, window_ns))
+
+    executor = ThreadPoolExecutor(max_workers)
+    def submit(batch_start: int, batch_stop: int) -> tuple[int, Future[tuple[np.ndarray, np.ndarray]]]:
+        return batch_stop, executor.submit(query_window, bucket_name, measurement_id, sensor_node_name, sensor_name, batch_start, batch_stop, batch_size)
+
+    try:
+        # (window stop, next batch of the window) in the order of the windows
+        batches: deque[tuple[int, Future[tuple[np.ndarray, np.ndarray]]]] = deque()
+        while True:
+            while len(batches) < max_workers and (window := next(windows, None)):
+                batches.append(submit(*window))
+            if not batches:
+                break
+            window_stop, future = batches.popleft()
+            timestamps, values = future.result()
+            if len(timestamps) == batch_size:
+                # Timestamps of a series are unique, the rest of the window follows the last one
+                batches.appendleft(submit(int(timestamps[-1]) + 1, window_stop))
+            if len(timestamps):
+                yield timestamps, values
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def stream_csv(
     bucket_name: str,
     measurement_id,
     sensor_node_name :str,
     sensor_name: str,
-    out_path: Path|str,
-    ):
+    chunk_size: int = 64*1024,
+    ) -> Iterator[bytes]:
+    """Generator of a CSV export (`timestamp,value`) of the sensor data in a measurement.
+
+    The raw CSV response of InfluxDB is transformed chunk by chunk while it is received,
+    so nothing is stored and the first rows are sent before the query is finished.
+    """
     query = f'''
         from(bucket: "{bucket_name}")
         |> range(start: 0)
         |> filter(fn: (r) => r["_measurement"] == "{measurement_id}" and r["sensor_node"] == "{sensor_node_name}" and r["_field"] == "{sensor_name}")
         |> keep(columns: ["_time", "_value"])
     '''
-
-    with open(out_path, 'a') as file:
-        file.write('timestamp,value\n')
-        rows = Api.query.query_csv(query,ORG_NAME, dialect=Dialect(annotations=[]))
-
-        # return if there are no rows
-        try:
-            header = next(rows)
-        except StopIteration:
-            return
-        
-        time_index = header.index('_time')
-        value_index = header.index('_value')
-        for row in rows:
-            # Time format from 'YYYY-MM-DDTHH:MM:SS.nnnnnnnnnZ' to 'YYYY-MM-DD HH:MM:SS.ssssss'
-            file.write(f'{row[time_index][:10]} {row[time_index][11:-1]},{row[value_index]}\n')
+    response = Api.query.query_raw(query, ORG_NAME, dialect=Dialect(header=False, annotations=[]))
+    try:
+        yield b'timestamp,value\n'
+        remainder = b''
+        for chunk in response.stream(chunk_size):
+            chunk = remainder + chunk
+            end = chunk.rfind(b'\n') + 1
+            remainder = chunk[end:]
+            if end:
+                yield _to_export_rows(chunk[:end])
+        if remainder:
+            yield _to_export_rows(remainder + b'\n')
+    finally:
+        response.release_conn()
+
+
+# Raw CSV row `,result,table,YYYY-MM-DDTHH:MM:SS.nnnnnnnnnZ,value`
+_RAW_CSV_ROW = re.compile(rb'^,[^,\r\n]*,[^,\r\n]*,(\d{4}-\d\d-\d\d)T([^Z,\r\n]*)Z,([^\r\n]*)\r?\n', re.MULTILINE)
+
+def _to_export_rows(lines: bytes) -> bytes:
+    """Transform complete raw CSV lines to `YYYY-MM-DD HH:MM:SS.nnnnnnnnn,value` rows"""
+    # Lines which are not rows (empty lines between tables) keep their CRLF and are removed
+    return _RAW_CSV_ROW.sub(rb'\1 \2,\3\n', lines).replace(b'\r\n', b'')
@@ -0,0 +1,6 @@
+"""Tests of the API clients, run from the repository root with `python -m unittest discover -s api_clients/tests -t .`"""
+import os
+
+# The clients connect on import, the tests never reach a real server
+os.environ.setdefault('INFLUXDB_ADMIN_TOKEN', 'test')
+os.environ.setdefault('INFLUXDB_URL', 'http://127.0.0.1:9')
@@ -0,0 +1,215 @@
+import multiprocessing
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from types import SimpleNamespace
+from unittest import TestCase, mock
+
+import numpy as np
+from influxdb_client.client.flux_table import FluxRecord, FluxTable
+
+from api_clients import influxdb
+
+
+class QuerySelectAllTests(TestCase):
+    def setUp(self):
+        # Series of one node: dense first half, single record at the end
+        self.timestamps = np.concatenate([np.arange(1000, 1250, dtype=np.int64), [10_000]])
+        self.values = self.timestamps.astype(np.float64) / 2
+        self.queries: list[tuple[int, int, int]] = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def query_window(self, bucket_name, measurement_id, sensor_node_name, sensor_name, start, stop, limit):
+        with self.lock:
+            self.queries.append((start, stop, limit))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            selected = (self.timestamps >= start) & (self.timestamps < stop)
+            return self.timestamps[selected][:limit], self.values[selected][:limit]
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def select_all(self, **kwargs) -> list[tuple[np.ndarray, np.ndarray]]:
+        with mock.patch.object(influxdb, 'query_time_range', return_value=(1000, 10_001)), \
+             mock.patch.object(influxdb, 'query_window', side_effect=self.query_window):
+            return list(influxdb.query_select_all('bucket', 1, 'node', 'sensor', **kwargs))
+
+    def test_batches_in_order(self):
+        batches = self.select_all(batch_size=64, window_count=4, max_workers=2)
+        np.testing.assert_array_equal(np.concatenate([timestamps for timestamps, _ in batches]), self.timestamps)
+        np.testing.assert_array_equal(np.concatenate([values for _, values in batches]), self.values)
+        self.assertTrue(all(len(timestamps) <= 64 for timestamps, _ in batches))
+        self.assertEqual(batches[0][0].dtype, np.int64)
+        self.assertEqual(batches[0][1].dtype, np.float64)
+        self.assertLessEqual(self.max_running, 2)
+
+    def test_window_continues_after_last_timestamp(self):
+        self.select_all(batch_size=100, window_count=4, max_workers=1)
+        # The dense first window of 2251 ns is read in 3 batches, the sparse windows once each
+        self.assertEqual(self.queries, [
+            (1000, 3251, 100),
+            (1100, 3251, 100),
+            (1200, 3251, 100),
+            (3251, 5502, 100),
+            (5502, 7753, 100),
+            (7753, 10_001, 100),
+        ])
+
+    def test_no_records(self):
+        with mock.patch.object(influxdb, 'query_time_range', return_value=None):
+            self.assertEqual(list(influxdb.query_select_all('bucket', 1, 'node', 'sensor')), [])
+
+
+class QueryAggregateWindowsTests(TestCase):
+    def test_windows_start_at_start(self):
+        def table(result: str, values: dict[int, float]) -> FluxTable:
+            flux_table = FluxTable()
+            flux_table.records = [FluxRecord(0, {'result': result, 'time': time, '_value': value}) for time, value in values.items()]
+            return flux_table
+
+        with mock.patch.object(influxdb.Api, 'query', create=True) as query:
+            query.query.return_value = [
+                table('min', {1050: 1.0, 1250: 5.0}),
+                table('max', {1050: 2.0, 1250: 6.0}),
+                table('mean', {1050: 1.5, 1250: 5.5}),
+            ]
+            columns = influxdb.query_aggregate_windows('bucket', 1, 'node', 'sensor', 1050, 1351, 100)
+
+        flux = query.query.call_args.args[0]
+        self.assertEqual(flux.count('aggregateWindow(every: 100ns, offset: 50ns,'), 3)
+        self.assertEqual(columns, {'time': [1050, 1250], 'min': [1.0, 5.0], 'max': [2.0, 6.0], 'mean': [1.5, 5.5]})
+
+
+class BackfillRollupsTests(TestCase):
+    HOUR = 3600 * 10**9
+
+    def test_periods_with_data(self):
+        now = 100*self.HOUR + 90*10**9 + 500 # 100 h 1 m 30.0000005 s
+        periods = [SimpleNamespace(records=[{'time': 2*self.HOUR}, {'time': 100*self.HOUR}]), SimpleNamespace(records=[{'time': 2*self.HOUR}])]
+        with mock.patch.object(influxdb.Api, 'query', create=True) as query, mock.patch.object(influxdb.time, 'time_ns', return_value=now):
+            query.query.return_value = periods
+            influxdb.backfill_rollups('bucket')
+
+        ranges = []
+        for call in query.query_raw.call_args_list:
+            flux = call.args[0]
+            self.assertIn('to(bucket: "bucket_rollup_', flux)
+            resolution = re.search(r'aggregateWindow\(every: (\w+)', flux)[1]
+            start = int(re.search(r'range\(start: time\(v: (\d+)\)', flux)[1])
+            stop = int(re.search(r'stop = time\(v: (\d+)\)', flux)[1])
+            ranges.append((resolution, start, stop))
+        # The current hour is backfilled up to its last complete window, the 1h window is left to the task
+        self.assertEqual(ranges, [
+            ('1s', 2*self.HOUR, 3*self.HOUR),
+            ('1s', 100*self.HOUR, 100*self.HOUR + 90*10**9),
+            ('1m', 2*self.HOUR, 3*self.HOUR),
+            ('1m', 100*self.HOUR, 100*self.HOUR + 60*10**9),
+            ('1h', 2*self.HOUR, 3*self.HOUR),
+        ])
+        self.assertEqual(query.query_raw.return_value.release_conn.call_count, 5)
+
+    def test_rename_does_not_backfill(self):
+        with mock.patch.object(influxdb, 'delete_rollup_tasks'), \
+             mock.patch.object(influxdb, 'rename_bucket'), \
+             mock.patch.object(influxdb, 'get_org_by_name'), \
+             mock.patch.object(influxdb.Api, 'bucket', create=True), \
+             mock.patch.object(influxdb.Api, 'tasks', create=True) as tasks, \
+             mock.patch.object(influxdb, 'backfill_rollups') as backfill_rollups:
+            influxdb.rename_rollups('old', 'new')
+            self.assertEqual(tasks.create_task_every.call_count, len(influxdb.ROLLUPS))
+            backfill_rollups.assert_not_called()
+            influxdb.create_rollups('new')
+            backfill_rollups.assert_called_once_with('new')
+
+
+class StreamCsvTests(TestCase):
+    RAW = (
+        b',_result,0,2024-01-01T00:00:00.123456789Z,1.5\r\n'
+        b',_result,0,2024-01-01T00:00:01Z,-2\r\n'
+        b'\r\n'
+        b',_result,1,2024-01-01T00:00:02.5Z,3e-05\r\n'
+    )
+    EXPORT = (
+        b'timestamp,value\n'
+        b'2024-01-01 00:00:00.123456789,1.5\n'
+        b'2024-01-01 00:00:01,-2\n'
+        b'2024-01-01 00:00:02.5,3e-05\n'
+    )
+
+    def stream_csv(self, chunks: list[bytes]) -> list[bytes]:
+        with mock.patch.object(influxdb.Api, 'query', create=True) as query:
+            response = query.query_raw.return_value
+            response.stream.return_value = iter(chunks)
+            result = list(influxdb.stream_csv('bucket', 1, 'node', 'sensor'))
+        response.release_conn.assert_called_once_with()
+        return result
+
+    def test_whole_response(self):
+        self.assertEqual(b''.join(self.stream_csv([self.RAW])), self.EXPORT)
+
+    def test_split_chunks(self):
+        # Rows broken at every position, including between CR and LF
+        for split in range(1, len(self.RAW)):
+            with self.subTest(split=split):
+                self.assertEqual(b''.join(self.stream_csv([self.RAW[:split], self.RAW[split:]])), self.EXPORT)
+        self.assertEqual(b''.join(self.stream_csv([self.RAW[i:i + 1] for i in range(len(self.RAW))])), self.EXPORT)
+
+    def test_rows_sent_as_received(self):
+        split = self.RAW.index(b'\r\n') + 10
+        self.assertEqual(self.stream_csv([self.RAW[:split], self.RAW[split:]]), [
+            b'timestamp,value\n',
+            b'2024-01-01 00:00:00.123456789,1.5\n',
+            b'2024-01-01 00:00:01,-2\n2024-01-01 00:00:02.5,3e-05\n',
+        ])
+
+    def test_last_row_without_line_end(self):
+        self.assertEqual(b''.join(self.stream_csv([self.RAW[:-2]])), self.EXPORT)
+        self.assertEqual(b''.join(self.stream_csv([self.RAW[:-1]])), self.EXPORT)
+
+
+def write_in_forked_process(done):
+    influxdb.reconnect() # like `run_worker` of the receiver server
+    influxdb.write('bucket', b'measurement value=1 1')
+    # Writes are flushed by a background thread, which stops with the process
+    done.wait(5)
+
+
+class ForkTests(TestCase):
+    """Receiver workers are forked after the InfluxDB client is created"""
+
+    def test_write_in_forked_process(self):
+        received = threading.Event()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.path.startswith('/api/v2/write') and b'measurement value=1 1' in body:
+                    received.set()
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = influxdb.URL
+        influxdb.URL = f'http://127.0.0.1:{server.server_port}'
+        influxdb.reconnect()
+        context = multiprocessing.get_context('fork')
+        done = context.Event()
+        process = context.Process(target=write_in_forked_process, args=(done,))
+        process.start()
+        try:
+            self.assertTrue(received.wait(5))
+        finally:
+            done.set()
+            process.join()
+            server.shutdown()
+            server.server_close()
+            influxdb.URL = url
+            influxdb.reconnect()
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Project, SensorNode, Sensor, UserProject, Measurement
+from .models import User, Project, SensorNode, Sensor, UserProject, Measurement, OutboxJob
 
 class CustomUserAdmin(UserAdmin):
     model = User
@@ -19,3 +19,4 @@ admin.site.register(Measurement)
 admin.site.register(SensorNode)
 admin.site.register(Sensor)
 admin.site.register(UserProject)
+admin.site.register(OutboxJob)
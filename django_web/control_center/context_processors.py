@@ -1,4 +1,6 @@
-from .models import UserProject
+from django.db.models import Prefetch
+
+from .models import UserProject, Project
 import os
 
 APP_NAME = os.getenv('WEB_APP_NAME', 'Control Center')
@@ -9,7 +11,9 @@ def user_projects(request):
     """
     if request.user.is_authenticated:
         # Get all projects where the user is a member
-        projects = UserProject.objects.filter(user=request.user).select_related('project')
+        projects = UserProject.objects.filter(user=request.user).prefetch_related(
+            Prefetch('project', queryset=Project.objects.with_state())
+        )
         return {
             'user_projects': projects,
         }
@@ -49,7 +49,7 @@ class SensorNodeForm(BootstrapModelForm):
 class ProjectForm(BootstrapModelForm):
     class Meta:
         model = Project
-        fields = ('name','description')
+        fields = ('name','description','rollups')
 
 class SensorForm(BootstrapModelForm):
     class Meta:
@@ -0,0 +1,68 @@
+"""
+Side effects of Control Center changes in Grafana and InfluxDB, which are run by the outbox worker
+(`python manage.py runoutbox`) instead of blocking the request.
+
+Jobs are run in the order they were queued and are retried when they fail, so each job has to be idempotent.
+Arguments are stored as JSON, so they are names and plain values, not model instances.
+Project buckets are not changed by jobs, the Receiver server writes to them as soon as they are renamed
+or created, so `Project` changes them synchronously. Their rollups are changed by jobs.
+"""
+
+from typing import Callable
+
+from api_clients import influxdb, grafana
+
+JOBS: dict[str, Callable[..., object]] = dict()
+
+def job(func:Callable[..., object]) -> Callable[..., object]:
+    JOBS[func.__name__] = func
+    return func
+
+@job
+def create_project(name:str, rollups:bool):
+    if rollups:
+        influxdb.create_rollups(name)
+    if not grafana.get_folder(name):
+        grafana.create_folder(name)
+    # Grafana does not overwrite an existing dashboard
+    grafana.create_dashboard(name, rollups)
+
+@job
+def update_project(old_name:str, name:str, old_rollups:bool, rollups:bool):
+    renamed = old_name != name
+    if renamed:
+        # Renaming does nothing if the old buckets or folder do not exist anymore
+        if old_rollups:
+            influxdb.rename_rollups(old_name, name)
+        grafana.rename_folder(old_name, name)
+    if old_rollups != rollups:
+        if rollups:
+            influxdb.create_rollups(name)
+        else:
+            influxdb.delete_rollups(name)
+    # Generated dashboard queries contain the bucket names
+    if renamed or old_rollups != rollups:
+        grafana.replace_dashboard_query(
+            name,
+            grafana.dashboard_query(old_name, old_rollups),
+            grafana.dashboard_query(name, rollups)
+        )
+
+@job
+def delete_project(name:str, rollups:bool):
+    if rollups:
+        influxdb.delete_rollups(name)
+    grafana.delete_folder(name)
+
+@job
+def update_folder_permissions(folder_name:str, members:dict[str, int]):
+    """`members` are permission values of `grafana.FolderPermission` by username"""
+    grafana.update_folder_permissions(folder_name, {name: grafana.FolderPermission(perm) for name, perm in members.items()})
+
+@job
+def change_user_role(username:str, role:grafana.Role):
+    grafana.change_user_role(username, role)
+
+@job
+def delete_user(username:str):
+    grafana.delete_user(username)
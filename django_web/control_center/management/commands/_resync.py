@@ -0,0 +1,41 @@
+"""Shared helpers of the resync commands"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+
+from django.core.management.base import BaseCommand, CommandParser
+
+WORKERS = 8
+
+Task = tuple[str, Callable[[], object]] # (message printed when done, function)
+
+def add_arguments(parser: CommandParser):
+    parser.add_argument('--dry-run', action='store_true', help="Only print the changes that would be made.")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="Number of concurrent requests.")
+
+def run_tasks(command: BaseCommand, tasks: list[Task], options: dict) -> int:
+    """Run the tasks on a bounded thread pool, return the number of failed tasks"""
+    if options['dry_run']:
+        for message, _ in tasks:
+            command.stdout.write(f'[dry run] {message}')
+        return 0
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(options['workers'], 1)) as executor:
+        futures = {executor.submit(func): message for message, func in tasks}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                command.stdout.write(futures[future])
+            except Exception as e:
+                failed += 1
+                command.stderr.write(f'Failed: {futures[future]} - {e.__class__.__name__}: {e}')
+    return failed
+
+def report(command: BaseCommand, task_count: int, failed: int, start: float, options: dict):
+    if options['dry_run']:
+        command.stdout.write(f'{task_count} changes would be made, diffed in {time.perf_counter() - start:.1f} s')
+        return
+    message = f'{task_count - failed} of {task_count} changes done in {time.perf_counter() - start:.1f} s'
+    command.stdout.write(command.style.SUCCESS(message) if not failed else command.style.ERROR(message))
@@ -1,25 +1,40 @@
+import time
+
 from django.core.management.base import BaseCommand, CommandParser
-from control_center.models import Project, update_folder_members
+from control_center.models import Project, get_folder_members
 from api_clients import grafana
+from . import _resync
 
 class Command(BaseCommand):
     help = 'Resync Control center projects with Grafana folders'
     def add_arguments(self, parser: CommandParser) -> None:
         parser.add_argument('--clear', action='store_true', help="Remove all folders that do not have a corresponding project in the Control Center.")
+        _resync.add_arguments(parser)
     
     def handle(self, *args, **options):
-        grafana_project_names = set(folder['title'] for folder in grafana.get_folders())
+        start = time.perf_counter()
+        grafana_project_names = set(folder['title'] for folder in grafana.get_folders(refresh=True))
         projects_names = set(Project.objects.values_list('name', flat=True))
         
-        projects_not_in_grafana = projects_names - grafana_project_names
-        for project_name in projects_not_in_grafana:
-            grafana.create_folder(project_name)
-            update_folder_members(Project.objects.get(name=project_name))
-            grafana.create_dashboard(project_name)
-            print(f'Grafana folder "{project_name}" added')
+        tasks: list[_resync.Task] = []
+        projects_not_in_grafana = Project.objects.filter(name__in=projects_names - grafana_project_names)
+        members = {project.name: get_folder_members(project) for project in projects_not_in_grafana}
+        if members and not options['dry_run']:
+            # One listing of users instead of a lookup per member
+            grafana.get_users({name for project_members in members.values() for name in project_members})
+        for project in projects_not_in_grafana:
+            tasks.append((f'Grafana folder "{project.name}" added', lambda project=project: self.add_folder(project, members[project.name])))
 
         if options['clear']:
             projects_not_in_control_center = grafana_project_names - projects_names
             for project_name in projects_not_in_control_center:
-                grafana.delete_folder(project_name)
-                print(f'Grafana folder "{project_name}" removed')
+                tasks.append((f'Grafana folder "{project_name}" removed', lambda name=project_name: grafana.delete_folder(name)))
+
+        failed = _resync.run_tasks(self, tasks, options)
+        _resync.report(self, len(tasks), failed, start, options)
+
+    @staticmethod
+    def add_folder(project: Project, members: dict[str, int]):
+        grafana.create_folder(project.name)
+        grafana.update_folder_permissions(project.name, {name: grafana.FolderPermission(perm) for name, perm in members.items()})
+        grafana.create_dashboard(project.name, project.rollups)
@@ -1,23 +1,38 @@
+import time
+
 from django.core.management.base import BaseCommand, CommandParser
 from control_center.models import Project
 from api_clients import influxdb
+from . import _resync
 
 class Command(BaseCommand):
     help = 'Resync Control center projects with InfluxDB buckets'
     def add_arguments(self, parser: CommandParser) -> None:
         parser.add_argument('--clear', action='store_true', help="Remove all buckets that do not have a corresponding project in the Control Center.")
+        _resync.add_arguments(parser)
     
     def handle(self, *args, **options):
+        start = time.perf_counter()
         influxdb_project_names: set[str] = set(bucket.name for bucket in influxdb.get_buckets()) # type: ignore
         projects_names = set(Project.objects.values_list('name', flat=True))
+        rollup_names = {
+            influxdb.rollup_bucket_name(project_name, resolution): project_name
+            for project_name in Project.objects.filter(rollups=True).values_list('name', flat=True)
+            for resolution in influxdb.ROLLUPS
+        }
         
+        tasks: list[_resync.Task] = []
         projects_not_in_influxdb = projects_names - influxdb_project_names
         for project_name in projects_not_in_influxdb:
-            influxdb.create_bucket(project_name)
-            print(f'InfluxDB bucket "{project_name}" added')
+            tasks.append((f'InfluxDB bucket "{project_name}" added', lambda name=project_name: influxdb.create_bucket(name)))
+
+        for project_name in set(rollup_names[name] for name in rollup_names.keys() - influxdb_project_names):
+            tasks.append((f'InfluxDB rollups of "{project_name}" added', lambda name=project_name: influxdb.create_rollups(name)))
 
         if options['clear']:
-            projects_not_in_control_center = influxdb_project_names - projects_names
+            projects_not_in_control_center = influxdb_project_names - projects_names - rollup_names.keys()
             for project_name in projects_not_in_control_center:
-                influxdb.delete_bucket(project_name)
-                print(f'InfluxDB bucket "{project_name}" removed')
+                tasks.append((f'InfluxDB bucket "{project_name}" removed', lambda name=project_name: influxdb.delete_bucket(name)))
+
+        failed = _resync.run_tasks(self, tasks, options)
+        _resync.report(self, len(tasks), failed, start, options)
@@ -0,0 +1,55 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.utils import timezone
+from control_center.models import OutboxJob
+
+log = logging.getLogger(__name__)
+
+POLL_PERIOD = 0.5
+MIN_RETRY_DELAY = 1
+MAX_RETRY_DELAY = 300
+MAX_ATTEMPTS = 20 # about an hour with `MAX_RETRY_DELAY`
+
+class Command(BaseCommand):
+    help = 'Run queued Grafana and InfluxDB side effects of Control Center changes, only one worker may run'
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--once', action='store_true', help="Run the queued jobs and exit.")
+
+    def handle(self, *args, **options):
+        while True:
+            job = OutboxJob.objects.filter(failed=False).order_by('pk').first()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(POLL_PERIOD)
+                continue
+            # Jobs are run in order, a failing job delays the following ones
+            wait = (job.next_attempt - timezone.now()).total_seconds()
+            if wait > 0:
+                if options['once']:
+                    return
+                time.sleep(min(wait, POLL_PERIOD))
+                continue
+            self.run_job(job)
+
+    def run_job(self, job:OutboxJob):
+        try:
+            job.run()
+        except Exception as e:
+            job.attempts += 1
+            job.error = f'{e.__class__.__name__}: {e}'
+            if job.attempts >= MAX_ATTEMPTS:
+                job.failed = True
+                log.error(f'Outbox job {job} failed {job.attempts} times, giving up: {job.error}')
+            else:
+                delay = min(MIN_RETRY_DELAY*2**(job.attempts - 1), MAX_RETRY_DELAY)
+                job.next_attempt = timezone.now() + timedelta(seconds=delay)
+                log.warning(f'Outbox job {job} failed, retrying in {delay} s: {job.error}')
+            job.save()
+        else:
+            description = str(job) # the primary key is cleared by `delete`
+            job.delete()
+            log.info(f'Outbox job {description} done')
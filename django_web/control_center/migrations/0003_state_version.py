@@ -0,0 +1,20 @@
+# Generated by Django 5.1.15 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('control_center', '0002_alter_measurement_id_in_project'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateVersion',
+            fields=[
+                ('key', models.CharField(choices=[('measurements', 'Measurements')], max_length=32, primary_key=True, serialize=False)),
+                ('version', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
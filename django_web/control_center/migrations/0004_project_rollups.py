@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-18 20:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('control_center', '0003_state_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='rollups',
+            field=models.BooleanField(default=False, help_text='Aggregate data into 1 s, 1 min and 1 h buckets, dashboards use them for long time ranges.'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-18 20:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('control_center', '0004_project_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stateversion',
+            name='key',
+            field=models.CharField(choices=[('measurements', 'Measurements'), ('connections', 'Connections'), ('sensor_nodes', 'Sensor Nodes'), ('projects', 'Projects')], max_length=32, primary_key=True, serialize=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('control_center', '0006_outbox_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sensornode',
+            name='config_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -3,10 +3,12 @@ from django.contrib.auth.models import AbstractUser
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.core.exceptions import ValidationError
 from django.utils import timezone
+from django.db.models import F, Exists, OuterRef, Prefetch, Subquery, Case, When, Value
 from django.db.models.signals import pre_delete, post_delete
 from django.dispatch import receiver
 
 from api_clients import influxdb, grafana
+from . import jobs
 
 # If set to True, automatically deletes the associated InfluxDB bucket and Grafana folder
 # when a project is removed from the system.
@@ -23,17 +25,86 @@ SENSOR_NODES_FOR_SENSOR_MANAGE: tuple[SensorNodeTypes, ...] = (
 
 TEST_MEASUREMENT_ID = -1
 
+class StateVersion(models.Model):
+    """
+    Version counters of the state that the Receiver server and the polled page fragments cache.
+    The Receiver server polls the versions and reloads the state only when they change,
+    the fragments use them as ETags.
+    """
+    class Keys(models.TextChoices):
+        MEASUREMENTS = 'measurements' # running measurements of sensor nodes
+        CONNECTIONS = 'connections' # connection states of sensor nodes, bumped by the Receiver server
+        SENSOR_NODES = 'sensor_nodes' # sensor nodes and their sensors, `SensorNode.config_version` tells which ones
+        PROJECTS = 'projects' # projects and their users
+
+    key = models.CharField(max_length=32, primary_key=True, choices=Keys)
+    version = models.PositiveBigIntegerField(default=0)
+
+    @classmethod
+    def bump(cls, key:Keys) -> None:
+        if not cls.objects.filter(key=key).update(version=F('version')+1):
+            cls.objects.get_or_create(key=key)
+            cls.objects.filter(key=key).update(version=F('version')+1)
+
+    @classmethod
+    def get(cls, key:Keys) -> int:
+        return cls.objects.filter(key=key).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def get_many(cls, *keys:Keys) -> tuple[int, ...]:
+        versions = dict(cls.objects.filter(key__in=keys).values_list('key', 'version'))
+        return tuple(versions.get(key, 0) for key in keys)
+
+    def __str__(self) -> str:
+        return f'{self.key}, {self.version}'
+
+
+class OutboxJob(models.Model):
+    """
+    Side effect of a change in Grafana or InfluxDB, see `jobs`.
+    The `runoutbox` worker runs the jobs in order and deletes them when they succeed.
+    """
+    name = models.CharField(max_length=64)
+    kwargs = models.JSONField(default=dict)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    error = models.TextField(blank=True)
+    failed = models.BooleanField(default=False) # gave up after too many attempts
+
+    @classmethod
+    def enqueue(cls, name:str, /, **kwargs) -> 'OutboxJob':
+        if name not in jobs.JOBS:
+            raise ValueError(f'Unknown job {name}')
+        return cls.objects.create(name=name, kwargs=kwargs)
+
+    def run(self):
+        jobs.JOBS[self.name](**self.kwargs)
+
+    def __str__(self) -> str:
+        return f'{self.pk}, {self.name}, {self.kwargs}'
+
+
 class User(AbstractUser):
     darkmode = models.BooleanField(default=True)
 
     def save(self, *args, **kwargs) -> None:
-        grafana.change_user_role(self.username, 'Admin' if self.is_staff else 'Editor')
-        return super().save(*args, **kwargs)
+        super().save(*args, **kwargs)
+        # E.g. `last_login` is saved on every login
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'is_staff' in update_fields:
+            OutboxJob.enqueue('change_user_role', username=self.username, role='Admin' if self.is_staff else 'Editor')
 
     def set_password(self, raw_password):
+        # Called synchronously, the password must not be stored in the outbox
         if raw_password:
             # Check if the object does not already exist
             if not self.pk:
+                # A deleted user of the same name may still have a Grafana account, which would be
+                # deleted by the queued job after the new one is created
+                for job in OutboxJob.objects.filter(name='delete_user', kwargs__username=self.username):
+                    job.run()
+                    job.delete()
                 grafana.create_user(self.username, raw_password, 'Editor')
             else:
                 grafana.change_user_password(self.username, raw_password)
@@ -44,38 +115,71 @@ class User(AbstractUser):
         return self.username
 
 
+class ProjectQuerySet(models.QuerySet):
+    def with_state(self):
+        """
+        Annotate the running state and prefetch the last measurement,
+        so `is_running` and `get_last_measurement` do not query per project.
+        """
+        return self.annotate(
+            running=Exists(Measurement.objects.filter(project=OuterRef('pk'), end_time=None))
+        ).prefetch_related(
+            Prefetch('projects', queryset=Measurement.objects.last_of_projects(), to_attr='last_measurements')
+        )
+
+
 class Project(models.Model):
     name = models.CharField(max_length=32, null=False, blank= False)
     description = models.TextField(max_length=400, null=True, blank=True)
     sensor_nodes = models.ManyToManyField('SensorNode')
     users = models.ManyToManyField(User, through='UserProject')
+    rollups = models.BooleanField(
+        default=False,
+        help_text='Aggregate data into 1 s, 1 min and 1 h buckets, dashboards use them for long time ranges.'
+    )
+
+    objects = ProjectQuerySet.as_manager()
 
     def get_last_measurement(self):
+        # Prefetched by `ProjectQuerySet.with_state`
+        if hasattr(self, 'last_measurements'):
+            return self.last_measurements[0] if self.last_measurements else None
         return self.get_test_measurement() or Measurement.objects.filter(project=self).last()
     
     def get_test_measurement(self):
         return Measurement.objects.filter(project=self, id_in_project = TEST_MEASUREMENT_ID).first()
 
     def is_running(self):
+        # Annotated by `ProjectQuerySet.with_state`
+        if hasattr(self, 'running'):
+            return self.running
         last_measurement = self.get_last_measurement()
         return last_measurement.is_running() if (last_measurement is not None) else False
 
     def save(self, *args, **kwargs):
         self.name = clean_name(self.name)
+        renamed = False
 
+        # The bucket is changed synchronously, the Receiver server writes to it by project name,
+        # so it must not wait for queued Grafana jobs
         # Check if the object does not already exist
         if not self.pk: 
-            influxdb.create_bucket(self.name)
-            grafana.create_folder(self.name)
-            grafana.create_dashboard(self.name)
+            if not influxdb.Api.bucket.find_bucket_by_name(self.name):
+                influxdb.create_bucket(self.name)
+            OutboxJob.enqueue('create_project', name=self.name, rollups=self.rollups)
         else:
-            # If the project already exists, check if the name has changed
+            # If the project already exists, check if the name or rollups have changed
             old = Project.objects.get(pk=self.pk)
-            if old.name != self.name:
-                # If the name has changed, rename the InfluxDB bucket and Grafana folder
+            renamed = old.name != self.name
+            if renamed:
                 influxdb.rename_bucket(old.name, self.name)
-                grafana.rename_folder(old.name, self.name)
+            if renamed or old.rollups != self.rollups:
+                OutboxJob.enqueue('update_project', old_name=old.name, name=self.name, old_rollups=old.rollups, rollups=self.rollups)
         super().save(*args, **kwargs)
+        StateVersion.bump(StateVersion.Keys.PROJECTS)
+        # Running measurements are routed to the bucket by project name
+        if renamed:
+            StateVersion.bump(StateVersion.Keys.MEASUREMENTS)
                
     def __str__(self) -> str:
         return f'{self.pk}, {self.name}'
@@ -92,6 +196,7 @@ class Project(models.Model):
         
         measurement.sensor_nodes.set(self.sensor_nodes.all())
         measurement.save()
+        StateVersion.bump(StateVersion.Keys.MEASUREMENTS)
         influxdb.delete_test_measurement(self.name)
 
     def start_test_measurement(self)->None:
@@ -100,6 +205,7 @@ class Project(models.Model):
             measurement = Measurement.objects.create(project = self, id_in_project = TEST_MEASUREMENT_ID)
             measurement.sensor_nodes.set(self.sensor_nodes.all())
             measurement.save()
+            StateVersion.bump(StateVersion.Keys.MEASUREMENTS)
         influxdb.delete_test_measurement(self.name)
 
     def stop_measurement(self):
@@ -110,6 +216,16 @@ class Project(models.Model):
             else:
                 last_measurement.end_time = timezone.now()
                 last_measurement.save()
+            StateVersion.bump(StateVersion.Keys.MEASUREMENTS)
+
+class MeasurementQuerySet(models.QuerySet):
+    def last_of_projects(self):
+        """Only the last measurement of each project, the test measurement takes precedence"""
+        last = Measurement.objects.filter(project=OuterRef('project')).order_by(
+            Case(When(id_in_project=TEST_MEASUREMENT_ID, then=Value(0)), default=Value(1)), '-pk'
+        )
+        return self.filter(pk=Subquery(last.values('pk')[:1]))
+
 
 class Measurement(models.Model):
     project = models.ForeignKey(Project, related_name='projects', on_delete=models.CASCADE)
@@ -118,6 +234,8 @@ class Measurement(models.Model):
     start_time = models.DateTimeField(auto_now_add=True)
     end_time = models.DateTimeField(blank=True, null=True)
 
+    objects = MeasurementQuerySet.as_manager()
+
     class Meta:
         unique_together = ['project', 'id_in_project']
 
@@ -134,11 +252,23 @@ class Measurement(models.Model):
     def __str__(self) -> str:
         return f'{self.project.pk}, {self.id_in_project}'
 
+class SensorNodeQuerySet(models.QuerySet):
+    def with_state(self):
+        """Annotate the running state and prefetch the sensors, so the sensor node tables do not query per row"""
+        return self.annotate(
+            running=Exists(Measurement.objects.filter(project__sensor_nodes=OuterRef('pk'), end_time=None))
+        ).prefetch_related('sensors')
+
+
 class SensorNode(models.Model):
     name = models.CharField(max_length=40, unique=True)
     initialized = models.BooleanField(default=False)
     type = models.IntegerField(choices=SensorNodeTypes) # type: ignore
     connected = models.BooleanField(default=False)
+    # Bumped when the sensor node or its sensors change, the Receiver server then reloads the sensor params
+    config_version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = SensorNodeQuerySet.as_manager()
 
     @property
     def manage_sensors(self) -> bool:
@@ -149,6 +279,9 @@ class SensorNode(models.Model):
         return self.type in SENSOR_NODES_FOR_SENSOR_MANAGE
 
     def is_running(self):
+        # Annotated by `SensorNodeQuerySet.with_state`
+        if hasattr(self, 'running'):
+            return self.running
         projects = Project.objects.filter(sensor_nodes=self)
         for project in projects:
             if project.is_running():
@@ -160,6 +293,12 @@ class SensorNode(models.Model):
         if not self.manage_sensors:
             self.initialized = True
         super().save(*args, **kwargs)
+        self.bump_config_version(self.pk)
+
+    @staticmethod
+    def bump_config_version(pk:int) -> None:
+        SensorNode.objects.filter(pk=pk).update(config_version=F('config_version')+1)
+        StateVersion.bump(StateVersion.Keys.SENSOR_NODES)
 
     def __str__(self) -> str:
         return f'{self.pk}, {self.name}'
@@ -186,7 +325,8 @@ class Sensor(models.Model):
             elif self.samples_per_message > samples_per_message_range[1]:
                 self.samples_per_message = samples_per_message_range[1]
                 
-        return super().save(*args, **kwargs)
+        super().save(*args, **kwargs)
+        SensorNode.bump_config_version(self.sensor_node_id) # type: ignore
 
     def __str__(self) -> str:
         return f'{self.sensor_node.name}, {self.id_in_sensor_node}, {self.name}'
@@ -206,6 +346,7 @@ class UserProject(models.Model):
         if self.is_owner:
             self.is_editor = True
         super().save(*args, **kwargs)
+        StateVersion.bump(StateVersion.Keys.PROJECTS)
         update_folder_members(self.project)
         
 
@@ -213,25 +354,50 @@ class UserProject(models.Model):
         return f'{self.pk}, {self.user}, ({self.project})'
 
 
-def update_folder_members(project:Project):
-    """Update all user permissions for the Grafana folder"""
-    user_projects = UserProject.objects.filter(project=project)
-    members:dict[str, grafana.FolderPermission] = dict()
+def get_folder_members(project:Project) -> dict[str, int]:
+    """Return `grafana.FolderPermission` values of the project's users by username"""
+    user_projects = UserProject.objects.filter(project=project).select_related('user')
+    members:dict[str, int] = dict()
     for user_project in user_projects:
-        members[user_project.user.username] = grafana.FolderPermission.EDIT if user_project.is_editor else grafana.FolderPermission.VIEW
+        members[user_project.user.username] = (grafana.FolderPermission.EDIT if user_project.is_editor else grafana.FolderPermission.VIEW).value
+    return members
 
-    grafana.update_folder_permissions(project.name, members)
+def update_folder_members(project:Project):
+    """Update all user permissions for the Grafana folder"""
+    # The members are queued as they are now, so the jobs are applied in order
+    OutboxJob.enqueue('update_folder_permissions', folder_name=project.name, members=get_folder_members(project))
 
 @receiver(post_delete, sender=User)
 def user_post_delete(sender, instance:User, **kwargs):
     """Remove the user from Grafana after they are deleted from the system."""
-    grafana.delete_user(instance.username)
+    OutboxJob.enqueue('delete_user', username=instance.username)
 
 @receiver(post_delete, sender=UserProject)
 def user_project_post_delete(sender, instance:UserProject, **kwargs):
     """Remove the user from the associated Grafana folder after they are removed from the project."""
+    StateVersion.bump(StateVersion.Keys.PROJECTS)
     update_folder_members(instance.project)
 
+@receiver(post_delete, sender=Measurement)
+def measurement_post_delete(sender, instance:Measurement, **kwargs):
+    """Notify the Receiver server that the running measurements may have changed."""
+    StateVersion.bump(StateVersion.Keys.MEASUREMENTS)
+
+@receiver(post_delete, sender=Project)
+def project_post_delete(sender, instance:Project, **kwargs):
+    """Invalidate the cached project lists."""
+    StateVersion.bump(StateVersion.Keys.PROJECTS)
+
+@receiver(post_delete, sender=SensorNode)
+def sensor_node_post_delete(sender, instance:SensorNode, **kwargs):
+    """Invalidate the cached sensor node tables."""
+    StateVersion.bump(StateVersion.Keys.SENSOR_NODES)
+
+@receiver(post_delete, sender=Sensor)
+def sensor_post_delete(sender, instance:Sensor, **kwargs):
+    """Notify the Receiver server that the sensor params of the sensor node changed."""
+    SensorNode.bump_config_version(instance.sensor_node_id) # type: ignore
+
 @receiver(pre_delete, sender=Project)
 def project_pre_delete(sender, instance:Project, **kwargs):
     """
@@ -239,8 +405,9 @@ def project_pre_delete(sender, instance:Project, **kwargs):
     if `PROJECT_AUTO_PURGE` is `True`.
     """
     if PROJECT_AUTO_PURGE:
+        # Synchronous like creating the bucket, so a new project of the same name keeps its bucket
         influxdb.delete_bucket(instance.name)
-        grafana.delete_folder(instance.name)
+        OutboxJob.enqueue('delete_project', name=instance.name, rollups=instance.rollups)
 
 def clean_name(name:str) -> str:
     '''Remove `"` from name'''
@@ -1,3 +1,217 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from api_clients import influxdb, grafana
+from .models import OutboxJob, User, Project, SensorNode, Sensor, UserProject, Measurement, SensorNodeTypes, StateVersion
+
+
+class BucketTestCase(TestCase):
+    """Projects change their InfluxDB buckets synchronously, the bucket functions are replaced by mocks"""
+    def setUp(self):
+        def patch(target, name: str) -> mock.MagicMock:
+            patcher = mock.patch.object(target, name)
+            self.addCleanup(patcher.stop)
+            return patcher.start()
+
+        patch(influxdb.Api, 'bucket').find_bucket_by_name.return_value = None
+        self.create_bucket = patch(influxdb, 'create_bucket')
+        self.rename_bucket = patch(influxdb, 'rename_bucket')
+        self.delete_bucket = patch(influxdb, 'delete_bucket')
+
+
+# The manifest exists only after `collectstatic`
+@override_settings(STORAGES={'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}})
+class ViewTestCase(BucketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='user')
+        self.client.force_login(self.user)
+        self.project_number = 0
+
+    def add_rows(self, count: int):
+        """Add `count` projects with sensor nodes, sensors and measurements, every other one is running"""
+        for _ in range(count):
+            number = self.project_number = self.project_number + 1
+            project = Project.objects.create(name=f'project{number}')
+            UserProject.objects.create(user=self.user, project=project)
+            sensor_node = SensorNode.objects.create(name=f'node{number}', type=SensorNodeTypes.ESP32, initialized=number % 3 != 0)
+            Sensor.objects.bulk_create(Sensor(sensor_node=sensor_node, id_in_sensor_node=i, name=f'sensor{i}') for i in range(2))
+            project.sensor_nodes.add(sensor_node)
+            for id_in_project in range(2):
+                measurement = Measurement.objects.create(project=project, id_in_project=id_in_project)
+                measurement.sensor_nodes.add(sensor_node)
+            if number % 2:
+                Measurement.objects.filter(project=project).update(end_time='2025-01-01T00:00Z')
+
+
+class QueryCountTests(ViewTestCase):
+    """Pages listing projects, sensor nodes and measurements have to issue a fixed number of queries"""
+
+    def count_queries(self, url: str) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def assertFixedQueryCount(self, url_func):
+        self.add_rows(2)
+        few = self.count_queries(url_func())
+        self.add_rows(10)
+        self.assertEqual(self.count_queries(url_func()), few)
+
+    def test_project_list(self):
+        self.assertFixedQueryCount(lambda: reverse('project_list'))
+
+    def test_sensor_node_list(self):
+        self.assertFixedQueryCount(lambda: reverse('sensor_node_list'))
+
+    def test_reload_sensor_nodes_table(self):
+        self.assertFixedQueryCount(lambda: reverse('reload_sensor_nodes_table'))
+
+    def test_measurement_list(self):
+        self.add_rows(1)
+        project = Project.objects.get(name='project1')
+        few = self.count_queries(reverse('measurement_list', args=[project.pk]))
+        for id_in_project in range(2, 12):
+            measurement = Measurement.objects.create(project=project, id_in_project=id_in_project)
+            measurement.sensor_nodes.set(project.sensor_nodes.all())
+        self.assertEqual(self.count_queries(reverse('measurement_list', args=[project.pk])), few)
+
+    def test_running_state(self):
+        self.add_rows(2)
+        for project in Project.objects.with_state():
+            self.assertEqual(project.is_running(), Project.objects.get(pk=project.pk).is_running())
+            self.assertEqual(project.get_last_measurement(), Project.objects.get(pk=project.pk).get_last_measurement())
+        for sensor_node in SensorNode.objects.with_state():
+            self.assertEqual(sensor_node.is_running(), SensorNode.objects.get(pk=sensor_node.pk).is_running())
+
+
+class FragmentETagTests(ViewTestCase):
+    """Polled fragments are not rendered again until the state they show changes"""
+
+    def assertNotModifiedUntil(self, url: str, key: StateVersion.Keys):
+        self.add_rows(2)
+        self.client.get(url) # sets the CSRF cookie, like the page containing the fragment
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        StateVersion.bump(key)
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_active_projects_panel(self):
+        self.assertNotModifiedUntil(reverse('reload_active_projects_panel'), StateVersion.Keys.PROJECTS)
+
+    def test_start_stop_panel(self):
+        self.add_rows(1)
+        url = reverse('reload_start_stop_panel', args=[Project.objects.get(name='project1').pk])
+        self.assertNotModifiedUntil(url, StateVersion.Keys.MEASUREMENTS)
+
+    def test_sensor_nodes_table(self):
+        self.assertNotModifiedUntil(reverse('reload_sensor_nodes_table'), StateVersion.Keys.CONNECTIONS)
+
+    def test_sensor_nodes_table_project_change(self):
+        self.add_rows(2)
+        project = Project.objects.get(name='project2') # running
+        sensor_node = project.sensor_nodes.get()
+        self.assertTrue(SensorNode.objects.with_state().get(pk=sensor_node.pk).is_running())
+        url = reverse('reload_sensor_nodes_table')
+        self.client.get(url)
+        etag = self.client.get(url)['ETag']
+        self.client.post(reverse('sensor_node_remove_from_project', args=[project.pk, sensor_node.pk]))
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(SensorNode.objects.with_state().get(pk=sensor_node.pk).is_running())
+
+
+class PreviewDataTests(ViewTestCase):
+    COLUMNS = {'time': [1000, 1101], 'min': [1.0, 3.0], 'max': [2.0, 4.0], 'mean': [1.5, 3.5]}
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.add_rows(1)
+        self.project = Project.objects.get(name='project1')
+        self.sensor = Sensor.objects.get(sensor_node__name='node1', name='sensor0')
+
+    def get(self, **params):
+        return self.client.get(reverse('preview_data', args=[self.project.pk, 0, self.sensor.pk]), params)
+
+    @mock.patch.object(influxdb, 'query_aggregate_windows', return_value=COLUMNS)
+    @mock.patch.object(influxdb, 'query_time_range', return_value=(1000, 2001))
+    def test_whole_measurement(self, query_time_range, query_aggregate_windows):
+        response = self.get(width=10)
+        self.assertEqual(response.status_code, 200)
+        # Windows cover the range in at most `width` columns
+        self.assertEqual(response.json(), {'start': 1000, 'stop': 2001, 'window': 101, **self.COLUMNS})
+        query_aggregate_windows.assert_called_once_with('project1', 0, 'node1', 'sensor0', 1000, 2001, 101)
+
+        # Ended measurement is cached
+        self.assertEqual(self.get(width=10).json(), response.json())
+        query_time_range.assert_called_once()
+        query_aggregate_windows.assert_called_once()
+
+    @mock.patch.object(influxdb, 'query_aggregate_windows', return_value=COLUMNS)
+    @mock.patch.object(influxdb, 'query_time_range')
+    def test_range(self, query_time_range, query_aggregate_windows):
+        response = self.get(start=1000, stop=1100, width=1000)
+        self.assertEqual(response.json(), {'start': 1000, 'stop': 1100, 'window': 1, **self.COLUMNS})
+        query_aggregate_windows.assert_called_once_with('project1', 0, 'node1', 'sensor0', 1000, 1100, 1)
+        query_time_range.assert_not_called()
+
+    def test_invalid_params(self):
+        with self.assertLogs('django.request', 'WARNING'):
+            response = self.get(width='wide')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+
+
+class OutboxTests(BucketTestCase):
+    """Grafana and InfluxDB side effects are queued instead of called in the request"""
+
+    def test_project_jobs(self):
+        user = User.objects.create(username='user')
+        project = Project.objects.create(name='project')
+        UserProject.objects.create(user=user, project=project, is_owner=True)
+        project.name = 'renamed'
+        project.save()
+        project.delete()
+        # The Receiver server writes to the bucket by project name, so it is not queued
+        self.create_bucket.assert_called_once_with('project')
+        self.rename_bucket.assert_called_once_with('project', 'renamed')
+        self.delete_bucket.assert_called_once_with('renamed')
+        self.assertEqual(
+            [(job.name, job.kwargs) for job in OutboxJob.objects.order_by('pk')],
+            [
+                ('change_user_role', {'username': 'user', 'role': 'Editor'}),
+                ('create_project', {'name': 'project', 'rollups': False}),
+                ('update_folder_permissions', {'folder_name': 'project', 'members': {'user': 2}}),
+                ('update_project', {'old_name': 'project', 'name': 'renamed', 'old_rollups': False, 'rollups': False}),
+                ('delete_project', {'name': 'renamed', 'rollups': False}),
+                ('update_folder_permissions', {'folder_name': 'renamed', 'members': {}}),
+            ]
+        )
+
+    def test_recreated_user(self):
+        calls = []
+        with (
+            mock.patch.object(grafana, 'create_user', lambda name, *args: calls.append(('create_user', name))),
+            mock.patch.object(grafana, 'delete_user', lambda name: calls.append(('delete_user', name))),
+        ):
+            for deleted in (True, False):
+                # Like the user creation form of the admin
+                user = User(username='user')
+                user.set_password('password')
+                user.save()
+                if deleted:
+                    user.delete()
+        # The Grafana account of the deleted user is deleted before the new one is created
+        self.assertEqual(calls, [('create_user', 'user'), ('delete_user', 'user'), ('create_user', 'user')])
+        self.assertFalse(OutboxJob.objects.filter(name='delete_user').exists())
@@ -7,16 +7,38 @@ from django.contrib import messages
 from django.apps import apps
 from django.utils import timezone
 from django.urls import reverse_lazy
+from django.core.cache import cache
+from django.views.decorators.http import condition
+from django.views.decorators.cache import cache_control
+from django.conf import settings
 
-from pathlib import Path
-import os
+from datetime import datetime, timedelta
+import hashlib
 
-from .models import User, Project, SensorNode, Sensor, UserProject, Measurement, SensorNodeTypes
+from .models import User, Project, SensorNode, Sensor, UserProject, Measurement, SensorNodeTypes, StateVersion
 from .forms import SensorNodeForm, ProjectForm, LoginForm, SensorForm, UserProjectForm
 from api_clients import influxdb, grafana
 
+RUNNING_MEASUREMENT_CACHE_TIMEOUT = 10 # record count of a running measurement changes
+PREVIEW_DEFAULT_WIDTH = 1000
+PREVIEW_MAX_WIDTH = 10_000
+
+
+def state_etag(*keys:StateVersion.Keys, per_user:bool = False):
+    """
+    Return an ETag function for `condition` built from the state versions of `keys`.
+    Polled fragments contain CSRF tokens, so the ETag changes with the CSRF cookie.
+    """
+    def etag(request, *args, **kwargs) -> str:
+        parts = [request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''), *StateVersion.get_many(*keys)]
+        if per_user:
+            parts += [request.user.pk, request.user.darkmode]
+        return hashlib.md5('-'.join(map(str, parts)).encode()).hexdigest()
+    return etag
+
+# Polled by htmx from every open tab, browsers revalidate the fragments and get `304 Not Modified` if nothing changed
+poll_cache_control = cache_control(private=True, no_cache=True)
 
-TEMP_DIR_PATH = Path(__file__).parent/'temp' 
 
 def index(request):
     return redirect('project_list')
@@ -29,7 +51,7 @@ def user_details(request):
 #region Project
 def project_list(request):
     context = {}
-    context['projects'] = Project.objects.all()
+    context['projects'] = Project.objects.with_state()
     return render(request, 'project_list.html', context)
 
 def project_dashboard(request, project_pk):
@@ -39,7 +61,7 @@ def project_dashboard(request, project_pk):
     context['user_project'] = get_object_or_404(UserProject, user=request.user, project=project)
     context['all_user_projects'] = UserProject.objects.filter(project=project)
     grafana_folder = grafana.get_folder(project.name)
-    context['grafana_endpoint'] = f'dashboards/f/{grafana_folder['uid']}' if grafana_folder else None
+    context['grafana_endpoint'] = f'dashboards/f/{grafana_folder["uid"]}' if grafana_folder else None
     return render(request, 'project_dashboard.html', context)
 
 
@@ -97,8 +119,8 @@ def project_deactivate(request, project_pk):
 def project_sensor_node_list(request, project_pk):
     context = {}
     project = get_object_or_404(Project, pk=project_pk)
-    context['sensor_nodes'] = SensorNode.objects.all()
-    context['project_sensor_nodes'] = project.sensor_nodes.all()
+    context['sensor_nodes'] = SensorNode.objects.with_state()
+    context['project_sensor_nodes'] = project.sensor_nodes.with_state()
     context['user_project'] = get_object_or_404(UserProject, user=request.user, project=project)
     #context['project'] = project
     return render(request, 'project_sensor_node_list.html', context)
@@ -190,6 +212,8 @@ def project_leave(request, project_pk):
     user_project.delete()
     return redirect('project_list')
 
+@poll_cache_control
+@condition(etag_func=state_etag(StateVersion.Keys.MEASUREMENTS, StateVersion.Keys.PROJECTS, per_user=True))
 def reload_active_projects_panel(request):
     """
     Reload sidebar active projects panel.
@@ -204,7 +228,10 @@ def measurement_list(request, project_pk):
     context = {}
     project = get_object_or_404(Project, pk=project_pk)
     context['project'] = project
-    context['measurements'] = Measurement.objects.filter(project=project).order_by('-pk')
+    context['measurements'] = (
+        Measurement.objects.filter(project=project)
+        .select_related('project').prefetch_related('sensor_nodes').order_by('-pk')
+    )
     return render(request, 'measurement_list.html', context)
 
 def measurement_data(request, project_pk, measurement_id):
@@ -222,9 +249,33 @@ def explore_data(request, project_pk, measurement_id, sensor_pk, page=1, limit_n
     measurement = get_object_or_404(Measurement, project=project, id_in_project=measurement_id)
     sensor = get_object_or_404(Sensor, pk=sensor_pk)
     sensor_node = sensor.sensor_node
-    record_count = influxdb.query_count(project.name, measurement.id_in_project, sensor_node.name, sensor.name) # type: ignore
+
+    # Start time distinguishes measurements with a reused ID (test measurement)
+    cache_key = f'explore_data_{project.pk}_{measurement.id_in_project}_{measurement.start_time.timestamp()}_{sensor.pk}'
+    # Data of an ended measurement do not change
+    cache_timeout = None if measurement.end_time else RUNNING_MEASUREMENT_CACHE_TIMEOUT
+    record_count = cache.get_or_set(
+        f'{cache_key}_count',
+        lambda: influxdb.query_count(project.name, measurement.id_in_project, sensor_node.name, sensor.name), # type: ignore
+        cache_timeout
+    )
     page_count = record_count//limit_n if record_count % limit_n == 0 else record_count//limit_n + 1
-    records = influxdb.query_select(project.name, measurement.id_in_project, sensor_node.name, sensor.name, limit_n, page-1) # type: ignore
+    page = min(max(page, 1), max(page_count, 1))
+
+    # Start times of already visited pages and the pages after them, so a page is queried
+    # from the nearest known start instead of skipping all records before it
+    page_starts_key = f'{cache_key}_page_starts_{limit_n}'
+    page_starts: dict[int, datetime] = cache.get(page_starts_key, {})
+    start_page = max((start_page for start_page in page_starts if start_page <= page), default=1)
+    records = influxdb.query_select(
+        project.name, measurement.id_in_project, sensor_node.name, sensor.name, limit_n, # type: ignore
+        page_starts.get(start_page, 0), (page - start_page)*limit_n
+    )
+    if records:
+        page_starts[page] = records[0].get_time()
+        page_starts[page + 1] = records[-1].get_time() + timedelta(microseconds=1) # times are stored at most in microseconds
+        cache.set(page_starts_key, page_starts, cache_timeout)
+
     current_timezone = timezone.get_current_timezone()
     context['records'] = (
         (
@@ -242,41 +293,56 @@ def explore_data(request, project_pk, measurement_id, sensor_pk, page=1, limit_n
     context['add_page_field_size'] = len(str(page_count))*10
     return render(request, 'explore_data.html', context)
 
+def preview_data(request, project_pk, measurement_id, sensor_pk):
+    """Return min, max and mean of sensor values per pixel column of a chart as JSON.
+
+    Optional GET params: `start` and `stop` (ns since epoch, the whole measurement by default)
+    and `width` (number of columns).
+    """
+    project = get_object_or_404(Project, pk=project_pk)
+    measurement = get_object_or_404(Measurement, project=project, id_in_project=measurement_id)
+    sensor = get_object_or_404(Sensor, pk=sensor_pk)
+    sensor_node = sensor.sensor_node
+    try:
+        start = int(request.GET['start']) if 'start' in request.GET else None
+        stop = int(request.GET['stop']) if 'stop' in request.GET else None
+        width = min(max(int(request.GET.get('width', PREVIEW_DEFAULT_WIDTH)), 1), PREVIEW_MAX_WIDTH)
+    except ValueError:
+        return JsonResponse({'error': 'start, stop and width have to be integers'}, status=400)
+
+    # Start time distinguishes measurements with a reused ID (test measurement)
+    cache_key = f'preview_data_{project.pk}_{measurement.id_in_project}_{measurement.start_time.timestamp()}_{sensor.pk}_{start}_{stop}_{width}'
+    if (preview := cache.get(cache_key)) is None:
+        if start is None or stop is None:
+            time_range = influxdb.query_time_range(project.name, measurement.id_in_project, sensor_node.name, sensor.name) or (0, 1) # type: ignore
+            start = time_range[0] if start is None else start
+            stop = time_range[1] if stop is None else stop
+        window = max(-(-(stop - start)//width), 1)
+        preview = {
+            'start': start,
+            'stop': stop,
+            'window': window,
+            **influxdb.query_aggregate_windows(project.name, measurement.id_in_project, sensor_node.name, sensor.name, start, stop, window), # type: ignore
+        }
+        # Data of an ended measurement do not change
+        cache.set(cache_key, preview, None if measurement.end_time else RUNNING_MEASUREMENT_CACHE_TIMEOUT)
+    return JsonResponse(preview)
+
 def explore_data_goto(request, project_pk, measurement_id, sensor_pk, count=50):
     """Redirect to explore data view"""
     page = int(request.POST.get('page', 1))
     return redirect('explore_data', project_pk=project_pk, measurement_id=measurement_id, sensor_pk=sensor_pk, page=page)
 
 def export_csv(request, project_pk, measurement_id, sensor_pk):
-    TEMP_DIR_PATH.mkdir(exist_ok=True)
     project = get_object_or_404(Project, pk=project_pk)
     measurement= get_object_or_404(Measurement, project=project, id_in_project=measurement_id)
     sensor = get_object_or_404(Sensor, pk=sensor_pk)
     sensor_node = sensor.sensor_node
-    filename = f'{project.name}_{sensor.sensor_node.name}_{sensor.name}_{measurement.id_in_project}_{measurement.start_time.isoformat(timespec='milliseconds')[:-6]}.csv'
+    filename = f'{project.name}_{sensor.sensor_node.name}_{sensor.name}_{measurement.id_in_project}_{measurement.start_time.isoformat(timespec="milliseconds")[:-6]}.csv'
 
-    i = 0
-    while True:
-        temp_file_path = TEMP_DIR_PATH/f'export_{i}.csv'
-        if not temp_file_path.exists():
-            break
-        else:
-            i+=1
-    
-    influxdb.export_csv(project.name, measurement.id_in_project, sensor_node.name, sensor.name, temp_file_path) # type: ignore
-
-    def file_iterator(path, chunk_size=8192):
-        with open(path, 'rb') as f:
-            while chunk := f.read(chunk_size):
-                yield chunk
-
-        # Remove file after download
-        try:
-            os.remove(path)
-        except FileNotFoundError:
-            pass
-    
-    response = StreamingHttpResponse(file_iterator(temp_file_path), content_type='application/octet-stream')
+    # Rows are streamed from InfluxDB as they are received
+    rows = influxdb.stream_csv(project.name, measurement.id_in_project, sensor_node.name, sensor.name) # type: ignore
+    response = StreamingHttpResponse(rows, content_type='application/octet-stream')
     response['Content-Disposition'] = f'attachment; filename="{filename}"'
 
     return response
@@ -313,6 +379,8 @@ def stop_measurement(request, project_pk):
         else:
             return HttpResponseRedirect(request.META['HTTP_REFERER'])
 
+@poll_cache_control
+@condition(etag_func=state_etag(StateVersion.Keys.MEASUREMENTS))
 def reload_start_stop_panel(request, project_pk):
     """
     Reload start stop panel.
@@ -326,16 +394,19 @@ def reload_start_stop_panel(request, project_pk):
 #region SensorNode
 def sensor_node_list(request):
     context = {}
-    context['sensor_nodes'] = SensorNode.objects.all()
+    context['sensor_nodes'] = SensorNode.objects.with_state()
     return render(request, 'sensor_node_list.html', context)
 
+@poll_cache_control
+# Running states depend on the sensor nodes of projects, which are changed with `PROJECTS`
+@condition(etag_func=state_etag(StateVersion.Keys.MEASUREMENTS, StateVersion.Keys.CONNECTIONS, StateVersion.Keys.SENSOR_NODES, StateVersion.Keys.PROJECTS))
 def reload_sensor_nodes_table(request):
     """
     Reload table of all sensor nodes.
     Called by htmlx.
     """
     context = {}
-    context['sensor_nodes'] = SensorNode.objects.all()
+    context['sensor_nodes'] = SensorNode.objects.with_state()
     return render(request, r'includes/sensor_nodes_table.html', context)
 
 def sensor_node_edit(request, sensor_node_pk=None):
@@ -0,0 +1,291 @@
+"""
+This module provides load tests and benchmarks for the receiver server.
+
+Usage:
+    python benchmark.py load --nodes 2000 --duration 60
+    python benchmark.py udp --nodes 10000 --duration 60
+    python benchmark.py decode
+    python benchmark.py encode
+
+`load` simulates ESP32 sensor nodes which connect to a running receiver server, receive their sensor
+params and stream samples. They acknowledge in-band reconfiguration like the firmware. The simulated nodes are created and initialized in the Control Center
+database before connecting, so the benchmark has to use the same `APP_DATA_PATH` as the server.
+
+`udp` simulates ESP32 sensor nodes which send datagrams to the UDP port of the receiver server, all from one socket.
+Datagrams can be skipped on purpose (`--drop`) to check the loss accounting of the server.
+
+`decode` compares decoding received messages into dataclasses (one object per sample)
+with decoding them into structured NumPy arrays.
+
+`encode` compares creating InfluxDB `Point`s and serializing them for each running project
+with encoding a batch once into line protocol (`influxdb.encode_lines`) and prepending
+the measurement name per project. It needs the InfluxDB env vars.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import struct
+import sys
+import time
+import timeit
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+import sensor_node_protocol as snp
+import fbguard_protocol as fbg
+
+HOST = os.getenv('RECEIVER_HOST', '127.0.0.1')
+PORT = int(os.getenv('RECEIVER_PORT', 5123))
+UDP_PORT = int(os.getenv('RECEIVER_UDP_PORT', PORT))
+SENSOR_NODE_TYPE_ESP32 = 0
+
+
+@dataclass
+class LoadStats:
+    connected: int = 0
+    initialized: int = 0
+    alive: int = 0
+    failed: int = 0
+    frames_sent: int = 0
+    reconfigured: int = 0
+    handshake_times: list[float] = field(default_factory=list)
+
+
+def prepare_nodes(name_prefix: str, count: int, sensor_count: int, sample_period: int, samples_per_message: int) -> list[str]:
+    """Create and initialize simulated sensor nodes in the Control Center database"""
+    import control_center_queries as ccq # Sets up Django, needed only for the load test
+
+    names = [f'{name_prefix}{i}' for i in range(count)]
+    for name in names:
+        sensor_node_id = ccq.get_sensor_node_id_or_create(name, ccq.SensorNodeTypes.ESP32, sensor_count)
+        ccq.Sensor.objects.filter(sensor_node=sensor_node_id).update(sample_period=sample_period, samples_per_message=samples_per_message)
+        for sensor in ccq.Sensor.objects.filter(sensor_node=sensor_node_id, name=None):
+            sensor.name = f'sensor{sensor.id_in_sensor_node}'
+            sensor.save()
+        ccq.SensorNode.objects.filter(pk=sensor_node_id).update(initialized=True)
+    return names
+
+
+def info_to_bytes(name: str, sensor_count: int, unix_time_offset: int) -> bytes:
+    return (
+        bytes([SENSOR_NODE_TYPE_ESP32]) + name.encode(snp.ENC) + bytes([snp.ASCII_ETX, sensor_count])
+        + unix_time_offset.to_bytes(snp.Info.UNIX_TIME_OFFSET_SIZE, 'little')
+    )
+
+
+def sensor_samples_to_bytes(sensor_id: int, start_timestamp: int, sample_period: int, sample_count: int) -> bytes:
+    return bytes([sensor_id]) + b''.join(
+        struct.pack('<Id', start_timestamp + i*sample_period, random.random())
+        for i in range(sample_count)
+    )
+
+
+async def simulate_node(name: str, sensor_count: int, duration: float, stats: LoadStats):
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(HOST, PORT)
+    except OSError:
+        stats.failed += 1
+        return
+    stats.connected += 1
+    params_size = sensor_count*struct.calcsize('<iB')
+    reconfigure: asyncio.Task[bytes] | None = None
+    try:
+        writer.write(info_to_bytes(name, sensor_count, int(time.time()*1000)))
+        params = await reader.readexactly(params_size)
+        stats.handshake_times.append(time.perf_counter() - start)
+        stats.initialized += 1
+        sample_period, samples_per_message = struct.unpack_from('<iB', params)
+
+        timestamp = 0
+        message_period = sample_period*samples_per_message/1000
+        end = time.perf_counter() + duration
+        reconfigure = asyncio.create_task(reader.readexactly(1 + params_size))
+        while time.perf_counter() < end:
+            await asyncio.sleep(message_period)
+            for sensor_id in range(sensor_count):
+                writer.write(sensor_samples_to_bytes(sensor_id, timestamp, sample_period, samples_per_message))
+                stats.frames_sent += 1
+            timestamp += sample_period*samples_per_message
+            if reconfigure.done():
+                # New params are used after the acknowledgement, messages before it have sizes by the old params
+                sample_period, samples_per_message = struct.unpack_from('<iB', reconfigure.result(), 1)
+                message_period = sample_period*samples_per_message/1000
+                writer.write(bytes([snp.RECONFIGURE_ACK]))
+                stats.reconfigured += 1
+                reconfigure = asyncio.create_task(reader.readexactly(1 + params_size))
+            await writer.drain()
+            if reader.at_eof():
+                return
+        stats.alive += 1
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        if reconfigure:
+            reconfigure.cancel()
+        writer.close()
+
+
+async def run_load(names: list[str], sensor_count: int, duration: float, ramp: float) -> LoadStats:
+    # One socket per simulated node
+    import resource
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    stats = LoadStats()
+    tasks = []
+    for name in names:
+        tasks.append(asyncio.create_task(simulate_node(name, sensor_count, duration, stats)))
+        await asyncio.sleep(ramp/len(names))
+    await asyncio.gather(*tasks)
+    return stats
+
+
+def load(args: argparse.Namespace):
+    names = prepare_nodes(args.prefix, args.nodes, args.sensors, args.sample_period, args.samples_per_message)
+    start = time.perf_counter()
+    stats = asyncio.run(run_load(names, args.sensors, args.duration, args.ramp))
+    elapsed = time.perf_counter() - start
+    handshake_times = sorted(stats.handshake_times) or [0.0]
+    print(f'Nodes: {args.nodes}, connected: {stats.connected}, initialized: {stats.initialized}, '
+          f'alive after {args.duration} s: {stats.alive}, failed to connect: {stats.failed}')
+    print(f'Handshake median: {statistics.median(handshake_times)*1000:.1f} ms, '
+          f'p99: {handshake_times[int(len(handshake_times)*0.99)]*1000:.1f} ms')
+    print(f'Frames sent: {stats.frames_sent} ({stats.frames_sent/elapsed:.0f} frames/s), reconfigured: {stats.reconfigured}')
+    if stats.alive < args.nodes:
+        exit(1)
+
+
+def udp_load(args: argparse.Namespace):
+    names = prepare_nodes(args.prefix, args.nodes, args.sensors, args.sample_period, args.samples_per_message)
+    unix_time_offset = int(time.time()*1000)
+    # Headers without the sequence number, it is appended for each datagram
+    prefixes = [
+        snp.DatagramHeader(name, args.sensors, unix_time_offset, 0).to_bytes(SENSOR_NODE_TYPE_ESP32)[:-snp.DatagramHeader.SEQUENCE_NUMBER_SIZE]
+        for name in names
+    ]
+    message_period = args.sample_period*args.samples_per_message/1000
+    sent = dropped = 0
+    timestamp = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        start = time.perf_counter()
+        for sequence_number in range(int(args.duration/message_period)):
+            payload = b''.join(
+                bytes([args.samples_per_message]) + sensor_samples_to_bytes(sensor_id, timestamp, args.sample_period, args.samples_per_message)
+                for sensor_id in range(args.sensors)
+            )
+            sequence_number_bytes = sequence_number.to_bytes(snp.DatagramHeader.SEQUENCE_NUMBER_SIZE, 'little')
+            for prefix in prefixes:
+                if random.random() < args.drop:
+                    dropped += 1
+                    continue
+                s.sendto(prefix + sequence_number_bytes + payload, (HOST, UDP_PORT))
+                sent += 1
+            timestamp += args.sample_period*args.samples_per_message
+            time.sleep(max(start + (sequence_number + 1)*message_period - time.perf_counter(), 0))
+        elapsed = time.perf_counter() - start
+    print(f'Nodes: {args.nodes}, datagrams sent: {sent} ({sent/elapsed:.0f} datagrams/s, {sent*args.sensors/elapsed:.0f} frames/s), '
+          f'dropped on purpose: {dropped}')
+
+
+def report(name: str, func: Callable, messages: int, samples_per_message: int, repeat: int):
+    seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+    print(f'{name:<40} {seconds*1000:8.2f} ms {messages/seconds:12.0f} messages/s {messages*samples_per_message/seconds:14.0f} samples/s')
+
+
+def decode(args: argparse.Namespace):
+    expected_sizes = (snp.SensorSamples.get_expected_size(args.samples),)
+    snp_bytes = b''.join(sensor_samples_to_bytes(0, i*args.samples, 1, args.samples) for i in range(args.messages))
+    print(f'SensorSamples, {args.messages} messages, {args.samples} samples/message')
+    report('dataclasses (SensorSamples)', lambda: snp.SensorSamples.list_from_bytes_with_remainder(snp_bytes, expected_sizes), args.messages, args.samples, args.repeat)
+    report('NumPy (SensorSamplesArray)', lambda: snp.SensorSamplesArray.list_from_bytes_with_remainder(snp_bytes, expected_sizes), args.messages, args.samples, args.repeat)
+
+    readouts = [fbg.Readout(i, i, random.random()) for i in range(args.readouts)]
+    fbg_bytes = b''.join(fbg.Message.build('device', 'sensor', i, readouts).to_bytes() for i in range(args.messages))
+    print(f'FBGuard Message, {args.messages} messages, {args.readouts} readouts/message')
+    report('dataclasses (Message)', lambda: fbg.Message.list_from_bytes_with_remainder(fbg_bytes), args.messages, args.readouts, args.repeat)
+    report('NumPy (MessageArray)', lambda: fbg.MessageArray.list_from_bytes_with_remainder(fbg_bytes), args.messages, args.readouts, args.repeat)
+
+
+def encode(args: argparse.Namespace):
+    # Same as Django settings, makes `api_clients` importable
+    sys.path.append(str(Path(__file__).parent.parent))
+    from api_clients import influxdb
+
+    timestamps = list(range(1_700_000_000_000, 1_700_000_000_000 + args.samples))
+    values = [random.random() for _ in timestamps]
+    batch = [(f'sensor{i}', timestamps, values) for i in range(args.sensors)]
+    points = args.sensors*args.samples
+
+    def encode_points():
+        return [
+            '\n'.join(
+                influxdb.create_point(measurement_id, 'sensor-node', sensor_name, timestamp, value, 'ms').to_line_protocol()
+                for sensor_name, timestamps, values in batch
+                for timestamp, value in zip(timestamps, values)
+            ).encode()
+            for measurement_id in range(args.projects)
+        ]
+
+    def encode_lines():
+        lines = influxdb.encode_lines('sensor-node', batch)
+        return [influxdb.with_measurement(measurement_id, lines) for measurement_id in range(args.projects)]
+
+    print(f'{args.sensors} sensors, {args.samples} samples/sensor, {args.projects} running projects')
+    for name, func in (
+        ('Point', encode_points),
+        ('encode_lines + with_measurement', encode_lines),
+    ):
+        seconds = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f'{name:<40} {seconds*1000:8.2f} ms {points*args.projects/seconds:14.0f} points/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(required=True)
+
+    load_parser = subparsers.add_parser('load', help='Simulate many concurrent ESP32 sensor nodes')
+    load_parser.add_argument('--nodes', type=int, default=2000)
+    load_parser.add_argument('--sensors', type=int, default=1, help='Sensors per node')
+    load_parser.add_argument('--sample-period', type=int, default=100, help='Sample period (ms)')
+    load_parser.add_argument('--samples-per-message', type=int, default=10)
+    load_parser.add_argument('--duration', type=float, default=30, help='Streaming duration per node (s)')
+    load_parser.add_argument('--ramp', type=float, default=10, help='Time to connect all nodes (s)')
+    load_parser.add_argument('--prefix', default='load-test-', help='Sensor node name prefix')
+    load_parser.set_defaults(func=load)
+
+    udp_parser = subparsers.add_parser('udp', help='Simulate many ESP32 sensor nodes sending datagrams')
+    udp_parser.add_argument('--nodes', type=int, default=10000)
+    udp_parser.add_argument('--sensors', type=int, default=1, help='Sensors per node')
+    udp_parser.add_argument('--sample-period', type=int, default=100, help='Sample period (ms)')
+    udp_parser.add_argument('--samples-per-message', type=int, default=10)
+    udp_parser.add_argument('--duration', type=float, default=30, help='Streaming duration (s)')
+    udp_parser.add_argument('--drop', type=float, default=0, help='Fraction of datagrams which are not sent')
+    udp_parser.add_argument('--prefix', default='udp-test-', help='Sensor node name prefix')
+    udp_parser.set_defaults(func=udp_load)
+
+    decode_parser = subparsers.add_parser('decode', help='Compare dataclass and NumPy decoding of received messages')
+    decode_parser.add_argument('--messages', type=int, default=1000)
+    decode_parser.add_argument('--samples', type=int, default=snp.MAX_SAMPLES_PER_MESSAGE, help='ESP32 samples per message')
+    decode_parser.add_argument('--readouts', type=int, default=1024, help='FBGuard readouts per message')
+    decode_parser.add_argument('--repeat', type=int, default=5)
+    decode_parser.set_defaults(func=decode)
+
+    encode_parser = subparsers.add_parser('encode', help='Compare Point and line protocol encoding of samples')
+    encode_parser.add_argument('--sensors', type=int, default=4)
+    encode_parser.add_argument('--samples', type=int, default=10_000, help='Samples per sensor')
+    encode_parser.add_argument('--projects', type=int, default=1, help='Running projects of the sensor node')
+    encode_parser.add_argument('--repeat', type=int, default=5)
+    encode_parser.set_defaults(func=encode)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
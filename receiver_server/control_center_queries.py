@@ -3,9 +3,13 @@ This module provides connection to the control center database and query functio
 """
 
 import os
+import time
+import threading
+from collections import defaultdict
 import django
 import django.conf
-from django.db.models import Max
+from django.db import connections, transaction
+from django.db.models import Max, Case, When, Value
 import sys
 from pathlib import Path
 from dataclasses import dataclass
@@ -27,9 +31,12 @@ django.conf.settings.LOGGING = {}
 django.setup()
 
 # Import models from the Control Center
-from control_center.models import SensorNodeTypes, Sensor, SensorNode, Measurement
+from control_center.models import SensorNodeTypes, Sensor, SensorNode, Measurement, StateVersion
 
 DATA_DIR_PATH = Path(__file__).parent.parent/'data'
+RUNNING_MEASUREMENTS_REFRESH_PERIOD = 0.25
+CONNECTION_STATES_FLUSH_PERIOD = 0.5
+SENSOR_NODE_CONFIGS_REFRESH_PERIOD = 0.25
 
 @dataclass
 class NamedSensorParams(SensorParams):
@@ -61,14 +68,98 @@ def get_sensor_node_id_or_create(name:str, type:SensorNodeTypes, sensor_count:in
         return sensor_node.pk
 
 
-def get_running_project_measurements(sensor_node_id:int) -> list[tuple[str, int]]:
-    """Retrieve the measurement IDs of all projects with running measurements for a specific sensor node."""
-    measurements = Measurement.objects.filter(end_time=None, sensor_nodes=sensor_node_id)
-    return [(m.project.name, m.id_in_project) for m in measurements]
+def get_all_running_project_measurements() -> dict[int, tuple[tuple[str, int], ...]]:
+    """Retrieve the project names and measurement IDs of all running measurements for every sensor node."""
+    rows = Measurement.objects.filter(end_time=None, sensor_nodes__isnull=False).values_list('sensor_nodes', 'project__name', 'id_in_project')
+    routes: dict[int, list[tuple[str, int]]] = defaultdict(list)
+    for sensor_node_id, project_name, measurement_id in rows:
+        routes[sensor_node_id].append((project_name, measurement_id))
+    return {sensor_node_id: tuple(measurements) for sensor_node_id, measurements in routes.items()}
 
-def is_initialized(sensor_node_id:int) -> bool:
-    sensor_node = SensorNode.objects.get(pk=sensor_node_id)
-    return sensor_node.initialized
+class RunningMeasurementsCache:
+    """In-process routing table of running measurements for all sensor nodes.
+
+    A background thread polls the measurements version in the Control Center and reloads the table
+    only when it changes, so `get` does not query the database.
+    """
+    def __init__(self, refresh_period:float) -> None:
+        self.refresh_period = refresh_period
+        self._routes: dict[int, tuple[tuple[str, int], ...]] = dict()
+        self._version: int|None = None
+        self._thread = threading.Thread(target=self._refresh_loop, name=self.__class__.__name__, daemon=True)
+
+    def start(self):
+        self.refresh()
+        self._thread.start()
+
+    def refresh(self):
+        # The version is read first, so the loaded routes are at least as new as the version
+        version = StateVersion.get(StateVersion.Keys.MEASUREMENTS)
+        if version != self._version:
+            self._routes = get_all_running_project_measurements()
+            self._version = version
+            log.debug(f'Running measurements reloaded (version {version})')
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_period)
+            try:
+                self.refresh()
+            except Exception:
+                log.exception('Failed to refresh running measurements')
+
+    def get(self, sensor_node_id:int) -> tuple[tuple[str, int], ...]:
+        """Return (project name, measurement ID) pairs of running measurements for the sensor node"""
+        return self._routes.get(sensor_node_id, tuple())
+
+running_measurements = RunningMeasurementsCache(RUNNING_MEASUREMENTS_REFRESH_PERIOD)
+
+class SensorNodeConfigWatcher:
+    """In-process config versions of all sensor nodes.
+
+    A background thread polls the sensor nodes version in the Control Center and reloads the config versions
+    only when it changes. Clients compare the config version of their sensor node with the version of their
+    params instead of querying the params, so idle database load does not depend on the number of clients.
+    """
+    def __init__(self, refresh_period:float) -> None:
+        self.refresh_period = refresh_period
+        self._configs: dict[int, int] = dict() # sensor node ID -> config version
+        self._version: int|None = None
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._refresh_loop, name=self.__class__.__name__, daemon=True)
+
+    def start(self):
+        self.refresh()
+        self._thread.start()
+
+    def refresh(self):
+        # The version is read first, so the loaded configs are at least as new as the version
+        version = StateVersion.get(StateVersion.Keys.SENSOR_NODES)
+        if version != self._version:
+            configs = dict(SensorNode.objects.values_list('pk', 'config_version'))
+            with self._changed:
+                self._configs = configs
+                self._version = version
+                self._changed.notify_all()
+            log.debug(f'Sensor node configs reloaded (version {version})')
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_period)
+            try:
+                self.refresh()
+            except Exception:
+                log.exception('Failed to refresh sensor node configs')
+
+    def get_version(self, sensor_node_id:int) -> int:
+        return self._configs.get(sensor_node_id, -1)
+
+    def wait(self, sensor_node_id:int, version:int, timeout:float) -> bool:
+        """Wait until the config version of the sensor node is not `version`, return `False` on timeout"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self.get_version(sensor_node_id) != version, timeout)
+
+sensor_node_configs = SensorNodeConfigWatcher(SENSOR_NODE_CONFIGS_REFRESH_PERIOD)
 
 def get_params_for_sensors(sensor_node_id:int) -> list[NamedSensorParams]:
     sensors = Sensor.objects.filter(sensor_node__pk=sensor_node_id, sensor_node__initialized=True)
@@ -97,17 +188,70 @@ def add_sensor(sensor_node_id:int, sensor_name:str) -> Sensor:
     log.info(f'Sensor {sensor.name} added to {sensor_node.name}')
     return sensor
 
+class ConnectionStates:
+    """In-process connection states of sensor nodes which are written to the Control Center in batches.
+
+    `set` only records the latest state, a background thread writes the changed states with one `update`
+    per flush, so a reconnect storm does not lock the database with a write per connection.
+    """
+    def __init__(self, flush_period:float) -> None:
+        self.flush_period = flush_period
+        self._pending: dict[int, bool] = dict()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._flush_loop, name=self.__class__.__name__, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def set(self, sensor_node_id:int, state:bool):
+        with self._lock:
+            self._pending[sensor_node_id] = state
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, dict()
+        if not pending:
+            return
+        try:
+            connected = [sensor_node_id for sensor_node_id, state in pending.items() if state]
+            with transaction.atomic():
+                SensorNode.objects.filter(pk__in=pending).update(
+                    connected=Case(When(pk__in=connected, then=Value(True)), default=Value(False))
+                )
+                StateVersion.bump(StateVersion.Keys.CONNECTIONS)
+        except Exception:
+            # Keep states set meanwhile, they are newer
+            with self._lock:
+                self._pending = pending | self._pending
+            raise
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_period)
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Failed to flush connection states')
+
+connection_states = ConnectionStates(CONNECTION_STATES_FLUSH_PERIOD)
+
+def close_db_connections():
+    """Close database connections of this process, e.g. before forking"""
+    connections.close_all()
+
 def set_sensor_node_conn_state(sensor_node_id:int, state:bool):
-    """Set connection state for the sensor node"""
-    sensor_node = SensorNode.objects.get(pk=sensor_node_id)
-    sensor_node.connected = state
-    sensor_node.save()
+    """Set connection state for the sensor node, it is written to the database by `connection_states`"""
+    connection_states.set(sensor_node_id, state)
 
 def set_all_sensor_nodes_conn_state(state:bool):
     """Set connection state for all sensor nodes"""
-    for sensor_node in SensorNode.objects.all():
-        sensor_node.connected = state
-        sensor_node.save()
+    connection_states.clear()
+    SensorNode.objects.update(connected=state)
+    StateVersion.bump(StateVersion.Keys.CONNECTIONS)
 
 if __name__ == '__main__':
     pass
@@ -5,10 +5,12 @@ This module provides functionality for handling FBGuard messages, including seri
 import struct
 from dataclasses import dataclass
 from typing import ClassVar, Self, Any
+import numpy as np
 
 ENC = 'utf-8'
 BYTE_ORDER = 'little'
 DOUBLE_FORMAT = '<d'
+MAX_READOUT_COUNT = 1024
 
 @dataclass
 class Header:
@@ -28,7 +30,29 @@ class Header:
         if self.sync != self.EXPECTED_SYNC:
             raise Exception('Wrong sync bytes')
         if not self.packet_byte_size:
-            self.packet_byte_size = 80 + self.packet_readout_count*24 + 4
+            self.packet_byte_size = self.get_packet_byte_size(self.packet_readout_count)
+
+    @staticmethod
+    def get_packet_byte_size(packet_readout_count:int) -> int:
+        return 80 + packet_readout_count*24 + 4
+
+    @staticmethod
+    def checksum(header_bytes:bytes) -> int:
+        """Sum of header bytes before the checksum"""
+        return sum(header_bytes[:Header.SIZE-4]) & 0xFFFFFFFF
+
+    @classmethod
+    def is_valid(cls, header_bytes:bytes) -> bool:
+        """Check sync bytes, readout count, packet size and checksum (if it is not zero) of `SIZE` header bytes"""
+        if header_bytes[0:3] != cls.EXPECTED_SYNC:
+            return False
+        packet_readout_count = int.from_bytes(header_bytes[70:72], BYTE_ORDER)
+        if packet_readout_count > MAX_READOUT_COUNT:
+            return False
+        if int.from_bytes(header_bytes[72:76], BYTE_ORDER) != cls.get_packet_byte_size(packet_readout_count):
+            return False
+        header_checksum = int.from_bytes(header_bytes[76:80], BYTE_ORDER)
+        return not header_checksum or header_checksum == cls.checksum(header_bytes)
         
     @classmethod
     def from_bytes(cls, header_bytes:bytes):
@@ -50,9 +74,7 @@ class Header:
     def compute_checksum(self):
         #raise NotImplementedError
         if self.packet_byte_size:
-            #count = self.packet_byte_size/4-1
-            _bytes = self.to_bytes()[:self.SIZE-4]
-            return sum(_bytes)
+            return self.checksum(self.to_bytes())
 
 
 @dataclass
@@ -62,6 +84,7 @@ class Readout:
     value:float # 8B
 
     SIZE:ClassVar = 24
+    DTYPE:ClassVar = np.dtype([('timestamp_seconds', '<u8'), ('timestamp_microseconds', '<u8'), ('value', '<f8')])
         
     @classmethod
     def from_bytes(cls, readout_bytes:bytes):
@@ -86,11 +109,26 @@ class Data:
         return b''.join(readout.to_bytes() for readout in self.readouts)
 
 
+@dataclass
+class DataArray(Data):
+    """`Data` decoded into a structured NumPy array (`Readout.DTYPE`) instead of `Readout` objects"""
+    readouts:np.ndarray # type: ignore
+
+    @classmethod
+    def from_bytes(cls, data_bytes:bytes):
+        return cls(np.frombuffer(data_bytes, Readout.DTYPE))
+
+    def to_bytes(self) -> bytes:
+        return self.readouts.tobytes()
+
+
 @dataclass
 class Message:
     header:Header
     data:Data
     packet_checksum:bytes|None = None
+
+    DATA_CLASS:ClassVar[type[Data]] = Data
     
     @classmethod
     def from_bytes(cls, message_bytes:bytes):
@@ -98,7 +136,7 @@ class Message:
         header = Header.from_bytes(message_bytes[index:80])
         index += 80
         data_size = header.packet_readout_count*24
-        data = Data.from_bytes(message_bytes[index:index+data_size])
+        data = cls.DATA_CLASS.from_bytes(message_bytes[index:index+data_size])
         index += data_size
         packet_checksum = message_bytes[index:index+4]
         return cls(header, data, packet_checksum)
@@ -115,18 +153,49 @@ class Message:
     @classmethod
     def list_from_bytes_with_remainder(cls, message_bytes:bytes) -> tuple[list[Self], bytes]:
         """Return the list of `Messages` and any remainder bytes"""
-        cls_list: list[Self] = []
         bytes_view = memoryview(message_bytes)
-        while (expected_size := cls.get_expected_size(bytes_view)) and expected_size <= len(bytes_view):
-            cls_list.append(cls.from_bytes(bytes_view[:expected_size]))
-            bytes_view = bytes_view[expected_size:]
-        return cls_list, bytes(bytes_view)
+        cls_list, size, _ = cls.list_from_buffer(bytes_view)
+        return cls_list, bytes(bytes_view[size:])
+
+    @classmethod
+    def list_from_buffer(cls, bytes_view:memoryview) -> tuple[list[Self], int, int]:
+        """Return the list of `Messages`, the number of parsed bytes and the number of discarded bytes, without copying the remainder
+
+        Bytes which do not start a valid header (e.g. after a transmission error) are discarded up to the next sync bytes,
+        so the remainder is never longer than the maximum message size.
+        """
+        cls_list: list[Self] = []
+        index = 0
+        discarded = 0
+        searched: bytes | None = None # copy for searching sync bytes, made only after invalid data
+        while index < len(bytes_view):
+            header_bytes = bytes_view[index:index+Header.SIZE]
+            if len(header_bytes) < Header.SIZE:
+                if Header.EXPECTED_SYNC.startswith(header_bytes[:3]):
+                    break # incomplete header
+            elif Header.is_valid(header_bytes):
+                expected_size = int.from_bytes(header_bytes[72:76], BYTE_ORDER)
+                if expected_size > len(bytes_view) - index:
+                    break # incomplete message
+                cls_list.append(cls.from_bytes(bytes_view[index:index+expected_size]))
+                index += expected_size
+                continue
+
+            # Skips to the next sync bytes, last bytes are kept if they can start the sync bytes
+            if searched is None:
+                searched = bytes(bytes_view)
+            next_index = searched.find(Header.EXPECTED_SYNC, index + 1)
+            if next_index == -1:
+                next_index = max(len(searched) - len(Header.EXPECTED_SYNC) + 1, index + 1)
+            discarded += next_index - index
+            index = next_index
+        return cls_list, index, discarded
 
     @classmethod
     def build(cls, device_id:str, sensor_id:str, packet_counter:int, readouts:list[Readout], calc_checksum=False) -> Self:
         if calc_checksum:
             raise NotImplementedError
-        if len(readouts) > 1024:
+        if len(readouts) > MAX_READOUT_COUNT:
             raise Exception('maximum number of readouts exceeded')
         header = Header(Header.EXPECTED_SYNC, 0, device_id, sensor_id, packet_counter, len(readouts), None, None)
         data = Data(readouts)
@@ -145,3 +214,11 @@ class Message:
         
     def compute_checksum(self):
         raise NotImplementedError
+
+
+@dataclass
+class MessageArray(Message):
+    """`Message` with readouts decoded into a structured NumPy array"""
+    data:DataArray # type: ignore
+
+    DATA_CLASS:ClassVar[type[Data]] = DataArray
@@ -1,5 +1,15 @@
 """
 This module is used to handle TCP communication between the server and clients.
+
+Clients are served either by one thread per connection (`threads` engine) or by coroutines
+on a single asyncio event loop (`asyncio` engine), selected by the `RECEIVER_ENGINE` env var.
+
+ESP32 sensor nodes can also send self-contained datagrams to the UDP port `RECEIVER_UDP_PORT` (`UDPReceiver`),
+a single thread then receives data of all of them.
+
+With `RECEIVER_WORKERS` > 1 the server runs in that many worker processes which share the port
+(`SO_REUSEPORT`), the kernel distributes new connections among them. Each worker has its own
+spool directory and metrics port (`RECEIVER_METRICS_PORT` + worker index).
 """
 
 import logging
@@ -32,33 +42,63 @@ else:
 import socket
 import time
 import threading
-from typing import TypeAlias
+import asyncio
+from typing import Callable, TypeAlias
 from abc import ABC, abstractmethod
 import signal
+import itertools
+import functools
+import multiprocessing
+import queue
+import numpy as np
 
 import sensor_node_protocol as snp
 import fbguard_protocol as fbg
 import control_center_queries as ccq
+from recv_buffer import RecvBuffer
+from spool import Spool, merge_segments
+from registry import ClientRegistry, Token
+from pipeline import Pipeline
+import metrics
 from api_clients import influxdb
 
 HOST = os.getenv('RECEIVER_HOST', '0.0.0.0')
 PORT = int(os.getenv('RECEIVER_PORT', 5123))
+ENGINE = os.getenv('RECEIVER_ENGINE', 'threads') # 'threads' or 'asyncio'
+SPOOL = False if os.getenv('RECEIVER_SPOOL') == 'false' else True
+SPOOL_PATH = APP_DATA_PATH/'receiver_spool'
+PIPELINE = False if os.getenv('RECEIVER_PIPELINE') == 'false' else True
+DECODE_WORKERS = int(os.getenv('RECEIVER_DECODE_WORKERS', 4))
+DECODE_QUEUE_TIMEOUT = 1 # max time (s) a receiving thread waits for a full decode queue
+METRICS_PORT = int(os.getenv('RECEIVER_METRICS_PORT', 9123)) # 0 disables the metrics endpoint
+WORKERS = int(os.getenv('RECEIVER_WORKERS', 1))
+UDP_PORT = int(os.getenv('RECEIVER_UDP_PORT', 0)) # 0 disables the UDP transport
 
 RECV_SIZE = 4096
-SENSOR_PARAMS_UPDATE_PERIOD = 1
+SENSOR_PARAMS_WAIT_PERIOD = 1 # max time (s) between checks if the client was stopped while waiting for params
+RECONFIGURE_TIMEOUT = 5 # max time (s) to wait for the acknowledgement of new params before restarting the client
 MAX_FIRST_MESSAGE_FRAGMENTATION = 1024
 CLIENT_TIMEOUT = 3
 UINT32_MAX = 0xFFFFFFFF
+LISTEN_BACKLOG = 20 # max number of pending requests
+ASYNC_LISTEN_BACKLOG = 4096
+ASYNC_RECV_HIGH_WATER = 1024*1024 # pause reading from the transport above this many buffered bytes
+UDP_BATCH_SIZE = 256 # max datagrams handled per wakeup
+UDP_BATCH_BUFFER_SIZE = 1024*1024
+UDP_MAX_DATAGRAM_SIZE = 65535
+UDP_RECV_BUFFER_SIZE = 4*1024*1024 # kernel buffer, keeps datagrams arriving while a batch is handled
+UDP_CLIENT_TIMEOUT = 10 # a sensor node is disconnected if it does not send a datagram for this many seconds
+UDP_SWEEP_PERIOD = 1
+UDP_CLIENT_RETRY_DELAY = 10 # datagrams of a sensor node whose client failed to be created are ignored for this many seconds
+UDP_MAX_PENDING_CLIENTS = 1000 # max clients being created at once, datagrams of other new sensor nodes are ignored
 
 class KeepAlive:
     INTERVAL = 15
     INTERVAL_BETWEEN_ATTEMPTS = 1
     MAX_FAILED_ATTEMPTS = 3
 
-if DEBUG:
-    from math import isnan
-
 Addr: TypeAlias = tuple[str, int]  # (ip, port)
+Batch: TypeAlias = list[tuple[str, list[int], list[float]]] # [(sensor name, timestamps, values), ...]
 
 def thread_exception_handler(args):
     logging.error(f"Exception in thread {args.thread.name}: {args.exc_value}", exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
@@ -72,58 +112,121 @@ def handle_stop_signal(signum, frame):
     """
     exit(0)
 
-class FreqCounter:
-    def __init__(self, measure_period:float|int) -> None:
-        self.measure_period = measure_period
-        self.count = -1
-        self.count_lock = threading.Lock()
-        self._run = False
-        self.log_loop_thread = threading.Thread(target=self.log_loop)
+BYTES_RECEIVED = metrics.Counter('receiver_received_bytes_total', 'Bytes received from sensor nodes')
+CONNECTIONS_ACCEPTED = metrics.Counter('receiver_accepted_connections_total', 'Accepted TCP connections')
+FRAMES_DECODED = metrics.Counter('receiver_decoded_frames_total', 'Decoded messages with samples', ('type',))
+DECODE_ERRORS = metrics.Counter('receiver_decode_errors_total', 'Received data which failed to decode', ('type',))
+DISCARDED_BYTES = metrics.Counter('receiver_discarded_bytes_total', 'Received bytes discarded as invalid while resynchronizing the stream', ('type',))
+POINTS_WRITTEN = metrics.Counter('receiver_written_points_total', 'Points written (or queued for writing) to InfluxDB', ('bucket',))
+WRITE_DURATION = metrics.Histogram('receiver_write_seconds', 'Time spent by a client writing (or queuing) one batch')
+UDP_DATAGRAMS = metrics.Counter('receiver_udp_datagrams_total', 'Received UDP datagrams by result (accepted, invalid, duplicate, uninitialized, pending - the client is being created or failed to be created)', ('result',))
+UDP_LOST_DATAGRAMS = metrics.Counter('receiver_udp_lost_datagrams_total', 'Gaps in datagram sequence numbers, late datagrams are counted again in receiver_udp_late_datagrams_total')
+UDP_LATE_DATAGRAMS = metrics.Counter('receiver_udp_late_datagrams_total', 'Datagrams received after a datagram with a higher sequence number')
+UDP_BATCH = metrics.Histogram('receiver_udp_batch_datagrams', 'Datagrams received per wakeup of the UDP receiver', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
 
-    def start(self):
-        self.count = 0
-        self._run = True
-        self.log_loop_thread.start()
+# Writes go through the on-disk spool, so receiving is not blocked by InfluxDB outages
+spool = Spool(SPOOL_PATH) if SPOOL else None
+# Received data are decoded and written by worker threads, so receiving is not blocked by decoding and writing
+pipeline = Pipeline(spool.append if spool else influxdb.write, DECODE_WORKERS) if PIPELINE else None
+write = pipeline.write if pipeline else spool.append if spool else influxdb.write
 
-    def stop(self):
-        self._run = False
-
-    def log_loop(self):
-        while self._run:
-            time.sleep(self.measure_period)
-            log.debug(f'DB write freq: {self.count/self.measure_period}')
-            with self.count_lock:
-                self.count = 0
-
-    def __add__(self, count: int):
-        with self.count_lock:
-            self.count += count
-        return self
-if DEBUG:
-    freq = FreqCounter(5)
-    freq.start()
+if spool:
+    metrics.Gauge('receiver_spool_backlog_bytes', 'Spooled bytes not written to InfluxDB yet', spool.backlog)
+if pipeline:
+    _stages = (*pipeline.decode_stages, pipeline.writer)
+    metrics.Gauge('receiver_pipeline_queue_depth', 'Items waiting in the pipeline stage queue', lambda: {(stage.name,): stage.depth for stage in _stages}, ('stage',))
+    metrics.CallbackCounter('receiver_pipeline_dropped_total', 'Items dropped because the pipeline stage queue was full', lambda: {(stage.name,): stage.dropped for stage in _stages}, ('stage',))
 
 # Abstract class
 class Client(ABC):
     TYPE: ccq.SensorNodeTypes
 
-    def __init__(self, server: 'Server', c: socket.socket, addr: Addr, initial_recv_buffer:bytes = bytes()) -> None:
+    def __init__(self, server: 'Server', c: 'socket.socket | AsyncConnection', addr: Addr, recv_buffer:RecvBuffer) -> None:
         self.id: int
         self.name: str
-        self.recv_buffer = initial_recv_buffer
+        self.recv_buffer = recv_buffer
+        # Decode workers of the pipeline decode copies of received data from their own buffer
+        self.decode_buffer = RecvBuffer() if pipeline else recv_buffer
         self.server = server
         self.c = c
         self.addr = addr
         self._run = True
         self.change_state_after_disconnect = True
+        self.registry_token: Token | None = None
         self.server.add_client(self)
         log.info(f'({addr[0]}:{addr[1]}) identified as {self.name}')
         self.server.stop_client_if_exists(self.name, self)
 
     @abstractmethod
-    def serve(self):
+    def decode(self) -> Batch:
+        """Decode and consume complete messages from `decode_buffer`"""
+        pass
+
+    @abstractmethod
+    def write(self, batch: Batch):
+        """Write the decoded batch to all running measurements of the sensor node"""
         pass
 
+    def process(self, data: bytes):
+        """Decode and write data received by the socket reader (called by a decode worker of the pipeline)"""
+        self.decode_buffer.write(data)
+        if batch := self._decode():
+            self.write(batch)
+
+    def handle_received(self):
+        """Decode and write received data, or queue them for the pipeline (`threads` engine)"""
+        if pipeline:
+            self._submit(DECODE_QUEUE_TIMEOUT)
+        elif batch := self._decode():
+            self.write(batch)
+
+    async def handle_received_async(self):
+        """Decode and write received data, or queue them for the pipeline (`asyncio` engine)"""
+        if pipeline:
+            self._submit(0)
+        # Decodes on the event loop, the receive buffer may be filled while writing in the thread
+        elif batch := self._decode():
+            await asyncio.to_thread(self.write, batch)
+
+    def _decode(self) -> Batch:
+        try:
+            batch = self.decode()
+        except Exception:
+            DECODE_ERRORS.inc(1, self.__class__.__name__)
+            raise
+        FRAMES_DECODED.inc(len(batch), self.__class__.__name__)
+        return batch
+
+    def discard(self, size: int):
+        """Count bytes skipped by the decoder as invalid"""
+        if size:
+            DISCARDED_BYTES.inc(size, self.__class__.__name__)
+            log.debug(f'{self} - discarded {size} B of invalid data')
+
+    def _submit(self, timeout: float):
+        if not len(self.recv_buffer) or not pipeline:
+            return
+        data = bytes(self.recv_buffer.data)
+        self.recv_buffer.consume(len(data))
+        if not pipeline.submit(self, data, timeout):
+            # Dropped data would break message boundaries, the sensor node starts a new stream after reconnecting
+            log.error(f'{self} - decode queue is full - disconnecting')
+            self.stop()
+
+    def write_to_running_measurements(self, batch: Batch, write_precision: influxdb.TimePrecision):
+        """Encode the batch once and write it to each running project, only the measurement name differs"""
+        running_measurements = ccq.running_measurements.get(self.id)
+        if not running_measurements:
+            return
+        lines = influxdb.encode_lines(self.name, batch)
+        if not lines:
+            return
+        point_count = sum(len(timestamps) for _, timestamps, _ in batch)
+        with WRITE_DURATION.time():
+            for project_name, measurement_id in running_measurements:
+                write(project_name, influxdb.with_measurement(measurement_id, lines), write_precision)
+                POINTS_WRITTEN.inc(point_count, project_name)
+
     def stop(self):
         self._run = False
 
@@ -132,34 +235,184 @@ class Client(ABC):
         self.stop()
         self.server.remove_client(self)
         if self.change_state_after_disconnect and hasattr(self, 'id'):
-            ccq.set_sensor_node_conn_state(self.id, False)
+            self.server.set_conn_state(self, False)
         log.info(f'{self} - disconnected')
+        log.debug(f'{self} - receive buffer {self.recv_buffer.stats()}')
 
     def __str__(self) -> str:
         return f'({self.__class__.__name__}, {self.name}, {self.addr[0]}:{self.addr[1]})'
 
 
-class ESP32(Client):
+class StreamClient(Client):
+    """Client served on its own TCP connection"""
+
+    @abstractmethod
+    def serve(self):
+        """Serve the client on a blocking socket (`threads` engine)"""
+        pass
+
+    @abstractmethod
+    async def serve_async(self):
+        """Serve the client as a coroutine on the event loop (`asyncio` engine)"""
+        pass
+
+    def recv(self) -> int:
+        """Receive data into `recv_buffer` (`threads` engine), return the number of received bytes (0 if the connection is closed)"""
+        size = self.recv_buffer.recv_into(self.c, RECV_SIZE) # type: ignore
+        BYTES_RECEIVED.inc(size)
+        return size
+
+
+class ESP32Base(Client):
+    """Sensor params and samples of an ESP32 sensor node, shared by TCP (`ESP32`) and UDP (`ESP32Datagrams`) clients"""
     TYPE = ccq.SensorNodeTypes.ESP32 # need to add to Control Center
-    #ADDITIONAL_TIMEOUT = 5
 
-    def __init__(self, server: 'Server', c: socket.socket, addr: Addr, snp_info: snp.Info) -> None:
+    def __init__(self, server: 'Server', c: 'socket.socket | AsyncConnection', addr: Addr, snp_info: snp.Info, recv_buffer:RecvBuffer) -> None:
         self.name = snp_info.name
         self.sensor_count = snp_info.sensor_count
         self.unix_time_offset = snp_info.unix_time_offset
-        super().__init__(server, c, addr)
+        self.sensor_params_list: list[ccq.NamedSensorParams] = []
+        self.config_version = -1 # config version of `sensor_params_list`
+        self.ready_to_time_overflow = False
+        self.time_overflow_offset = 0
+        super().__init__(server, c, addr, recv_buffer)
+
+    def register(self):
+        """Get the sensor node ID from the Control Center and mark it as connected"""
+        self.id = ccq.get_sensor_node_id_or_create(self.name, self.TYPE, self.sensor_count)
+        self.server.set_conn_state(self, True)
+
+    def params_changed(self) -> bool:
+        """Check if the config version changed since the params were loaded, does not query the database"""
+        return ccq.sensor_node_configs.get_version(self.id) != self.config_version
+
+    def load_sensor_params(self) -> list[ccq.NamedSensorParams]:
+        """Query sensor params, the config version is read first, so the params are at least as new as the version"""
+        self.config_version = ccq.sensor_node_configs.get_version(self.id)
+        return ccq.get_params_for_sensors(self.id)
+
+    def load_changed_params(self) -> list[ccq.NamedSensorParams] | None:
+        """Return new sensor params if they changed, queries them only if the config version changed"""
+        if not self.params_changed():
+            return None
+        sensor_params_list = self.load_sensor_params()
+        return sensor_params_list if sensor_params_list != self.sensor_params_list else None
+
+    def to_batch(self, sensor_samples_list: list[snp.SensorSamplesArray], size: int) -> Batch:
+        """Convert decoded messages to a batch and consume their `size` bytes from `decode_buffer`"""
+        if not sensor_samples_list:
+            self.decode_buffer.consume(size)
+            return []
+
+        # Checks if ESP32 time overflowed
+        current_timestamp = int(sensor_samples_list[0].samples['timestamp'][0])
+        if not self.ready_to_time_overflow and current_timestamp >= UINT32_MAX//2:
+            self.ready_to_time_overflow = True
+        elif self.ready_to_time_overflow and current_timestamp < (UINT32_MAX//2)-1000: # 1000 -> safety offset 
+            self.ready_to_time_overflow = False
+            self.time_overflow_offset += UINT32_MAX
+            log.info(f'{self} - time overflow')
+
+        if DEBUG and any(np.isnan(sensor_samples.samples['value']).any() for sensor_samples in sensor_samples_list):
+            log.debug(f'{self} - NaN value detected')
+
+        # Converts whole arrays to Python lists at once instead of converting each sample
+        batch = [
+            (
+                self.sensor_params_list[sensor_samples.sensor_id].name,
+                (sensor_samples.samples['timestamp'].astype(np.int64) + (self.unix_time_offset + self.time_overflow_offset)).tolist(),
+                sensor_samples.samples['value'].tolist(),
+            )
+            for sensor_samples in sensor_samples_list
+        ]
+        # Arrays are views of the receive buffer, they must not be used after consuming
+        self.decode_buffer.consume(size)
+        return batch
+
+    def write(self, batch: Batch):
+        self.write_to_running_measurements(batch, write_precision='ms')
+
+
+class ESP32(ESP32Base, StreamClient):
+    #ADDITIONAL_TIMEOUT = 5
+
+    def __init__(self, server: 'Server', c: 'socket.socket | AsyncConnection', addr: Addr, snp_info: snp.Info, recv_buffer:RecvBuffer) -> None:
+        self.expected_sizes: tuple[int, ...] = tuple()
+        # Params and expected sizes sent in `Reconfigure`, used after the sensor node acknowledges them
+        self.pending_sensor_params: tuple[list[ccq.NamedSensorParams], tuple[int, ...]] | None = None
+        self.reconfigure_deadline = 0.0
+        super().__init__(server, c, addr, snp_info, recv_buffer)
+
+    @staticmethod
+    def get_expected_sizes(sensor_params_list: list[ccq.NamedSensorParams]) -> tuple[int, ...]:
+        """Get expected size for all sensor sample messages"""
+        return tuple(snp.SensorSamples.get_expected_size(param.samples_per_message) for param in sensor_params_list)
+
+    def set_sensor_params(self, sensor_params_list: list[ccq.NamedSensorParams]) -> bytes:
+        """Use new sensor params and return the `SetSensorParams` message for the sensor node"""
+        self.sensor_params_list = sensor_params_list
+        self.expected_sizes = self.get_expected_sizes(sensor_params_list)
+        return snp.SetSensorParams(sensor_params_list).to_bytes()
+
+    def reconfigure(self, sensor_params_list: list[ccq.NamedSensorParams]):
+        """Send new sensor params on the live connection, they are used from the acknowledgement (see `decode`).
+
+        The client is restarted instead if the number of sensors changed or the sensor node was uninitialized.
+        """
+        if len(sensor_params_list) != len(self.sensor_params_list):
+            log.info(f'{self} - sensors changed - restarting {self.__class__.__name__}')
+            self.stop()
+            return
+        log.info(f'{self} - params changed - reconfiguring')
+        self.reconfigure_deadline = time.monotonic() + RECONFIGURE_TIMEOUT
+        self.pending_sensor_params = (sensor_params_list, self.get_expected_sizes(sensor_params_list))
+        self.c.send(snp.Reconfigure(sensor_params_list).to_bytes())
+
+    def waiting_for_reconfigure_ack(self) -> bool:
+        """Check if new params were not acknowledged yet, restarts the client if the acknowledgement timed out
+        (e.g. firmware without in-band reconfiguration)"""
+        if self.pending_sensor_params is None:
+            return False
+        if time.monotonic() > self.reconfigure_deadline:
+            log.warning(f'{self} - params not acknowledged - restarting {self.__class__.__name__}')
+            self.stop()
+        return True
+
+    def apply_pending_params(self):
+        """Swap to the params acknowledged by the sensor node, called between two messages with samples"""
+        if self.pending_sensor_params is None:
+            log.warning(f'{self} - unexpected reconfigure acknowledgement')
+            return
+        self.sensor_params_list, self.expected_sizes = self.pending_sensor_params
+        self.pending_sensor_params = None
+        log.info(f'{self} - reconfigured')
+
+    def decode(self) -> Batch:
+        batch = self.decode_samples()
+        # Messages after the acknowledgement have sizes by the new params
+        while len(data := self.decode_buffer.data) and data[0] == snp.RECONFIGURE_ACK:
+            self.decode_buffer.consume(1)
+            self.apply_pending_params()
+            batch += self.decode_samples()
+        return batch
+
+    def decode_samples(self) -> Batch:
+        """Decode messages with samples up to the next acknowledgement of new params"""
+        sensor_samples_list, size, discarded = snp.SensorSamplesArray.list_from_buffer(self.decode_buffer.data, self.expected_sizes)
+        self.discard(discarded)
+        return self.to_batch(sensor_samples_list, size)
 
     def serve(self):
         try:
-            ready_to_time_overflow = False
-            time_overflow_offset = 0
-            with self.c:
-                self.id = ccq.get_sensor_node_id_or_create(self.name, self.TYPE, self.sensor_count)
-                ccq.set_sensor_node_conn_state(self.id, True)
+            with self.c: # type: ignore
+                self.register()
                 
                 sensor_params_list: list[ccq.NamedSensorParams]
-                while not (sensor_params_list := ccq.get_params_for_sensors(self.id)):
-                    time.sleep(SENSOR_PARAMS_UPDATE_PERIOD)
+                while not (sensor_params_list := self.load_sensor_params()):
+                    # Until the sensor node is initialized in the Control Center
+                    while not ccq.sensor_node_configs.wait(self.id, self.config_version, SENSOR_PARAMS_WAIT_PERIOD):
+                        if not self._run:
+                            return
                 '''
                 self.c.settimeout(
                     max(
@@ -169,132 +422,415 @@ class ESP32(Client):
                 )
                 '''
                 self.c.settimeout(CLIENT_TIMEOUT)
-                # Gets expected size for all sensor sample messages
-                expected_sizes: tuple[int, ...] = tuple(
-                    snp.SensorSamples.get_expected_size(param.samples_per_message)
-                    for param in sensor_params_list
-                )
 
                 # Sends params for sensors
-                self.c.send(snp.SetSensorParams(
-                    sensor_params_list).to_bytes())
+                self.c.send(self.set_sensor_params(sensor_params_list))
 
                 log.info(f'{self} - receiving samples')
-                last_sensor_params_update = time.time()
                 while self._run:
                     try:
-                        self.recv_buffer += self.c.recv(RECV_SIZE)
+                        if not self.recv():
+                            return
                     except TimeoutError:
                         pass
                     except ConnectionResetError:
                         log.warning(f'{self} - not alive')
                         return
 
-                    sensor_samples_list, self.recv_buffer = snp.SensorSamples.list_from_bytes_with_remainder(self.recv_buffer, expected_sizes)
-                    # print(sensor_samples_list)
-
-                    if sensor_samples_list:
-                        # Checks if ESP32 time overflowed
-                        current_timestamp = sensor_samples_list[0].samples[0].timestamp
-                        if not ready_to_time_overflow and current_timestamp >= UINT32_MAX//2:
-                            ready_to_time_overflow = True
-                        elif ready_to_time_overflow and current_timestamp < (UINT32_MAX//2)-1000: # 1000 -> safety offset 
-                            ready_to_time_overflow = False
-                            time_overflow_offset += UINT32_MAX
-                            log.info(f'{self} - time overflow')
-
-                        if DEBUG and any(isnan(sample.value) for sensor_samples in sensor_samples_list for sample in sensor_samples.samples): # type: ignore
-                            log.debug(f'{self} - NaN value detected')
-
-                        # Creates sample points for each running project
-                        for project_name, measurement_id in ccq.get_running_project_measurements(self.id):
-                            points = [
-                                influxdb.create_point(
-                                    measurement_id,
-                                    self.name,
-                                    sensor_params_list[sensor_samples.sensor_id].name,
-                                    sample.timestamp_to_unix(self.unix_time_offset)+time_overflow_offset,
-                                    sample.value,
-                                    write_precision='ms'
-                                )
-                                for sensor_samples in sensor_samples_list
-                                for sample in sensor_samples.samples
-                            ]
-                            influxdb.write(project_name, points)
-                            if DEBUG:
-                                freq.__add__(len(points))
-
-                    # Checks if params updated
-                    if time.time() - last_sensor_params_update >= SENSOR_PARAMS_UPDATE_PERIOD:
-                        if ccq.get_params_for_sensors(self.id) != sensor_params_list:
-                            log.info(f'{self} - params changed - restarting {self.__class__.__name__}')
-                            self.stop()
-                        else:
-                            last_sensor_params_update = time.time()
+                    self.handle_received()
+
+                    if not self.waiting_for_reconfigure_ack() and (sensor_params_list := self.load_changed_params()) is not None:
+                        self.reconfigure(sensor_params_list)
         finally:
             self._remove_client()
 
+    async def serve_async(self):
+        try:
+            await asyncio.to_thread(self.register)
+
+            sensor_params_list: list[ccq.NamedSensorParams]
+            while not (sensor_params_list := await asyncio.to_thread(self.load_sensor_params)):
+                # Until the sensor node is initialized in the Control Center, checking the version does not query the database
+                while ccq.sensor_node_configs.get_version(self.id) == self.config_version:
+                    if not self._run:
+                        return
+                    await asyncio.sleep(SENSOR_PARAMS_WAIT_PERIOD)
+
+            # Sends params for sensors
+            self.c.send(self.set_sensor_params(sensor_params_list))
+
+            log.info(f'{self} - receiving samples')
+            while self._run:
+                try:
+                    await self.c.recv_async(CLIENT_TIMEOUT) # type: ignore
+                except ConnectionResetError:
+                    log.warning(f'{self} - not alive')
+                    return
 
-class FBGuard(Client):
+                await self.handle_received_async()
+
+                if not self.waiting_for_reconfigure_ack() and self.params_changed():
+                    if (sensor_params_list := await asyncio.to_thread(self.load_changed_params)) is not None:
+                        self.reconfigure(sensor_params_list)
+        finally:
+            self.c.close()
+            await asyncio.to_thread(self._remove_client)
+
+
+class ESP32Datagrams(ESP32Base):
+    """ESP32 sensor node which sends `snp.DatagramHeader` datagrams over UDP.
+
+    There is no connection, the client is created by `UDPReceiver` for the first datagram and removed
+    when no datagram arrives for `UDP_CLIENT_TIMEOUT` seconds. Messages in datagrams carry their sample counts,
+    so the sensor params are used only for sensor names and are not sent to the sensor node.
+    """
+    def __init__(self, server: 'Server', s: socket.socket, addr: Addr, header: snp.DatagramHeader) -> None:
+        super().__init__(server, s, addr, header, RecvBuffer())
+        self.sequence_number: int | None = None # of the last accepted datagram
+        self.lost_datagrams = 0
+        self.last_receive = time.monotonic()
+        self.updating_params = False # an update of the params is queued by `UDPReceiver`
+        try:
+            self.register()
+            self.sensor_params_list = self.load_sensor_params()
+        except Exception:
+            self.server.remove_client(self)
+            raise
+
+    def update_sensor_params(self):
+        """Use new sensor names, queries them only if the config version changed"""
+        if (sensor_params_list := self.load_changed_params()) is not None:
+            self.sensor_params_list = sensor_params_list
+
+    def check_sequence_number(self, sequence_number: int) -> bool:
+        """Account lost and late datagrams, return `False` for a duplicate datagram"""
+        self.last_receive = time.monotonic()
+        if self.sequence_number is None:
+            self.sequence_number = sequence_number
+            return True
+        gap = (sequence_number - self.sequence_number) & UINT32_MAX
+        if not gap:
+            return False
+        if gap <= UINT32_MAX//2:
+            if gap > 1:
+                self.lost_datagrams += gap - 1
+                UDP_LOST_DATAGRAMS.inc(gap - 1)
+            self.sequence_number = sequence_number
+        else:
+            # Samples of late datagrams are written too, their timestamps are independent of the order
+            self.lost_datagrams -= 1
+            UDP_LATE_DATAGRAMS.inc()
+        return True
+
+    def expired(self, now: float) -> bool:
+        return not self._run or now - self.last_receive > UDP_CLIENT_TIMEOUT
+
+    def decode(self) -> Batch:
+        sensor_samples_list, size = snp.SensorSamplesArray.list_from_counted_buffer(self.decode_buffer.data)
+        return self.to_batch(sensor_samples_list, size)
+
+
+class FBGuard(StreamClient):
     TYPE = ccq.SensorNodeTypes.FBGUARD
     TIMEOUT = 60*10 # TODO
-    def __init__(self, server: 'Server', c: socket.socket, addr: tuple[str, int], fbguard_message:fbg.Message, remainder:bytes) -> None:
+    def __init__(self, server: 'Server', c: 'socket.socket | AsyncConnection', addr: tuple[str, int], fbguard_message:fbg.Message, recv_buffer:RecvBuffer) -> None:
+        """`recv_buffer` has to start with the `fbguard_message` bytes"""
         self.name = fbguard_message.header.device_id
         self.id = ccq.get_sensor_node_id_or_create(self.name, self.TYPE)
-        ccq.set_sensor_node_conn_state(self.id, True)
         self.sensor_names: set[str] = set(ccq.get_sensor_names(self.id))
-        initial_recv_buffer = fbguard_message.to_bytes() + remainder
-        super().__init__(server, c, addr, initial_recv_buffer)
+        super().__init__(server, c, addr, recv_buffer)
+        self.server.set_conn_state(self, True)
+
+    def decode(self) -> Batch:
+        messages, size, discarded = fbg.MessageArray.list_from_buffer(self.decode_buffer.data)
+        self.discard(discarded)
+        # Converts whole arrays to Python lists at once instead of converting each readout
+        batch = [
+            (
+                message.header.sensor_id,
+                (message.data.readouts['timestamp_seconds']*10**6 + message.data.readouts['timestamp_microseconds']).tolist(),
+                message.data.readouts['value'].tolist(),
+            )
+            for message in messages
+        ]
+        # Arrays are views of the receive buffer, they must not be used after consuming
+        self.decode_buffer.consume(size)
+        return batch
+
+    def write(self, batch: Batch):
+        # Checks if new names are received
+        for name, _, _ in batch:
+            if name not in self.sensor_names:
+                self.sensor_names.add(name)
+                ccq.add_sensor(self.id, name)
+
+        self.write_to_running_measurements(batch, write_precision='us')
 
     def serve(self):
         try:
-            while not ccq.is_initialized(self.id): # Probably useless
-                time.sleep(SENSOR_PARAMS_UPDATE_PERIOD)
-
-            self.c.settimeout(self.TIMEOUT)
+            self.c.settimeout(self.TIMEOUT) # type: ignore
             while self._run:
+                self.handle_received()
                 try:
-                    self.recv_buffer += self.c.recv(RECV_SIZE)
+                    if not self.recv():
+                        return
                 except TimeoutError:
                     pass
                 except ConnectionResetError:
                     log.warning(f'{self} - not alive')
                     return
-                messages, self.recv_buffer = fbg.Message.list_from_bytes_with_remainder(self.recv_buffer)
-                # Checks if new names are received
-                for name in (message.header.sensor_id for message in messages):
-                    if name not in self.sensor_names:
-                        self.sensor_names.add(name)
-                        ccq.add_sensor(self.id, name)
-
-                for project_name, measurement_id in ccq.get_running_project_measurements(self.id):
-                    
-                    points = [
-                        influxdb.create_point(
-                            measurement_id,
-                            self.name,
-                            message.header.sensor_id,
-                            readout.timestamp_seconds*10**6 + readout.timestamp_microseconds,
-                            readout.value,
-                            write_precision='us'
-                        )
-                        for message in messages
-                        for readout in message.data.readouts
-                    ]
-
-                    influxdb.write(project_name, points)
-                    if DEBUG:
-                        freq.__add__(len(points))
         finally:
             self._remove_client()
 
+    async def serve_async(self):
+        try:
+            while self._run:
+                await self.handle_received_async()
+                try:
+                    await self.c.recv_async(CLIENT_TIMEOUT) # type: ignore
+                except ConnectionResetError:
+                    log.warning(f'{self} - not alive')
+                    return
+        finally:
+            self.c.close()
+            await asyncio.to_thread(self._remove_client)
+
+
+class AsyncConnection(asyncio.BufferedProtocol):
+    """
+    `asyncio.BufferedProtocol` which receives data directly into the connection's `RecvBuffer`
+    and gives client coroutines a socket-like interface.
+    """
+    def __init__(self, server: 'Server') -> None:
+        self.server = server
+        self.transport: asyncio.Transport
+        self.addr: Addr
+        self.recv_buffer = RecvBuffer()
+        self._data_ready = asyncio.Event()
+        self._closed = False
+        self._paused = False
+
+    def connection_made(self, transport: asyncio.Transport): # type: ignore
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')[:2]
+        CONNECTIONS_ACCEPTED.inc()
+        asyncio.create_task(self.server.handle_new_connection_async(self), name=str(self.addr))
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.recv_buffer.get_free(RECV_SIZE)
+
+    def buffer_updated(self, nbytes: int):
+        self.recv_buffer.commit(nbytes)
+        BYTES_RECEIVED.inc(nbytes)
+        self._data_ready.set()
+        if not self._paused and len(self.recv_buffer) > ASYNC_RECV_HIGH_WATER:
+            self._paused = True
+            self.transport.pause_reading()
+
+    def connection_lost(self, exc: Exception | None):
+        self._closed = True
+        self._data_ready.set()
+
+    async def recv_async(self, timeout: float):
+        """
+        Wait up to `timeout` seconds for new data in `recv_buffer`.  
+        Raise `ConnectionResetError` if the connection is closed and the last received data were already returned.
+        """
+        if self._closed and not self._data_ready.is_set():
+            raise ConnectionResetError
+        if self._paused:
+            self._paused = False
+            self.transport.resume_reading()
+        if not self._data_ready.is_set():
+            try:
+                await asyncio.wait_for(self._data_ready.wait(), timeout)
+            except TimeoutError:
+                return
+        self._data_ready.clear()
+
+    def send(self, data: bytes):
+        self.transport.write(data)
+
+    def close(self):
+        self.transport.close()
+
+
+class UDPReceiver:
+    """Receiver of `snp.DatagramHeader` datagrams of ESP32 sensor nodes on a UDP port, served by one thread.
+
+    Datagrams are drained in batches (up to `UDP_BATCH_SIZE` per wakeup) without blocking. Valid payloads
+    of one sensor node in a batch are joined in its `ESP32Datagrams` client and decoded and written
+    by the same path as data received over TCP. Clients are created, updated and removed by another thread
+    (everything which queries the Control Center), so receiving is not blocked by it.
+    """
+    def __init__(self, server: 'Server', port: int) -> None:
+        self.server = server
+        self.port = port
+        self._clients: dict[str, ESP32Datagrams] = {} # sensor node name -> client
+        self._clients_lock = threading.Lock() # protects `_clients`, `_pending` and `_failed`
+        self._pending: set[str] = set() # names of sensor nodes whose clients are being created
+        self._failed: dict[str, float] = {} # sensor node name -> time until which creating its client is not retried
+        self._tasks: queue.Queue[Callable[[], None]] = queue.Queue() # run by the clients thread
+
+    def create_socket(self) -> socket.socket:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.server.registry:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Workers share the port
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECV_BUFFER_SIZE)
+        s.bind((self.server.host, self.port))
+        return s
+
+    def run(self):
+        threading.Thread(target=self._clients_loop, name='udp clients', daemon=True).start()
+        buffer = bytearray(UDP_BATCH_BUFFER_SIZE)
+        view = memoryview(buffer)
+        with self.create_socket() as s:
+            s.settimeout(UDP_SWEEP_PERIOD)
+            log.info(f'UDP receiver is listening on {self.server.host}:{self.port}')
+            next_sweep = time.monotonic() + UDP_SWEEP_PERIOD
+            while True:
+                datagrams: list[tuple[memoryview, Addr]] = []
+                offset = 0
+                try:
+                    size, addr = s.recvfrom_into(view[offset:])
+                    while True:
+                        datagrams.append((view[offset:offset + size], addr))
+                        offset += size
+                        if len(datagrams) >= UDP_BATCH_SIZE or len(buffer) - offset < UDP_MAX_DATAGRAM_SIZE:
+                            break
+                        size, addr = s.recvfrom_into(view[offset:], 0, socket.MSG_DONTWAIT)
+                except (TimeoutError, BlockingIOError):
+                    pass
+
+                if datagrams:
+                    UDP_BATCH.observe(len(datagrams))
+                    BYTES_RECEIVED.inc(offset)
+                    self.handle_datagrams(s, datagrams)
+                if time.monotonic() >= next_sweep:
+                    self.sweep()
+                    next_sweep = time.monotonic() + UDP_SWEEP_PERIOD
+
+    def handle_datagrams(self, s: socket.socket, datagrams: list[tuple[memoryview, Addr]]):
+        received: dict[str, ESP32Datagrams] = {}
+        for data, addr in datagrams:
+            header, size = snp.DatagramHeader.from_buffer(data, ESP32Datagrams.TYPE.value)
+            if not header:
+                UDP_DATAGRAMS.inc(1, 'invalid')
+                continue
+            client = self.get_client(s, addr, header)
+            if not client:
+                UDP_DATAGRAMS.inc(1, 'pending')
+                continue
+            if not client.sensor_params_list:
+                UDP_DATAGRAMS.inc(1, 'uninitialized')
+                continue
+            payload = data[size:]
+            if not snp.SensorSamples.is_valid_counted(payload, len(client.sensor_params_list)):
+                UDP_DATAGRAMS.inc(1, 'invalid')
+                client.discard(len(payload))
+                continue
+            if not client.check_sequence_number(header.sequence_number):
+                UDP_DATAGRAMS.inc(1, 'duplicate')
+                continue
+            UDP_DATAGRAMS.inc(1, 'accepted')
+            # Copies the payload, the batch buffer is reused by the next batch
+            client.recv_buffer.write(payload)
+            received[client.name] = client
+        for client in received.values():
+            client.handle_received()
+
+    def get_client(self, s: socket.socket, addr: Addr, header: snp.DatagramHeader) -> ESP32Datagrams | None:
+        """Return the client of the sensor node, `None` while it is being created or after creating it failed"""
+        client = self._clients.get(header.name)
+        if client and client.unix_time_offset != header.unix_time_offset:
+            # Sensor node restarted, sequence numbers and timestamps start again
+            client.change_state_after_disconnect = False
+            self.remove(client)
+            client = None
+        if not client:
+            self.create_client(s, addr, header)
+            return None
+        client.addr = addr
+        if not client.updating_params and client.params_changed():
+            client.updating_params = True
+            self._tasks.put(functools.partial(self._update_sensor_params, client))
+        return client
+
+    def create_client(self, s: socket.socket, addr: Addr, header: snp.DatagramHeader):
+        """Queue creating the client, unless it is already queued or failed recently"""
+        with self._clients_lock:
+            if (
+                header.name in self._pending
+                or self._failed.get(header.name, 0) > time.monotonic()
+                or len(self._pending) >= UDP_MAX_PENDING_CLIENTS
+            ):
+                return
+            self._pending.add(header.name)
+        self._tasks.put(functools.partial(self._create_client, s, addr, header))
+
+    def remove(self, client: ESP32Datagrams):
+        """Stop receiving datagrams of the client, it is removed from the server by the clients thread"""
+        with self._clients_lock:
+            if self._clients.get(client.name) is client:
+                del self._clients[client.name]
+        client.stop()
+        self._tasks.put(functools.partial(self._remove_client, client))
+
+    def sweep(self):
+        """Remove clients which are stopped (e.g. connected over TCP) or did not send a datagram for `UDP_CLIENT_TIMEOUT` seconds"""
+        now = time.monotonic()
+        with self._clients_lock:
+            expired = [client for client in self._clients.values() if client.expired(now)]
+            self._failed = {name: retry_time for name, retry_time in self._failed.items() if retry_time > now}
+        for client in expired:
+            self.remove(client)
+
+    def _clients_loop(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                task()
+            except Exception:
+                log.exception('UDP receiver - failed to update clients')
+
+    def _create_client(self, s: socket.socket, addr: Addr, header: snp.DatagramHeader):
+        try:
+            client = ESP32Datagrams(self.server, s, addr, header)
+        except Exception:
+            log.exception(f'({addr[0]}:{addr[1]}) - failed to create a client for {header.name}')
+            with self._clients_lock:
+                self._pending.discard(header.name)
+                self._failed[header.name] = time.monotonic() + UDP_CLIENT_RETRY_DELAY
+            return
+        with self._clients_lock:
+            self._clients[header.name] = client
+            self._pending.discard(header.name)
+
+    @staticmethod
+    def _update_sensor_params(client: ESP32Datagrams):
+        try:
+            client.update_sensor_params()
+        finally:
+            client.updating_params = False
+
+    @staticmethod
+    def _remove_client(client: ESP32Datagrams):
+        log.info(f'{client} - lost datagrams: {client.lost_datagrams}')
+        client._remove_client()
+
 
 class Server:
-    def __init__(self, host: str, port: int) -> None:
+    def __init__(self, host: str, port: int, registry: ClientRegistry | None = None, worker: int = 0) -> None:
+        """`registry` is shared by worker processes, `worker` is the index of this worker"""
         self.host = host
         self.port = port
+        self.registry = registry
+        self.worker = worker
         self._clients: list[Client] = []
         self._clients_lock = threading.Lock()
+        self._connection_numbers = itertools.count()
+        metrics.Gauge('receiver_connections', 'Connected sensor nodes', self.connection_counts, ('type',))
+        metrics.Gauge('receiver_client_backlog_bytes', 'Received bytes not decoded yet', self.client_backlogs, ('sensor_node',))
 
     def stop_client_if_exists(self, client_name:str, ignore:Client|None):
         """Stop client with the same name if exist"""
@@ -304,6 +840,10 @@ class Server:
                     log.warning(f'{client} - client with this name is already connected')
                     client.change_state_after_disconnect = False
                     client.stop()
+        if self.registry and ignore:
+            # Clients with the same name in other workers are stopped by `_eviction_loop` of their worker
+            ignore.registry_token = (self.worker, next(self._connection_numbers))
+            self.registry.register(client_name, ignore.registry_token)
 
     def add_client(self, client: Client):
         with self._clients_lock:
@@ -312,54 +852,251 @@ class Server:
     def remove_client(self, client: Client):
         with self._clients_lock:
             self._clients.remove(client)
+        if self.registry and client.registry_token:
+            self.registry.unregister(client.name, client.registry_token)
+
+    def set_conn_state(self, client: Client, state: bool):
+        """Set connection state of the sensor node, the supervisor sets it from the registry if there are more workers"""
+        if not self.registry:
+            ccq.set_sensor_node_conn_state(client.id, state)
+        elif state and client.registry_token:
+            self.registry.set_sensor_node_id(client.name, client.registry_token, client.id)
+
+    def _eviction_loop(self):
+        assert self.registry
+        for token in self.registry.evictions(self.worker):
+            with self._clients_lock:
+                for client in self._clients:
+                    if client.registry_token == token:
+                        log.warning(f'{client} - client with this name connected to another worker')
+                        client.change_state_after_disconnect = False
+                        client.stop()
+
+    def connection_counts(self) -> dict[tuple[str, ...], float]:
+        counts = {(client_class.__name__,): 0.0 for client_class in (ESP32, ESP32Datagrams, FBGuard)}
+        with self._clients_lock:
+            for client in self._clients:
+                counts[(client.__class__.__name__,)] += 1
+        return counts
+
+    def client_backlogs(self) -> dict[tuple[str, ...], float]:
+        with self._clients_lock:
+            return {
+                (client.name,): len(client.recv_buffer) + (len(client.decode_buffer) if client.decode_buffer is not client.recv_buffer else 0)
+                for client in self._clients
+            }
+
+    @staticmethod
+    def identify(recv_buffer: RecvBuffer) -> snp.Info | fbg.Message | bool:
+        """
+        Parse the first message of a new connection.  
+        Return `snp.Info` (consumed from the buffer) or `fbg.Message` (kept in the buffer),
+        `False` if more data are needed and `True` if the data are unknown.
+        """
+        if recv_buffer.data[0] == ESP32.TYPE.value:
+            message, remainder = snp.Info.from_bytes_with_remainder(bytes(recv_buffer.data))
+            log.debug(message)
+            if message:
+                recv_buffer.consume(len(recv_buffer) - len(remainder))
+                return message
+
+        elif recv_buffer.data[:3] == fbg.Header.EXPECTED_SYNC:
+            if len(recv_buffer) >= fbg.Header.SIZE and not fbg.Header.is_valid(recv_buffer.data[:fbg.Header.SIZE]):
+                log.warning(f'Invalid FBGuard header\nReceived data:\n{bytes(recv_buffer.data[:fbg.Header.SIZE])}')
+                return True
+            message, _ = fbg.Message.from_bytes_with_remainder(bytes(recv_buffer.data))
+            if message:
+                return message
+
+        else:
+            log.warning(f'Unknown\nReceived data:\n{bytes(recv_buffer.data)}')
+            return True
+        return False
 
     def handle_new_connection(self, c:socket.socket, addr:Addr):
         with c:
             log.info(f'New connection from ({addr[0]}:{addr[1]})')
-            recv_buffer = bytes()
+            recv_buffer = RecvBuffer()
             for _ in range(MAX_FIRST_MESSAGE_FRAGMENTATION):
-                recv_buffer += c.recv(RECV_SIZE)
-
-                if recv_buffer[0] == ESP32.TYPE.value:
-                    message, recv_buffer = snp.Info.from_bytes_with_remainder(recv_buffer)
-                    log.debug(message)
-                    if message:
-                        ESP32(self, c, addr, message).serve()
-                        return
+                if not (size := recv_buffer.recv_into(c, RECV_SIZE)):
+                    break
+                BYTES_RECEIVED.inc(size)
+                message = self.identify(recv_buffer)
 
-                elif recv_buffer[:3] == fbg.Header.EXPECTED_SYNC:
-                    message, recv_buffer = fbg.Message.from_bytes_with_remainder(recv_buffer)
-                    if message:
-                        FBGuard(self, c, addr, message, recv_buffer).serve()
-                        return
+                if isinstance(message, snp.Info):
+                    ESP32(self, c, addr, message, recv_buffer).serve()
+                    return
 
-                else:
-                    log.warning(f'Unknown\nReceived data:\n{recv_buffer}')
-                    c.close()
-                    log.info(f'({addr[0]}:{addr[1]}) - disconnected')
+                elif isinstance(message, fbg.Message):
+                    FBGuard(self, c, addr, message, recv_buffer).serve()
                     return
 
+                elif message:
+                    break
+
+            c.close()
+            log.info(f'({addr[0]}:{addr[1]}) - disconnected')
+
+    async def handle_new_connection_async(self, conn: AsyncConnection):
+        addr = conn.addr
+        log.info(f'New connection from ({addr[0]}:{addr[1]})')
+        client: StreamClient | None = None
+        try:
+            for _ in range(MAX_FIRST_MESSAGE_FRAGMENTATION):
+                await conn.recv_async(CLIENT_TIMEOUT)
+                if not len(conn.recv_buffer):
+                    continue
+                message = self.identify(conn.recv_buffer)
+
+                # Clients are created in a thread, registering them in the registry of workers blocks
+                if isinstance(message, snp.Info):
+                    client = await asyncio.to_thread(ESP32, self, conn, addr, message, conn.recv_buffer)
+                    break
+
+                elif isinstance(message, fbg.Message):
+                    client = await asyncio.to_thread(FBGuard, self, conn, addr, message, conn.recv_buffer)
+                    break
+
+                elif message:
+                    break
+        except ConnectionResetError:
+            pass
+
+        if client:
+            await client.serve_async()
+        else:
+            conn.close()
+            log.info(f'({addr[0]}:{addr[1]}) - disconnected')
+
+    def create_socket(self, backlog: int) -> socket.socket:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.registry:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Workers share the port
+        s.bind((self.host, self.port))
+        s.listen(backlog)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) # Enable keep-alive
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KeepAlive.INTERVAL)   # keep-alive Interval
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KeepAlive.INTERVAL_BETWEEN_ATTEMPTS)   # Interval between attempts
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KeepAlive.MAX_FAILED_ATTEMPTS) # Max failed attempts
+        return s
+
+    def start_services(self):
+        """Start background threads of the server, blocks while the Control Center and the spool are loaded"""
+        # Connection states of all workers are reset by the supervisor
+        if not self.registry:
+            ccq.set_all_sensor_nodes_conn_state(False)
+            ccq.connection_states.start()
+        else:
+            threading.Thread(target=self._eviction_loop, name='evictions', daemon=True).start()
+        ccq.running_measurements.start()
+        ccq.sensor_node_configs.start()
+        if spool:
+            spool.start()
+        if pipeline:
+            pipeline.start()
+        if METRICS_PORT:
+            metrics.serve(self.host, METRICS_PORT + self.worker)
+        if UDP_PORT:
+            threading.Thread(target=UDPReceiver(self, UDP_PORT).run, name='udp receiver', daemon=True).start()
+
     def run(self):
-        ccq.set_all_sensor_nodes_conn_state(False)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind((self.host, self.port))
+        self.start_services()
+        with self.create_socket(LISTEN_BACKLOG) as s:
             s.settimeout(60*5)
-            s.listen(20) # max number of pending requests
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) # Enable keep-alive
-            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KeepAlive.INTERVAL)   # keep-alive Interval
-            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KeepAlive.INTERVAL_BETWEEN_ATTEMPTS)   # Interval between attempts
-            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KeepAlive.MAX_FAILED_ATTEMPTS) # Max failed attempts
             log.info(f"Server is listening on {self.host}:{self.port}")
             while True:
                 try:
                     c, addr = s.accept()
+                    CONNECTIONS_ACCEPTED.inc()
                     threading.Thread(target=self.handle_new_connection, args=(c, addr), name=str(addr)).start()
                 except TimeoutError:
                     continue
 
-        ccq.set_all_sensor_nodes_conn_state(False)
+    async def run_async(self):
+        await asyncio.to_thread(self.start_services)
+        raise_open_files_limit()
+        loop = asyncio.get_running_loop()
+        s = self.create_socket(ASYNC_LISTEN_BACKLOG)
+        s.setblocking(False)
+        async with await loop.create_server(lambda: AsyncConnection(self), sock=s, backlog=ASYNC_LISTEN_BACKLOG) as server:
+            log.info(f"Server (asyncio) is listening on {self.host}:{self.port}")
+            await server.serve_forever()
+
+
+def raise_open_files_limit():
+    """Raise the soft limit of open file descriptors to the hard limit (one socket per client)"""
+    try:
+        import resource
+    except ImportError: # not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_server(server: Server):
+    if ENGINE == 'asyncio':
+        run_async(server)
+    else:
+        server.run()
+
+
+def run_async(server: Server):
+    """Run `Server.run_async`, use uvloop if it is installed"""
+    try:
+        import uvloop # type: ignore
+    except ImportError:
+        asyncio.run(server.run_async())
+    else:
+        uvloop.run(server.run_async())
+
+
+def run_worker(registry: ClientRegistry, worker: int):
+    """Entry point of a worker process"""
+    influxdb.reconnect()
+    if spool:
+        spool.path = SPOOL_PATH/str(worker)
+    run_server(Server(HOST, PORT, registry, worker))
+
+
+def run_workers(workers: int):
+    """Start worker processes and keep connection states of sensor nodes in the Control Center up to date"""
+    # Segments of workers which are not started anymore (or of a single process server) are replayed by worker 0
+    merge_segments([SPOOL_PATH, *(path for path in SPOOL_PATH.glob('*') if path.is_dir() and not (path.name.isdigit() and int(path.name) < workers))], SPOOL_PATH/'0')
+    ccq.set_all_sensor_nodes_conn_state(False)
+    ccq.close_db_connections() # Database connections must not be shared with the forked workers
+
+    context = multiprocessing.get_context('fork') # Workers inherit the initialized module state
+    registry = ClientRegistry(context.Manager(), workers)
+    processes = [context.Process(target=run_worker, args=(registry, worker), name=f'worker {worker}', daemon=True) for worker in range(workers)]
+    for process in processes:
+        process.start()
+    log.info(f'Started {workers} receiver workers')
+
+    ccq.connection_states.start()
+    connected: set[int] = set()
+    while all(process.is_alive() for process in processes):
+        time.sleep(ccq.CONNECTION_STATES_FLUSH_PERIOD)
+        try:
+            current = registry.connected_sensor_node_ids()
+        except Exception:
+            log.exception('Failed to read the client registry')
+            continue
+        for sensor_node_id in current - connected:
+            ccq.connection_states.set(sensor_node_id, True)
+        for sensor_node_id in connected - current:
+            ccq.connection_states.set(sensor_node_id, False)
+        connected = current
+    log.error('A receiver worker exited, stopping')
+    exit(1)
+
 
 if __name__ == '__main__':
     signal.signal(signal.SIGTERM, handle_stop_signal)
     signal.signal(signal.SIGINT, handle_stop_signal)
-    Server(HOST, PORT).run()
+    if WORKERS > 1:
+        run_workers(WORKERS)
+    else:
+        if spool:
+            merge_segments([path for path in SPOOL_PATH.glob('*') if path.is_dir()], SPOOL_PATH)
+        run_server(Server(HOST, PORT))
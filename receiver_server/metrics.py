@@ -0,0 +1,211 @@
+"""
+This module provides an in-process metrics registry and an HTTP endpoint serving it in the Prometheus text format.
+
+Counters and histograms are updated by many receiving and worker threads, so each thread updates
+its own shard without locking and the shards are summed only when the metrics are collected.
+"""
+
+import bisect
+import logging
+import threading
+import time
+import weakref
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Iterator, TypeAlias
+
+log = logging.getLogger(__name__)
+
+Labels: TypeAlias = tuple[str, ...]
+Sample: TypeAlias = tuple[str, Labels, float] # (name suffix, label values, value)
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+
+class Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: Labels = (), registry: 'Registry | None' = None) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        (registry or REGISTRY).register(self)
+
+    def collect(self) -> Iterable[Sample]:
+        raise NotImplementedError
+
+
+class Sharded(Metric):
+    """Metric with per-thread shards of values, shards of finished threads are merged when collecting"""
+    def __init__(self, name: str, help: str, labelnames: Labels = (), registry: 'Registry | None' = None) -> None:
+        super().__init__(name, help, labelnames, registry)
+        self._local = threading.local()
+        self._shards: list[tuple[weakref.ref[threading.Thread], dict]] = []
+        self._retired: dict = self._new_shard()
+        self._shards_lock = threading.Lock() # only used for a new thread and for collecting
+
+    def _new_shard(self) -> dict:
+        raise NotImplementedError
+
+    def _merge(self, target: dict, shard: dict):
+        raise NotImplementedError
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._new_shard()
+            with self._shards_lock:
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+            return shard
+
+    def _merged(self) -> dict:
+        with self._shards_lock:
+            alive = []
+            for thread, shard in self._shards:
+                thread_alive = thread() is not None and thread().is_alive() # type: ignore
+                if thread_alive:
+                    alive.append((thread, shard))
+                else:
+                    self._merge(self._retired, shard.copy())
+            self._shards = alive
+            merged = self._new_shard()
+            self._merge(merged, self._retired)
+            for _, shard in alive:
+                self._merge(merged, shard.copy()) # `dict.copy` is atomic, the owner thread may be updating it
+            return merged
+
+
+class Counter(Sharded):
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, *labelvalues: str):
+        self._shard()[labelvalues] += amount
+
+    def _new_shard(self) -> dict[Labels, float]:
+        return defaultdict(float)
+
+    def _merge(self, target: dict[Labels, float], shard: dict[Labels, float]):
+        for labelvalues, value in shard.items():
+            target[labelvalues] += value
+
+    def collect(self) -> Iterable[Sample]:
+        return (('', labelvalues, value) for labelvalues, value in self._merged().items())
+
+
+class Histogram(Sharded):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Labels = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS, registry: 'Registry | None' = None) -> None:
+        self.buckets = buckets
+        super().__init__(name, help, labelnames, registry)
+
+    def observe(self, value: float, *labelvalues: str):
+        # [count per bucket..., count above the last bucket, sum]
+        counts = self._shard()[labelvalues]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def _new_shard(self) -> dict[Labels, list[float]]:
+        return defaultdict(lambda: [0.0]*(len(self.buckets) + 2))
+
+    def _merge(self, target: dict[Labels, list[float]], shard: dict[Labels, list[float]]):
+        for labelvalues, counts in shard.items():
+            target_counts = target[labelvalues]
+            for i, count in enumerate(counts):
+                target_counts[i] += count
+
+    def collect(self) -> Iterable[Sample]:
+        for labelvalues, counts in self._merged().items():
+            cumulative = 0.0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield '_bucket', (*labelvalues, str(bound)), cumulative
+            yield '_count', labelvalues, cumulative
+            yield '_sum', labelvalues, counts[-1]
+
+
+class Gauge(Metric):
+    """Gauge whose values are read by `func` when collecting, e.g. queue depths and connection counts"""
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, help: str, func: Callable[[], dict[Labels, float] | float], labelnames: Labels = (), registry: 'Registry | None' = None) -> None:
+        super().__init__(name, help, labelnames, registry)
+        self.func = func
+
+    def collect(self) -> Iterable[Sample]:
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return (('', labelvalues, value) for labelvalues, value in values.items())
+
+
+class CallbackCounter(Gauge):
+    """Counter whose values are read by `func` when collecting, e.g. counters kept by other modules"""
+    TYPE = 'counter'
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[Metric] = []
+
+    def register(self, metric: Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            labelnames = metric.labelnames + (('le',) if isinstance(metric, Histogram) else ())
+            try:
+                for suffix, labelvalues, value in metric.collect():
+                    labels = ','.join(
+                        f'{name}="{_escape_label(value)}"'
+                        for name, value in zip(labelnames, labelvalues)
+                    )
+                    lines.append(f'{metric.name}{suffix}{{{labels}}} {value}' if labels else f'{metric.name}{suffix} {value}')
+            except Exception:
+                log.exception(f'Failed to collect {metric.name}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+REGISTRY = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str, port: int):
+    """Serve `/metrics` in a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log.info(f'Metrics are served on http://{host}:{port}/metrics')
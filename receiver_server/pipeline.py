@@ -0,0 +1,158 @@
+"""
+This module provides a staged ingest pipeline which decouples receiving from decoding and writing.
+
+Socket readers only copy received data to a bounded decode queue. Decode workers decode the data
+and encode them into line protocol, the writer joins the encoded payloads by bucket and writes them
+to InfluxDB (or to the spool). Each stage has a bounded queue with queue depth and drop counters.
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Generic, Protocol, TypeVar
+
+from api_clients import influxdb
+import metrics
+
+log = logging.getLogger(__name__)
+
+DECODE_WORKERS = 4
+QUEUE_SIZE = 10_000 # items per stage queue
+WRITE_BATCH_SIZE = 1024*1024 # max bytes written at once per bucket
+WRITE_FLUSH_PERIOD = 0.1 # max time (s) an encoded payload waits for other payloads to the same bucket
+STATS_PERIOD = 10
+
+Write = Callable[[str, bytes, influxdb.TimePrecision], None] # (bucket name, line protocol, precision)
+T = TypeVar('T')
+
+WRITE_DURATION = metrics.Histogram('receiver_pipeline_write_seconds', 'Duration of writes of joined payloads by the pipeline writer')
+
+
+class Decodable(Protocol):
+    id: int
+
+    def process(self, data: bytes):
+        """Decode received data and write the decoded samples"""
+        ...
+
+
+class Stage(Generic[T]):
+    """Bounded queue served by one thread"""
+    def __init__(self, name: str, handle: Callable[[T], None], maxsize: int = QUEUE_SIZE) -> None:
+        self.name = name
+        self.handle = handle
+        self.queue: queue.Queue[T] = queue.Queue(maxsize)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def start(self):
+        threading.Thread(target=self._loop, name=self.name, daemon=True).start()
+
+    def put(self, item: T, timeout: float = 0) -> bool:
+        """Queue the item, wait up to `timeout` seconds if the queue is full, return `False` if it was dropped"""
+        try:
+            if timeout:
+                self.queue.put(item, timeout=timeout)
+            else:
+                self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+            return False
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.handle(item)
+            except Exception:
+                log.exception(f'{self.name} - failed to process an item')
+
+
+class Writer(Stage[tuple[str, bytes, influxdb.TimePrecision]]):
+    """Stage which joins encoded payloads for the same bucket and precision before writing them"""
+    def __init__(self, write: Write, maxsize: int = QUEUE_SIZE) -> None:
+        super().__init__('writer', self._add, maxsize)
+        self.write = write
+        self._pending: dict[tuple[str, influxdb.TimePrecision], list[bytes]] = {}
+        self._pending_size = 0
+        self._flush_time = 0.0
+
+    def _add(self, item: tuple[str, bytes, influxdb.TimePrecision]):
+        bucket_name, payload, precision = item
+        if not self._pending:
+            self._flush_time = time.monotonic() + WRITE_FLUSH_PERIOD
+        self._pending.setdefault((bucket_name, precision), []).append(payload)
+        self._pending_size += len(payload)
+        if self._pending_size >= WRITE_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        for (bucket_name, precision), payloads in self._pending.items():
+            try:
+                with WRITE_DURATION.time():
+                    self.write(bucket_name, b'\n'.join(payloads), precision)
+            except Exception:
+                log.exception(f'{self.name} - failed to write to {bucket_name}')
+        self._pending.clear()
+        self._pending_size = 0
+
+    def _loop(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=max(self._flush_time - time.monotonic(), 0) if self._pending else None)
+            except queue.Empty:
+                self._flush()
+                continue
+            self._add(item)
+            if self._pending and time.monotonic() >= self._flush_time:
+                self._flush()
+
+
+class Pipeline:
+    """Decode stage sharded by sensor node ID (keeps the order of each node's data) and one writer stage"""
+    def __init__(self, write: Write, decode_workers: int = DECODE_WORKERS, queue_size: int = QUEUE_SIZE) -> None:
+        self.decode_stages = [
+            Stage[tuple[Decodable, bytes]](f'decode {i}', self._decode, queue_size)
+            for i in range(decode_workers)
+        ]
+        self.writer = Writer(write, queue_size)
+
+    def start(self):
+        for stage in self.decode_stages:
+            stage.start()
+        self.writer.start()
+        threading.Thread(target=self._stats_loop, name='pipeline stats', daemon=True).start()
+
+    def submit(self, client: Decodable, data: bytes, timeout: float = 0) -> bool:
+        """Queue received data for decoding, return `False` if the decode queue is full"""
+        return self.decode_stages[client.id % len(self.decode_stages)].put((client, data), timeout)
+
+    def write(self, bucket_name: str, payload: bytes, write_precision: influxdb.TimePrecision):
+        """Queue an encoded payload for writing, waits while the write queue is full"""
+        if not self.writer.put((bucket_name, payload, write_precision), timeout=1):
+            log.warning(f'Write queue is full - dropped {len(payload)} B for {bucket_name}')
+
+    def stats(self) -> str:
+        decode_depth = sum(stage.depth for stage in self.decode_stages)
+        decode_dropped = sum(stage.dropped for stage in self.decode_stages)
+        return (
+            f'decode queue: {decode_depth} (dropped {decode_dropped}), '
+            f'write queue: {self.writer.depth} (dropped {self.writer.dropped})'
+        )
+
+    @staticmethod
+    def _decode(item: tuple[Decodable, bytes]):
+        client, data = item
+        client.process(data)
+
+    def _stats_loop(self):
+        while True:
+            time.sleep(STATS_PERIOD)
+            log.debug(f'Pipeline - {self.stats()}')
@@ -0,0 +1,85 @@
+"""
+This module provides a receive buffer which is allocated once per connection and avoids copying received data.
+"""
+
+import socket
+
+DEFAULT_SIZE = 32*1024 # fits the largest FBGuard message (24 660 B) with a free space for the next receive
+
+
+class RecvBuffer:
+    """Reusable receive buffer.
+
+    Data are received directly into the free space at the end of the buffer (`recv_into`) and parsed
+    through `memoryview` slices (`data`, `consume`). Unparsed data are moved to the start of the buffer
+    only when the free space runs out, so parsing does not copy the remainder after every receive.
+
+    Views returned by `data` are valid only until the next receive into the buffer.
+    """
+    def __init__(self, size:int = DEFAULT_SIZE, initial_data:bytes = bytes()) -> None:
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0 # index of the first unparsed byte
+        self._end = 0 # index after the last received byte
+        self.copy_count = 0 # number of moves of unparsed data to the start of the buffer
+        self.copied_bytes = 0
+        self.grow_count = 0 # number of reallocations when a message does not fit into the buffer
+        self.write(initial_data)
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    @property
+    def capacity(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def data(self) -> memoryview:
+        """Unparsed data"""
+        return self._view[self._start:self._end]
+
+    def consume(self, size:int):
+        """Mark `size` bytes from the start of `data` as parsed"""
+        self._start += size
+        if self._start >= self._end:
+            # Buffer is empty, so the next receive can start at the beginning without copying
+            self._start = self._end = 0
+
+    def get_free(self, min_size:int = 1) -> memoryview:
+        """Return free space of at least `min_size` bytes at the end of the buffer, fill it and call `commit`"""
+        if self.capacity - self._end < min_size:
+            self._make_space(min_size)
+        return self._view[self._end:]
+
+    def commit(self, size:int):
+        """Mark `size` bytes written into the space returned by `get_free` as received"""
+        self._end += size
+
+    def recv_into(self, s:socket.socket, min_size:int = 1) -> int:
+        """Receive data from the socket into the buffer, return the number of received bytes (0 if the connection is closed)"""
+        size = s.recv_into(self.get_free(min_size))
+        self.commit(size)
+        return size
+
+    def write(self, data:bytes):
+        if data:
+            self.get_free(len(data))[:len(data)] = data
+            self.commit(len(data))
+
+    def stats(self) -> str:
+        return f'copies: {self.copy_count} ({self.copied_bytes} B), reallocations: {self.grow_count}'
+
+    def _make_space(self, min_size:int):
+        size = len(self)
+        if size + min_size > self.capacity:
+            buffer = bytearray(max(self.capacity*2, size + min_size))
+            buffer[:size] = self.data
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+            self.grow_count += 1
+        else:
+            self._view[:size] = self.data
+        self.copy_count += 1
+        self.copied_bytes += size
+        self._start = 0
+        self._end = size
@@ -0,0 +1,52 @@
+"""
+This module provides a registry of connected clients shared by receiver worker processes.
+
+With `RECEIVER_WORKERS` > 1 each worker process accepts connections on the same port (`SO_REUSEPORT`),
+so a reconnecting sensor node can be accepted by a different worker than its previous connection.
+The registry maps sensor node names to their current connection, the worker serving an older connection
+of the same name is notified through its eviction queue and stops it. The supervisor process reads
+the registry to update connection states of sensor nodes in the Control Center.
+"""
+
+from multiprocessing.managers import SyncManager
+from typing import Iterator, TypeAlias
+
+Token: TypeAlias = tuple[int, int] # (worker index, connection number in the worker)
+
+
+class ClientRegistry:
+    """Connected clients of all workers, stored in a `multiprocessing` manager process"""
+    def __init__(self, manager: SyncManager, workers: int) -> None:
+        self._clients = manager.dict() # name -> (token, sensor node ID or None before it is known)
+        self._lock = manager.Lock()
+        self._evictions = [manager.Queue() for _ in range(workers)]
+
+    def register(self, name: str, token: Token):
+        """Register a new connection, an older connection of the same name in another worker is evicted"""
+        with self._lock:
+            old = self._clients.get(name)
+            self._clients[name] = (token, None)
+        # Duplicates in the same worker are stopped by the worker itself
+        if old and old[0][0] != token[0]:
+            self._evictions[old[0][0]].put(old[0])
+
+    def set_sensor_node_id(self, name: str, token: Token, sensor_node_id: int):
+        """Mark the connection as a connected sensor node, unless it was replaced meanwhile"""
+        with self._lock:
+            current = self._clients.get(name)
+            if current and current[0] == token:
+                self._clients[name] = (token, sensor_node_id)
+
+    def unregister(self, name: str, token: Token):
+        with self._lock:
+            current = self._clients.get(name)
+            if current and current[0] == token:
+                del self._clients[name]
+
+    def evictions(self, worker: int) -> Iterator[Token]:
+        """Yield tokens of connections of the worker which have to be stopped"""
+        while True:
+            yield self._evictions[worker].get()
+
+    def connected_sensor_node_ids(self) -> set[int]:
+        return {sensor_node_id for _, sensor_node_id in self._clients.values() if sensor_node_id is not None}
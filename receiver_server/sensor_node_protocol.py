@@ -6,8 +6,11 @@ import struct
 from datetime import datetime
 from typing import Self, Iterable, ClassVar, Sequence
 from dataclasses import dataclass
+import numpy as np
 
 ASCII_ETX = 0x03
+RECONFIGURE = 0x01 # type of the `Reconfigure` message
+RECONFIGURE_ACK = 0xFF # sent by the sensor node in place of a sensor ID, so it is not a valid sensor ID
 
 ENC = 'ascii'
 MAX_SAMPLES_PER_MESSAGE = 89
@@ -35,12 +38,24 @@ class SetSensorParams:
         )  # little endian 4B 1B
 
 
+@dataclass
+class Reconfigure(SetSensorParams):
+    """`SetSensorParams` sent on a live connection.
+
+    The sensor node applies the params between two messages with samples and answers with the `RECONFIGURE_ACK`
+    byte, messages before it have sizes by the old params and messages after it by the new params.
+    """
+    def to_bytes(self) -> bytes:
+        return bytes([RECONFIGURE]) + super().to_bytes()
+
+
 @dataclass
 class Sample:
     timestamp: int
     value: float
 
     SIZE: ClassVar = 12
+    DTYPE: ClassVar = np.dtype([('timestamp', '<u4'), ('value', '<f8')]) # packed, same layout as SIZE bytes
 
     @classmethod
     def from_bytes(cls, sample_bytes: bytes):
@@ -72,19 +87,72 @@ class SensorSamples:
         
         expected_sizes (Sequence[int]): A sequence of expected message sizes for each sensor node's sensor, sorted by sensor IDs.
         """
-        cls_list: list[Self] = []
         bytes_view = memoryview(_bytes)
-        # Checks if can get expected message size for sensor, then checks if bytes has at least expected size
-        while len(bytes_view) > 0 and (expected_size := expected_sizes[bytes_view[0]]) <= len(bytes_view): # (bytes_view[0] -> sensor_id)
-            cls_list.append(cls.from_bytes(bytes_view[:expected_size]))
-            bytes_view = bytes_view[expected_size:]
-        return cls_list, bytes(bytes_view)
+        cls_list, size, _ = cls.list_from_buffer(bytes_view, expected_sizes)
+        return cls_list, bytes(bytes_view[size:])
+
+    @classmethod
+    def list_from_buffer(cls, bytes_view: memoryview, expected_sizes: Sequence[int]) -> tuple[list[Self], int, int]:
+        """Return the list of SensorSamples, the number of parsed bytes and the number of discarded bytes, without copying the remainder
+
+        Parsing stops before `RECONFIGURE_ACK`, the following messages have other expected sizes.
+        Bytes which are not a sensor ID (e.g. after a transmission error) are discarded.
+        """
+        cls_list: list[Self] = []
+        index = 0
+        discarded = 0
+        while index < len(bytes_view) and (sensor_id := bytes_view[index]) != RECONFIGURE_ACK:
+            if sensor_id >= len(expected_sizes):
+                discarded += 1
+                index += 1
+                continue
+            # Checks if bytes has at least expected size
+            if (expected_size := expected_sizes[sensor_id]) > len(bytes_view) - index:
+                break
+            cls_list.append(cls.from_bytes(bytes_view[index:index+expected_size]))
+            index += expected_size
+        return cls_list, index, discarded
+
+    @classmethod
+    def list_from_counted_buffer(cls, bytes_view: memoryview) -> tuple[list[Self], int]:
+        """Return the list of SensorSamples and the number of parsed bytes from messages prefixed by their sample count
+        (`Datagram` payloads), the messages have to be checked by `is_valid_counted` first"""
+        cls_list: list[Self] = []
+        index = 0
+        while index < len(bytes_view) and (expected_size := cls.get_expected_size(bytes_view[index])) < len(bytes_view) - index:
+            cls_list.append(cls.from_bytes(bytes_view[index+1:index+1+expected_size]))
+            index += 1 + expected_size
+        return cls_list, index
+
+    @classmethod
+    def is_valid_counted(cls, bytes_view: memoryview, sensor_count: int) -> bool:
+        """Check that `bytes_view` consists of complete messages prefixed by their sample count with valid sensor IDs"""
+        index = 0
+        while index < len(bytes_view):
+            sample_count = bytes_view[index]
+            if not 0 < sample_count <= MAX_SAMPLES_PER_MESSAGE or index + 1 >= len(bytes_view) or bytes_view[index + 1] >= sensor_count:
+                return False
+            index += 1 + cls.get_expected_size(sample_count)
+        return index == len(bytes_view)
 
     @staticmethod
     def get_expected_size(sample_count: int) -> int:
         return 1 + sample_count*Sample.SIZE
 
 
+@dataclass
+class SensorSamplesArray(SensorSamples):
+    """`SensorSamples` decoded into a structured NumPy array (`Sample.DTYPE`) instead of `Sample` objects.
+
+    The array is a read-only view of the received bytes, no object is created per sample.
+    """
+    samples: np.ndarray # type: ignore
+
+    @classmethod
+    def from_bytes(cls, samples_bytes: bytes):
+        return cls(samples_bytes[0], np.frombuffer(samples_bytes, Sample.DTYPE, offset=1))
+
+
 @dataclass
 class Info:
     name: str
@@ -123,3 +191,39 @@ class Info:
     def expected_size(cls, etx_index):
         return etx_index - 1 + cls.SIZE_WITHOUT_NAME
 
+
+@dataclass
+class DatagramHeader(Info):
+    """Header of a self-contained datagram with samples (UDP transport).
+
+    `Info` followed by a sequence number (4B), the rest of the datagram are messages with samples,
+    each prefixed by its sample count (1B), so the sensor params are not needed for decoding.
+    """
+    sequence_number: int
+
+    SEQUENCE_NUMBER_SIZE: ClassVar = 4
+    MAX_SEARCHED_SIZE: ClassVar = 256 # max size of the header, limits searching for the name terminator
+
+    @classmethod
+    def from_buffer(cls, bytes_view: memoryview, sensor_node_type: int) -> tuple[Self | None, int]:
+        """Return the header and its size, `None` if the datagram does not start with a complete header of the sensor node type"""
+        if not len(bytes_view) or bytes_view[0] != sensor_node_type:
+            return None, 0
+        etx_index = bytes(bytes_view[:cls.MAX_SEARCHED_SIZE]).find(ASCII_ETX)
+        size = cls.expected_size(etx_index) + cls.SEQUENCE_NUMBER_SIZE
+        if etx_index < 1 or size > len(bytes_view):
+            return None, 0
+        try:
+            info = Info.from_bytes(bytes(bytes_view[:size - cls.SEQUENCE_NUMBER_SIZE]))
+        except UnicodeDecodeError:
+            return None, 0
+        sequence_number = int.from_bytes(bytes_view[size - cls.SEQUENCE_NUMBER_SIZE:size], byteorder='little')
+        return cls(info.name, info.sensor_count, info.unix_time_offset, sequence_number), size
+
+    def to_bytes(self, sensor_node_type: int) -> bytes:
+        return (
+            bytes([sensor_node_type]) + self.name.encode(ENC) + bytes([ASCII_ETX, self.sensor_count])
+            + self.unix_time_offset.to_bytes(self.UNIX_TIME_OFFSET_SIZE, 'little')
+            + self.sequence_number.to_bytes(self.SEQUENCE_NUMBER_SIZE, 'little')
+        )
+
@@ -0,0 +1,264 @@
+"""
+This module provides a durable on-disk spool of line protocol payloads waiting to be written to InfluxDB.
+
+Receiving threads append payloads to memory-mapped segment files, so they are not blocked
+when InfluxDB is slow or restarting. A background thread syncs the segments to disk in batches
+and another one replays them to InfluxDB, so no samples are lost during an outage
+or across a restart of the receiver server.
+"""
+
+import atexit
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Iterator
+
+from influxdb_client.rest import ApiException
+
+from api_clients import influxdb
+import metrics
+
+log = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 16*1024*1024
+SYNC_PERIOD = 0.2 # max time (s) of appended data which can be lost on power failure
+MAX_DRAIN_SIZE = 1024*1024 # max size of one write to InfluxDB
+MIN_RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30
+PRECISIONS: tuple[influxdb.TimePrecision, ...] = ('s', 'ms', 'us', 'ns')
+
+# payload size, CRC-32 of bucket name and payload, precision index, bucket name size
+RECORD_HEADER = struct.Struct('<IIBH')
+
+INFLUXDB_WRITE_DURATION = metrics.Histogram('receiver_spool_influxdb_write_seconds', 'Duration of writes replayed from the spool to InfluxDB')
+
+Record = tuple[int, str, influxdb.TimePrecision, bytes] # (offset after the record, bucket name, precision, payload)
+
+
+class Segment:
+    """One segment file, records are appended until it is full and it is deleted when all records are written to InfluxDB.
+
+    A record is `RECORD_HEADER`, bucket name and payload. The rest of the file is filled with zeros,
+    so a zero payload size (or an invalid checksum after a crash) marks the end of records.
+    """
+    def __init__(self, path: Path, size: int = 0) -> None:
+        """Create a new segment of `size` bytes or open an existing one if `size` is 0"""
+        self.path = path
+        self.offset_path = path.with_suffix('.offset')
+        with open(path, 'x+b' if size else 'r+b') as f:
+            if size:
+                f.truncate(size)
+            self.mm = mmap.mmap(f.fileno(), 0)
+        self.size = len(self.mm)
+        self.end = 0 # offset after the last record
+        self.read_offset = int(self.offset_path.read_text()) if self.offset_path.exists() else 0
+        if not size:
+            for self.end, *_ in self.read(0, self.size):
+                pass
+
+    def append(self, bucket: bytes, payload: bytes, precision: int, checksum: int):
+        """Append a record, the caller has to check that it fits"""
+        start = self.end + RECORD_HEADER.size
+        self.mm[start:start + len(bucket)] = bucket
+        self.mm[start + len(bucket):start + len(bucket) + len(payload)] = payload
+        # Header is written last, so a partially written record is not valid
+        RECORD_HEADER.pack_into(self.mm, self.end, len(payload), checksum, precision, len(bucket))
+        self.end = start + len(bucket) + len(payload)
+
+    def free_space(self) -> int:
+        return self.size - self.end
+
+    def read(self, offset: int, end: int) -> Iterator[Record]:
+        """Yield valid records between `offset` and `end`"""
+        while offset + RECORD_HEADER.size <= end:
+            size, checksum, precision, bucket_size = RECORD_HEADER.unpack_from(self.mm, offset)
+            start = offset + RECORD_HEADER.size
+            record_end = start + bucket_size + size
+            if not size or record_end > end or precision >= len(PRECISIONS):
+                return
+            bucket = self.mm[start:start + bucket_size]
+            payload = self.mm[start + bucket_size:record_end]
+            if zlib.crc32(payload, zlib.crc32(bucket)) != checksum:
+                log.warning(f'{self.path.name} - invalid record at {offset}, the rest of the segment is ignored')
+                return
+            yield record_end, bucket.decode(), PRECISIONS[precision], payload
+            offset = record_end
+
+    def save_read_offset(self, offset: int):
+        self.read_offset = offset
+        tmp_path = self.offset_path.with_suffix('.tmp')
+        tmp_path.write_text(str(offset))
+        os.replace(tmp_path, self.offset_path)
+
+    def sync(self):
+        if not self.mm.closed:
+            self.mm.flush()
+
+    def delete(self):
+        self.mm.close()
+        self.path.unlink()
+        self.offset_path.unlink(missing_ok=True)
+
+
+class Spool:
+    """Write-ahead spool of InfluxDB writes in `path`.
+
+    `append` only copies the payload into the current memory-mapped segment. Segments left
+    by a previous run are replayed first, new data are written to a new segment.
+    """
+    def __init__(self, path: Path, segment_size: int = SEGMENT_SIZE) -> None:
+        self.path = path
+        self.segment_size = segment_size
+        self._segments: list[Segment] = [] # oldest first, the last one is appended to
+        self._lock = threading.Lock() # protects `_segments` and appending
+        self._sync_lock = threading.Lock() # prevents deleting a segment while it is synced
+        self._data_ready = threading.Event()
+        self._dirty = False
+
+    def start(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        for path in sorted(self.path.glob('*.seg')):
+            if not path.stat().st_size: # crashed before the segment was allocated
+                path.unlink()
+                continue
+            segment = Segment(path)
+            if segment.read_offset < segment.end:
+                log.info(f'Spool - replaying {segment.end - segment.read_offset} B from {path.name}')
+            self._segments.append(segment)
+        self._new_segment(self.segment_size)
+        self._data_ready.set()
+        threading.Thread(target=self._sync_loop, name='spool sync', daemon=True).start()
+        threading.Thread(target=self._drain_loop, name='spool drain', daemon=True).start()
+        atexit.register(self.sync)
+
+    def append(self, bucket_name: str, payload: bytes, write_precision: influxdb.TimePrecision):
+        """Spool a line protocol payload for writing to the bucket"""
+        bucket = bucket_name.encode()
+        checksum = zlib.crc32(payload, zlib.crc32(bucket))
+        size = RECORD_HEADER.size + len(bucket) + len(payload)
+        with self._lock:
+            if self._segments[-1].free_space() < size:
+                self._new_segment(max(self.segment_size, size))
+            self._segments[-1].append(bucket, payload, PRECISIONS.index(write_precision), checksum)
+            self._dirty = True
+        self._data_ready.set()
+
+    def backlog(self) -> int:
+        """Number of spooled bytes not written to InfluxDB yet"""
+        with self._lock:
+            return sum(segment.end - segment.read_offset for segment in self._segments)
+
+    def sync(self):
+        """Sync the current segment to disk"""
+        with self._lock:
+            segment = self._segments[-1]
+            self._dirty = False
+        with self._sync_lock:
+            segment.sync()
+
+    def _new_segment(self, size: int):
+        """Start appending to a new segment, has to be called with `_lock` held (or before `start` returns)"""
+        if self._segments:
+            # Syncs the full segment, its data are not synced by `_sync_loop` anymore
+            with self._sync_lock:
+                self._segments[-1].sync()
+        number = int(self._segments[-1].path.stem) + 1 if self._segments else 0
+        self._segments.append(Segment(self.path/f'{number:010}.seg', size))
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(SYNC_PERIOD)
+            if self._dirty:
+                self.sync()
+
+    def _drain_loop(self):
+        retry_delay = MIN_RETRY_DELAY
+        while True:
+            self._data_ready.clear()
+            with self._lock:
+                segment = self._segments[0]
+                end = segment.end
+                finished = len(self._segments) > 1
+
+            if segment.read_offset >= end:
+                if finished:
+                    with self._lock, self._sync_lock:
+                        self._segments.pop(0)
+                        segment.delete()
+                else:
+                    self._data_ready.wait()
+                continue
+
+            try:
+                self._drain(segment, end)
+                retry_delay = MIN_RETRY_DELAY
+            except Exception as e:
+                log.warning(f'Spool - failed to write to InfluxDB, retrying in {retry_delay} s: {e}')
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay*2, MAX_RETRY_DELAY)
+
+    def _drain(self, segment: Segment, end: int):
+        """Write records between the read offset and `end` to InfluxDB.
+
+        Consecutive records for the same bucket are joined into one write of at most `MAX_DRAIN_SIZE` bytes.
+        The read offset is saved after each successful write, so a write is repeated only after a crash.
+        """
+        pending: list[bytes] = []
+        pending_size = 0
+        pending_key: tuple[str, influxdb.TimePrecision] = ('', 'ns')
+        offset = segment.read_offset
+        for record_end, bucket_name, precision, payload in segment.read(segment.read_offset, end):
+            if pending and ((bucket_name, precision) != pending_key or pending_size + len(payload) > MAX_DRAIN_SIZE):
+                self._write(*pending_key, b'\n'.join(pending))
+                segment.save_read_offset(offset)
+                pending.clear()
+                pending_size = 0
+            pending_key = (bucket_name, precision)
+            pending.append(payload)
+            pending_size += len(payload)
+            offset = record_end
+        if pending:
+            self._write(*pending_key, b'\n'.join(pending))
+        segment.save_read_offset(offset)
+
+    def _write(self, bucket_name: str, precision: influxdb.TimePrecision, payload: bytes):
+        try:
+            with INFLUXDB_WRITE_DURATION.time():
+                influxdb.write_sync(bucket_name, payload, precision)
+        except ApiException as e:
+            # Client errors (e.g. deleted bucket) would fail again
+            if e.status and 400 <= e.status < 500 and e.status != 429:
+                log.error(f'Spool - dropping {len(payload)} B for bucket {bucket_name}: {e.status} {e.reason}')
+            else:
+                raise
+
+
+def merge_segments(sources: list[Path], target: Path):
+    """Move segments of other spools (e.g. of receiver workers which are not started anymore) to the spool in `target`.
+
+    Has to be called before the spools are started. The moved segments are numbered before
+    the segments in `target`, so they are replayed first.
+    """
+    moved = [path for source in sources for path in sorted(source.glob('*.seg'))]
+    if not moved:
+        return
+    target.mkdir(parents=True, exist_ok=True)
+    paths = [*moved, *sorted(target.glob('*.seg'))]
+    # Renamed in two steps, new names may be taken by segments which are renamed later
+    temporary = []
+    for number, path in enumerate(paths):
+        tmp_path = target/f'{number:010}.merging'
+        path.rename(tmp_path)
+        if path.with_suffix('.offset').exists():
+            path.with_suffix('.offset').rename(tmp_path.with_suffix('.merging-offset'))
+        temporary.append(tmp_path)
+    for tmp_path in temporary:
+        tmp_path.rename(tmp_path.with_suffix('.seg'))
+        if tmp_path.with_suffix('.merging-offset').exists():
+            tmp_path.with_suffix('.merging-offset').rename(tmp_path.with_suffix('.offset'))
+    log.info(f'Spool - {len(moved)} segments moved to {target}')
@@ -0,0 +1,17 @@
+"""Tests of the receiver server, run from `receiver_server` with `python -m unittest`"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Modules of the receiver server import each other as top-level modules and the API clients from the repository root
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+# The API clients connect on import, the tests never reach a real server
+os.environ.setdefault('INFLUXDB_ADMIN_TOKEN', 'test')
+os.environ.setdefault('INFLUXDB_URL', 'http://127.0.0.1:9')
+
+# The Control Center database and the spool are created in a temporary directory, not in the app data
+_app_data = tempfile.TemporaryDirectory()
+os.environ['APP_DATA_PATH'] = _app_data.name
@@ -0,0 +1,71 @@
+import time
+from unittest import TestCase, mock
+
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+import control_center_queries as ccq
+from control_center.models import SensorNode, StateVersion
+
+
+class ConnectionStatesTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        call_command('migrate', verbosity=0)
+
+    def setUp(self):
+        self.ids = [SensorNode.objects.create(name=f'node{i}', type=ccq.SensorNodeTypes.FBGUARD).pk for i in range(3)]
+        self.addCleanup(SensorNode.objects.filter(pk__in=self.ids).delete)
+        self.states = ccq.ConnectionStates(ccq.CONNECTION_STATES_FLUSH_PERIOD)
+
+    def connected(self) -> list[bool]:
+        return [SensorNode.objects.get(pk=pk).connected for pk in self.ids]
+
+    def flush(self) -> list[str]:
+        """Flush and return the SQL of executed updates of sensor nodes"""
+        with CaptureQueriesContext(connection) as queries:
+            self.states.flush()
+        return [query['sql'] for query in queries if query['sql'].startswith('UPDATE "control_center_sensornode"')]
+
+    def test_flips_merged_into_one_update(self):
+        a, b, c = self.ids
+        version = StateVersion.get(StateVersion.Keys.CONNECTIONS)
+        for sensor_node_id, state in [(a, True), (b, True), (a, False), (c, True), (b, False), (b, True), (c, False), (c, True)]:
+            self.states.set(sensor_node_id, state)
+        self.assertEqual(len(self.flush()), 1)
+        self.assertEqual(self.connected(), [False, True, True])
+        self.assertEqual(StateVersion.get(StateVersion.Keys.CONNECTIONS), version + 1)
+
+        # Nothing changed, nothing is written
+        self.assertEqual(self.flush(), [])
+        self.assertEqual(StateVersion.get(StateVersion.Keys.CONNECTIONS), version + 1)
+
+        # Only changed sensor nodes are updated
+        self.states.set(b, False)
+        self.assertEqual(len(self.flush()), 1)
+        self.assertEqual(self.connected(), [False, False, True])
+
+    def test_failed_flush_keeps_newer_states(self):
+        a, b, _ = self.ids
+        self.states.set(a, True)
+        self.states.set(b, True)
+        with mock.patch.object(ccq.StateVersion, 'bump', side_effect=Exception('database is locked')):
+            with self.assertRaises(Exception):
+                self.states.flush()
+        # Rolled back, the states are written by the next flush, with the state set meanwhile
+        self.assertEqual(self.connected(), [False, False, False])
+        self.states.set(b, False)
+        self.assertEqual(len(self.flush()), 1)
+        self.assertEqual(self.connected(), [True, False, False])
+
+    def test_flushed_periodically(self):
+        a, b, _ = self.ids
+        self.states.start()
+        self.states.set(a, True)
+        self.states.set(b, True)
+        self.states.set(a, False)
+        deadline = time.monotonic() + 5
+        while self.connected() != [False, True, False] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.connected(), [False, True, False])
@@ -0,0 +1,95 @@
+from unittest import TestCase
+
+import fbguard_protocol as fbg
+from recv_buffer import RecvBuffer
+
+
+def message_bytes(packet_counter: int, readout_count: int = 3, checksum: int | None = None) -> bytes:
+    readouts = [fbg.Readout(1_700_000_000 + i, 1000*i, i + 0.5) for i in range(readout_count)]
+    data = bytearray(fbg.Message.build('device', 'sensor', packet_counter, readouts).to_bytes())
+    if checksum is not None:
+        data[76:80] = checksum.to_bytes(4, fbg.BYTE_ORDER)
+    return bytes(data)
+
+
+class HeaderTests(TestCase):
+    def test_valid(self):
+        data = message_bytes(1)
+        self.assertTrue(fbg.Header.is_valid(data[:fbg.Header.SIZE]))
+        # Zero checksum is not checked, senders without checksums send zeros
+        checksum = fbg.Header.checksum(data)
+        self.assertTrue(fbg.Header.is_valid(message_bytes(1, checksum=checksum)[:fbg.Header.SIZE]))
+
+    def test_corrupted_checksum(self):
+        checksum = fbg.Header.checksum(message_bytes(1))
+        self.assertFalse(fbg.Header.is_valid(message_bytes(1, checksum=checksum + 1)[:fbg.Header.SIZE]))
+
+    def test_readout_count_over_max(self):
+        header = bytearray(message_bytes(1)[:fbg.Header.SIZE])
+        count = fbg.MAX_READOUT_COUNT + 1
+        header[70:72] = count.to_bytes(2, fbg.BYTE_ORDER)
+        header[72:76] = fbg.Header.get_packet_byte_size(count).to_bytes(4, fbg.BYTE_ORDER)
+        self.assertFalse(fbg.Header.is_valid(header))
+
+    def test_wrong_sync_or_size(self):
+        header = bytearray(message_bytes(1)[:fbg.Header.SIZE])
+        header[72:76] = (fbg.Header.get_packet_byte_size(3) + 1).to_bytes(4, fbg.BYTE_ORDER)
+        self.assertFalse(fbg.Header.is_valid(header))
+        self.assertFalse(fbg.Header.is_valid(b'\x55\x00\x56' + message_bytes(1)[3:fbg.Header.SIZE]))
+
+
+class ListFromBufferTests(TestCase):
+    def parse(self, data: bytes) -> tuple[list[int], int, int]:
+        messages, size, discarded = fbg.MessageArray.list_from_buffer(memoryview(data))
+        return [message.header.packet_counter for message in messages], size, discarded
+
+    def test_messages(self):
+        data = message_bytes(1) + message_bytes(2, readout_count=5)
+        messages, size, discarded = fbg.MessageArray.list_from_buffer(memoryview(data))
+        self.assertEqual((len(messages), size, discarded), (2, len(data), 0))
+        self.assertEqual(messages[1].header.device_id, 'device')
+        self.assertEqual(messages[1].header.sensor_id, 'sensor')
+        self.assertEqual(messages[1].data.readouts['timestamp_seconds'].tolist(), [1_700_000_000 + i for i in range(5)])
+        self.assertEqual(messages[1].data.readouts['value'].tolist(), [0.5, 1.5, 2.5, 3.5, 4.5])
+
+    def test_garbage_before_header(self):
+        garbage = b'\x01\x02\x55\x00\x03\x55garbage'
+        self.assertEqual(self.parse(garbage + message_bytes(1) + message_bytes(2)), ([1, 2], len(garbage) + 2*len(message_bytes(1)), len(garbage)))
+
+    def test_corrupted_checksum(self):
+        corrupted = message_bytes(1, checksum=fbg.Header.checksum(message_bytes(1)) + 1)
+        valid = message_bytes(2, checksum=fbg.Header.checksum(message_bytes(2)))
+        self.assertEqual(self.parse(corrupted + valid), ([2], len(corrupted) + len(valid), len(corrupted)))
+
+    def test_readout_count_over_max(self):
+        header = bytearray(message_bytes(1)[:fbg.Header.SIZE])
+        count = fbg.MAX_READOUT_COUNT + 1
+        header[70:72] = count.to_bytes(2, fbg.BYTE_ORDER)
+        header[72:76] = fbg.Header.get_packet_byte_size(count).to_bytes(4, fbg.BYTE_ORDER)
+        # The header is rejected without waiting for the 24 kB it announces
+        self.assertEqual(self.parse(bytes(header) + message_bytes(2)), ([2], len(header) + len(message_bytes(2)), len(header)))
+
+    def test_incomplete(self):
+        data = message_bytes(1)
+        self.assertEqual(self.parse(data[:50]), ([], 0, 0))
+        self.assertEqual(self.parse(data[:-1]), ([], 0, 0))
+        # Garbage is discarded up to possible start of sync bytes at the end
+        self.assertEqual(self.parse(b'garbage' + data[:2]), ([], 7, 7))
+        self.assertEqual(self.parse(b'garbage\x55\x01'), ([], 9, 9))
+
+    def test_split_between_buffers(self):
+        garbage = b'garbage'
+        data = garbage + message_bytes(1) + message_bytes(2)
+        split = len(garbage) + len(message_bytes(1)) + 40
+        buffer = RecvBuffer(256)
+        received: list[int] = []
+        total_discarded = 0
+        for i, part in enumerate((data[:split], data[split:])):
+            buffer.write(part)
+            messages, size, discarded = fbg.MessageArray.list_from_buffer(buffer.data)
+            received += [message.header.packet_counter for message in messages]
+            total_discarded += discarded
+            buffer.consume(size)
+            if i == 0:
+                self.assertEqual((received, size, len(buffer)), ([1], len(garbage) + len(message_bytes(1)), 40))
+        self.assertEqual((received, total_discarded, len(buffer)), ([1, 2], len(garbage), 0))
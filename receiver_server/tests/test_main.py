@@ -0,0 +1,84 @@
+from unittest import TestCase, mock
+
+import numpy as np
+
+import main
+import metrics
+import sensor_node_protocol as snp
+
+SENSOR_PARAMS = [main.ccq.NamedSensorParams(1, 2, 'temperature'), main.ccq.NamedSensorParams(1, 2, 'humidity')]
+
+
+def counter_value(counter: metrics.Counter, *labelvalues: str) -> float:
+    return sum(value for _, labels, value in counter.collect() if labels == labelvalues)
+
+
+def datagram(sequence_number: int, type: int = main.ESP32Datagrams.TYPE.value) -> bytes:
+    samples = np.array([(sequence_number, 0.5), (sequence_number + 1, 1.5)], snp.Sample.DTYPE)
+    header = snp.DatagramHeader('node', len(SENSOR_PARAMS), 1_700_000_000_000, sequence_number)
+    return header.to_bytes(type) + bytes([len(samples), 0]) + samples.tobytes()
+
+
+class UDPReceiverTests(TestCase):
+    def setUp(self):
+        self.server = mock.Mock(registry=None)
+        self.receiver = main.UDPReceiver(self.server, 0)
+        self.header = snp.DatagramHeader('node', len(SENSOR_PARAMS), 1_700_000_000_000, 0)
+
+    def create_client(self) -> main.ESP32Datagrams:
+        with mock.patch.object(main.ESP32Datagrams, 'register'), \
+             mock.patch.object(main.ESP32Datagrams, 'load_sensor_params', return_value=SENSOR_PARAMS):
+            client = main.ESP32Datagrams(self.server, mock.Mock(), ('127.0.0.1', 1234), self.header)
+        client.params_changed = lambda: False
+        return client
+
+    def test_sequence_gap(self):
+        client = self.create_client()
+        lost = counter_value(main.UDP_LOST_DATAGRAMS)
+        for sequence_number in (5, 6, 9, 10):
+            self.assertTrue(client.check_sequence_number(sequence_number))
+        self.assertEqual((client.sequence_number, client.lost_datagrams), (10, 2))
+        self.assertEqual(counter_value(main.UDP_LOST_DATAGRAMS) - lost, 2)
+
+    def test_sequence_wraparound(self):
+        client = self.create_client()
+        for sequence_number in (main.UINT32_MAX - 1, main.UINT32_MAX, 1):
+            self.assertTrue(client.check_sequence_number(sequence_number))
+        self.assertEqual((client.sequence_number, client.lost_datagrams), (1, 1))
+
+    def test_reordered(self):
+        client = self.create_client()
+        late = counter_value(main.UDP_LATE_DATAGRAMS)
+        for sequence_number in (5, 8, 6, 7):
+            self.assertTrue(client.check_sequence_number(sequence_number))
+        # 6 and 7 were counted as lost when 8 arrived
+        self.assertEqual((client.sequence_number, client.lost_datagrams), (8, 0))
+        self.assertEqual(counter_value(main.UDP_LATE_DATAGRAMS) - late, 2)
+
+    def test_duplicate(self):
+        client = self.create_client()
+        self.assertTrue(client.check_sequence_number(5))
+        self.assertFalse(client.check_sequence_number(5))
+        self.assertEqual((client.sequence_number, client.lost_datagrams), (5, 0))
+
+    def test_handle_datagrams(self):
+        client = self.create_client()
+        self.receiver._clients[client.name] = client
+        counts = {result: counter_value(main.UDP_DATAGRAMS, result) for result in ('accepted', 'duplicate', 'invalid')}
+        addr = ('127.0.0.1', 1234)
+        with mock.patch.object(client, 'handle_received') as handle_received, \
+             mock.patch.object(self.receiver, 'create_client') as create_client:
+            self.receiver.handle_datagrams(mock.Mock(), [
+                (memoryview(datagram(1)), addr),
+                (memoryview(datagram(3)), addr),
+                (memoryview(datagram(3)), addr),
+                (memoryview(datagram(2)), addr),
+                (memoryview(datagram(4, type=1)), addr), # FBGuard type byte
+            ])
+        handle_received.assert_called_once_with()
+        create_client.assert_not_called()
+        self.assertEqual({result: counter_value(main.UDP_DATAGRAMS, result) - count for result, count in counts.items()}, {'accepted': 3, 'duplicate': 1, 'invalid': 1})
+        self.assertEqual((client.sequence_number, client.lost_datagrams), (3, 0))
+        # Payloads of accepted datagrams are joined in the receive buffer
+        sensor_samples_list, _ = snp.SensorSamplesArray.list_from_counted_buffer(client.recv_buffer.data)
+        self.assertEqual([samples.samples['timestamp'].tolist() for samples in sensor_samples_list], [[1, 2], [3, 4], [2, 3]])
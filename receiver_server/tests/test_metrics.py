@@ -0,0 +1,108 @@
+import re
+import threading
+from unittest import TestCase
+
+import metrics
+
+# Line of the Prometheus text exposition format
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{((?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\[\\"n])*",?)*)\})? (\S+)$')
+_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\\n]|\\[\\"n])*)"')
+
+
+def parse(text: str) -> dict[tuple[str, tuple[tuple[str, str], ...]], float]:
+    """Parse the exposition, fail on any line which is not a comment or a valid sample"""
+    types: dict[str, str] = {}
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            continue
+        if line.startswith('# TYPE '):
+            name, type = line[len('# TYPE '):].split(' ')
+            types[name] = type
+            continue
+        match = _SAMPLE.match(line)
+        assert match, f'invalid line {line!r}'
+        name, labels, value = match.groups()
+        assert any(name == metric or name.startswith(metric + '_') for metric in types), f'no TYPE of {name}'
+        labels = tuple(_LABEL.findall(labels or ''))
+        samples[name, labels] = float(value)
+    return samples
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def run_threads(self, target, count: int = 8):
+        start = threading.Barrier(count)
+        def run():
+            start.wait()
+            target()
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def test_counter_summed_across_threads(self):
+        counter = metrics.Counter('test_total', 'Test counter', ('type',), registry=self.registry)
+        def increment():
+            for _ in range(10_000):
+                counter.inc(1, 'a')
+            counter.inc(0.5, 'b')
+        threads = self.run_threads(increment)
+        # Shards of running and finished threads are summed
+        for thread in threads[:4]:
+            thread.join()
+        collected = {labels: value for _, labels, value in counter.collect()}
+        self.assertGreaterEqual(collected[('a',)], 40_000)
+        for thread in threads[4:]:
+            thread.join()
+        counter.inc(1, 'a')
+        self.assertEqual({labels: value for _, labels, value in counter.collect()}, {('a',): 80_001, ('b',): 4})
+        # Merged shards of finished threads are not counted twice
+        self.assertEqual({labels: value for _, labels, value in counter.collect()}, {('a',): 80_001, ('b',): 4})
+
+    def test_histogram_summed_across_threads(self):
+        histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(1, 10), registry=self.registry)
+        def observe():
+            for value in (0.5, 1, 5, 20):
+                histogram.observe(value)
+        for thread in self.run_threads(observe):
+            thread.join()
+        samples = parse(self.registry.render())
+        # Buckets are cumulative and inclusive of their upper bound
+        self.assertEqual(samples['test_seconds_bucket', (('le', '1'),)], 16)
+        self.assertEqual(samples['test_seconds_bucket', (('le', '10'),)], 24)
+        self.assertEqual(samples['test_seconds_bucket', (('le', '+Inf'),)], 32)
+        self.assertEqual(samples['test_seconds_count', ()], 32)
+        self.assertEqual(samples['test_seconds_sum', ()], 8*26.5)
+
+    def test_exposition_parses(self):
+        metrics.Counter('test_requests_total', 'Requests', ('path', 'result'), registry=self.registry).inc(3, '/a "quoted"\\path\n', 'ok')
+        metrics.Histogram('test_latency_seconds', 'Latency', ('stage',), registry=self.registry).observe(0.002, 'decode')
+        metrics.Gauge('test_depth', 'Queue depth', lambda: {('writer',): 5, ('decode 0',): 0}, ('stage',), registry=self.registry)
+        metrics.Gauge('test_backlog_bytes', 'Backlog', lambda: 7, registry=self.registry)
+        metrics.CallbackCounter('test_dropped_total', 'Dropped', lambda: {('writer',): 2}, ('stage',), registry=self.registry)
+        metrics.Gauge('test_failing', 'Fails to collect', lambda: 1/0, registry=self.registry)
+
+        with self.assertLogs(metrics.log, 'ERROR'):
+            text = self.registry.render()
+        self.assertTrue(text.endswith('\n'))
+        self.assertIn('# TYPE test_dropped_total counter', text)
+        self.assertIn('# TYPE test_latency_seconds histogram', text)
+        samples = parse(text)
+        self.assertEqual(samples['test_requests_total', (('path', r'/a \"quoted\"\\path\n'), ('result', 'ok'))], 3)
+        self.assertEqual(samples['test_latency_seconds_bucket', (('stage', 'decode'), ('le', '0.005'))], 1)
+        self.assertEqual(samples['test_latency_seconds_bucket', (('stage', 'decode'), ('le', '0.001'))], 0)
+        self.assertEqual(samples['test_depth', (('stage', 'writer'),)], 5)
+        self.assertEqual(samples['test_backlog_bytes', ()], 7)
+        self.assertEqual(samples['test_dropped_total', (('stage', 'writer'),)], 2)
+        self.assertFalse([name for name, _ in samples if name == 'test_failing'])
+
+    def test_receiver_metrics_parse(self):
+        import main # registers the metrics of the receiver server
+        main.UDP_DATAGRAMS.inc(1, 'accepted')
+        main.WRITE_DURATION.observe(0.01)
+        samples = parse(metrics.REGISTRY.render())
+        self.assertGreaterEqual(samples['receiver_udp_datagrams_total', (('result', 'accepted'),)], 1)
+        self.assertIn(('receiver_pipeline_queue_depth', (('stage', 'writer'),)), samples)
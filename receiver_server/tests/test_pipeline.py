@@ -0,0 +1,98 @@
+import threading
+import time
+from unittest import TestCase, mock
+
+import pipeline
+from pipeline import Pipeline, Stage, Writer
+
+
+class Client:
+    def __init__(self, id: int, processed: list[tuple[int, str, bytes]]) -> None:
+        self.id = id
+        self.processed = processed
+
+    def process(self, data: bytes):
+        self.processed.append((self.id, threading.current_thread().name, data))
+
+
+def wait_until(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class PipelineTests(TestCase):
+    def test_sharded_by_node_id(self):
+        processed: list[tuple[int, str, bytes]] = []
+        stages = Pipeline(lambda *args: None, decode_workers=3)
+        clients = [Client(id, processed) for id in range(6)]
+        for i in range(20):
+            for client in clients:
+                self.assertTrue(stages.submit(client, f'{client.id}:{i}'.encode()))
+        self.assertEqual([stage.depth for stage in stages.decode_stages], [40, 40, 40])
+
+        for stage in stages.decode_stages:
+            stage.start()
+        wait_until(lambda: len(processed) == 120)
+        for client in clients:
+            node_items = [(thread, data) for id, thread, data in processed if id == client.id]
+            # Data of a node are decoded by one worker in the order they were received
+            self.assertEqual({thread for thread, _ in node_items}, {f'decode {client.id % 3}'})
+            self.assertEqual([data for _, data in node_items], [f'{client.id}:{i}'.encode() for i in range(20)])
+
+    def test_drop_when_queue_full(self):
+        stages = Pipeline(lambda *args: None, decode_workers=2, queue_size=2)
+        processed: list[tuple[int, str, bytes]] = []
+        client = Client(1, processed)
+        self.assertTrue(stages.submit(client, b'1'))
+        self.assertTrue(stages.submit(client, b'2'))
+        self.assertFalse(stages.submit(client, b'3'))
+        self.assertFalse(stages.submit(client, b'4', timeout=0.01))
+        # Other shards are not affected
+        self.assertTrue(stages.submit(Client(2, processed), b'1'))
+        self.assertEqual([stage.dropped for stage in stages.decode_stages], [0, 2])
+
+        self.assertTrue(stages.writer.put(('bucket', b'm v=1 1', 'ns')))
+        self.assertTrue(stages.writer.put(('bucket', b'm v=2 2', 'ns')))
+        with self.assertLogs(pipeline.log, 'WARNING'):
+            stages.write('bucket', b'm v=3 3', 'ns')
+        self.assertEqual(stages.writer.dropped, 1)
+        self.assertIn('(dropped 2)', stages.stats())
+
+    def test_stage_drop_counter(self):
+        stage = Stage[int]('stage', lambda item: None, maxsize=1)
+        self.assertEqual([stage.put(i) for i in range(4)], [True, False, False, False])
+        self.assertEqual((stage.depth, stage.dropped), (1, 3))
+
+
+class WriterTests(TestCase):
+    def setUp(self):
+        self.written: list[tuple[str, bytes, str]] = []
+        self.writer = Writer(lambda *args: self.written.append(args))
+
+    def test_joined_by_bucket_and_precision(self):
+        for item in [('a', b'm v=1 1', 'ns'), ('b', b'm v=2 2', 'ns'), ('a', b'm v=3 3', 'ns'), ('a', b'm v=4 4', 's')]:
+            self.assertTrue(self.writer.put(item))
+        self.writer.start()
+        wait_until(lambda: len(self.written) == 3)
+        self.assertEqual(sorted(self.written), [('a', b'm v=1 1\nm v=3 3', 'ns'), ('a', b'm v=4 4', 's'), ('b', b'm v=2 2', 'ns')])
+
+    def test_flushed_at_batch_size(self):
+        with mock.patch.object(pipeline, 'WRITE_BATCH_SIZE', 10):
+            self.writer._add(('a', b'12345', 'ns'))
+            self.assertEqual(self.written, [])
+            self.writer._add(('a', b'67890', 'ns'))
+        self.assertEqual(self.written, [('a', b'12345\n67890', 'ns')])
+        self.assertEqual((self.writer._pending, self.writer._pending_size), ({}, 0))
+
+    def test_write_error_does_not_stop_other_buckets(self):
+        def write(bucket_name: str, payload: bytes, precision: str):
+            if bucket_name == 'a':
+                raise Exception('write failed')
+            self.written.append((bucket_name, payload, precision))
+        writer = Writer(write)
+        writer._add(('a', b'm v=1 1', 'ns'))
+        writer._add(('b', b'm v=2 2', 'ns'))
+        with self.assertLogs(pipeline.log, 'ERROR'):
+            writer._flush()
+        self.assertEqual(self.written, [('b', b'm v=2 2', 'ns')])
@@ -0,0 +1,79 @@
+import socket
+from unittest import TestCase
+
+import fbguard_protocol as fbg
+from recv_buffer import RecvBuffer
+
+
+class RecvBufferTests(TestCase):
+    def test_consume(self):
+        buffer = RecvBuffer(16, b'abcdef')
+        self.assertEqual(bytes(buffer.data), b'abcdef')
+        buffer.consume(2)
+        self.assertEqual((bytes(buffer.data), len(buffer)), (b'cdef', 4))
+        # Emptied buffer starts again at the beginning without copying
+        buffer.consume(4)
+        buffer.write(b'0123456789abcdef')
+        self.assertEqual((bytes(buffer.data), buffer.copy_count), (b'0123456789abcdef', 0))
+
+    def test_wraparound(self):
+        buffer = RecvBuffer(16)
+        buffer.write(b'0123456789')
+        buffer.consume(8)
+        # Free space at the end is used before the unparsed data are moved
+        buffer.write(b'abcdef')
+        self.assertEqual((bytes(buffer.data), buffer.copy_count), (b'89abcdef', 0))
+        # Unparsed data are moved to the start when the end of the buffer is reached
+        buffer.write(b'ghij')
+        self.assertEqual(bytes(buffer.data), b'89abcdefghij')
+        self.assertEqual((buffer.copy_count, buffer.copied_bytes, buffer.grow_count, buffer.capacity), (1, 8, 0, 16))
+
+    def test_compaction_keeps_free_space(self):
+        buffer = RecvBuffer(16)
+        buffer.write(b'0123456789abcd')
+        buffer.consume(12)
+        free = buffer.get_free(10)
+        self.assertEqual(len(free), 14)
+        free[:3] = b'xyz'
+        buffer.commit(3)
+        self.assertEqual(bytes(buffer.data), b'cdxyz')
+        self.assertEqual((buffer.copy_count, buffer.copied_bytes), (1, 2))
+
+    def test_grow(self):
+        buffer = RecvBuffer(8, b'012345')
+        buffer.consume(1)
+        buffer.write(b'6789abcdef')
+        self.assertEqual(bytes(buffer.data), b'123456789abcdef')
+        self.assertEqual((buffer.grow_count, buffer.capacity), (1, 16))
+
+    def test_frame_spanning_compaction(self):
+        frames = [fbg.Message.build('device', 'sensor', i, [fbg.Readout(i, 0, i + 0.5)]*(i + 1)).to_bytes() for i in range(6)]
+        data = b''.join(frames)
+        buffer = RecvBuffer(256)
+        parsed: list[int] = []
+        # Receives in parts which do not end at frame boundaries, frames are moved to the start while incomplete
+        for start in range(0, len(data), 100):
+            buffer.write(data[start:start + 100])
+            messages, size, discarded = fbg.MessageArray.list_from_buffer(buffer.data)
+            self.assertEqual(discarded, 0)
+            parsed += [message.header.packet_counter for message in messages]
+            for message in messages:
+                self.assertEqual(message.data.readouts['value'].tolist(), [message.header.packet_counter + 0.5]*(message.header.packet_counter + 1))
+            buffer.consume(size)
+        self.assertEqual((parsed, len(buffer)), (list(range(6)), 0))
+        self.assertGreater(buffer.copied_bytes, 0)
+        self.assertEqual(buffer.grow_count, 0)
+
+    def test_recv_into(self):
+        a, b = socket.socketpair()
+        with a, b:
+            buffer = RecvBuffer(8)
+            a.sendall(b'0123')
+            self.assertEqual(buffer.recv_into(b), 4)
+            buffer.consume(3)
+            a.sendall(b'456789')
+            # At least `min_size` bytes of free space are made for the receive
+            self.assertEqual(buffer.recv_into(b, 6), 6)
+            self.assertEqual(bytes(buffer.data), b'3456789')
+            a.close()
+            self.assertEqual(buffer.recv_into(b), 0)
@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+import numpy as np
+
+import sensor_node_protocol as snp
+from recv_buffer import RecvBuffer
+
+# Sensor 0 sends 2 samples per message, sensor 1 sends 3
+EXPECTED_SIZES = [snp.SensorSamples.get_expected_size(2), snp.SensorSamples.get_expected_size(3)]
+
+
+def message_bytes(sensor_id: int, first_timestamp: int) -> bytes:
+    sample_count = (EXPECTED_SIZES[sensor_id] - 1) // snp.Sample.SIZE
+    samples = np.array([(first_timestamp + i, first_timestamp + i + 0.5) for i in range(sample_count)], snp.Sample.DTYPE)
+    return bytes([sensor_id]) + samples.tobytes()
+
+
+class ListFromBufferTests(TestCase):
+    def parse(self, data: bytes) -> tuple[list[tuple[int, list[int]]], int, int]:
+        messages, size, discarded = snp.SensorSamplesArray.list_from_buffer(memoryview(data), EXPECTED_SIZES)
+        return [(message.sensor_id, message.samples['timestamp'].tolist()) for message in messages], size, discarded
+
+    def test_messages(self):
+        data = message_bytes(0, 10) + message_bytes(1, 20)
+        messages, size, discarded = snp.SensorSamplesArray.list_from_buffer(memoryview(data), EXPECTED_SIZES)
+        self.assertEqual((size, discarded), (len(data), 0))
+        self.assertEqual(messages[1].sensor_id, 1)
+        self.assertEqual(messages[1].samples['timestamp'].tolist(), [20, 21, 22])
+        self.assertEqual(messages[1].samples['value'].tolist(), [20.5, 21.5, 22.5])
+
+    def test_garbage_before_message(self):
+        # Bytes which are not sensor IDs of the node
+        garbage = b'\x02\x07\xfe'
+        data = message_bytes(0, 10) + garbage + message_bytes(1, 20)
+        self.assertEqual(self.parse(data), ([(0, [10, 11]), (1, [20, 21, 22])], len(data), len(garbage)))
+
+    def test_stops_before_reconfigure_ack(self):
+        first = message_bytes(0, 10)
+        data = first + bytes([snp.RECONFIGURE_ACK]) + message_bytes(1, 20)
+        self.assertEqual(self.parse(data), ([(0, [10, 11])], len(first), 0))
+
+    def test_split_between_buffers(self):
+        garbage = b'\x09'
+        data = garbage + message_bytes(0, 10) + message_bytes(1, 20)
+        split = len(garbage) + EXPECTED_SIZES[0] + 5
+        buffer = RecvBuffer(64)
+        received: list[tuple[int, list[int]]] = []
+        total_discarded = 0
+        for i, part in enumerate((data[:split], data[split:])):
+            buffer.write(part)
+            messages, size, discarded = snp.SensorSamplesArray.list_from_buffer(buffer.data, EXPECTED_SIZES)
+            received += [(message.sensor_id, message.samples['timestamp'].tolist()) for message in messages]
+            total_discarded += discarded
+            buffer.consume(size)
+            if i == 0:
+                self.assertEqual((received, discarded, len(buffer)), ([(0, [10, 11])], 1, 5))
+        self.assertEqual((received, total_discarded, len(buffer)), ([(0, [10, 11]), (1, [20, 21, 22])], 1, 0))
+
+
+class DatagramHeaderTests(TestCase):
+    TYPE = 0
+
+    def test_round_trip(self):
+        header = snp.DatagramHeader('node', 2, 1_700_000_000_000, 0xFFFFFFFE)
+        data = header.to_bytes(self.TYPE)
+        self.assertEqual(snp.DatagramHeader.from_buffer(memoryview(data + b'payload'), self.TYPE), (header, len(data)))
+
+    def test_unknown_type(self):
+        data = snp.DatagramHeader('node', 2, 1_700_000_000_000, 1).to_bytes(self.TYPE)
+        self.assertEqual(snp.DatagramHeader.from_buffer(memoryview(b'\x07' + data[1:]), self.TYPE), (None, 0))
+        self.assertEqual(snp.DatagramHeader.from_buffer(memoryview(b''), self.TYPE), (None, 0))
+
+    def test_incomplete(self):
+        data = snp.DatagramHeader('node', 2, 1_700_000_000_000, 1).to_bytes(self.TYPE)
+        self.assertEqual(snp.DatagramHeader.from_buffer(memoryview(data[:-1]), self.TYPE), (None, 0))
+        self.assertEqual(snp.DatagramHeader.from_buffer(memoryview(data[:4]), self.TYPE), (None, 0))
@@ -0,0 +1,101 @@
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase, mock
+
+import spool
+from spool import RECORD_HEADER, Segment, Spool
+
+
+def record_size(bucket_name: str, payload: bytes) -> int:
+    return RECORD_HEADER.size + len(bucket_name) + len(payload)
+
+
+class SpoolTests(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = Path(tmp_dir.name)/'spool'
+        self.written: list[tuple[str, bytes, str]] = []
+        patcher = mock.patch.object(spool.influxdb, 'write_sync', side_effect=lambda *args: self.written.append(args))
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def open(self, segment_size: int = 1024) -> Spool:
+        """Start a spool without its sync and drain threads"""
+        result = Spool(self.path, segment_size)
+        with mock.patch.object(spool.threading, 'Thread'), mock.patch.object(spool.atexit, 'register'):
+            result.start()
+        return result
+
+    def segment_names(self) -> list[str]:
+        return sorted(path.name for path in self.path.glob('*.seg'))
+
+    def test_replay_after_reopening(self):
+        first = self.open()
+        first.append('bucket', b'm v=1 1', 's')
+        first.append('bucket', b'm v=2 2', 's')
+        first.append('other', b'm v=3 3', 'ns')
+        first.sync()
+        size = record_size('bucket', b'm v=1 1')*2 + record_size('other', b'm v=3 3')
+        self.assertEqual(first.backlog(), size)
+
+        # Records of the previous run are replayed from the old segment, new ones go to a new segment
+        second = self.open()
+        self.assertEqual(self.segment_names(), ['0000000000.seg', '0000000001.seg'])
+        self.assertEqual(second.backlog(), size)
+        segment = second._segments[0]
+        second._drain(segment, segment.end)
+        self.assertEqual(self.written, [('bucket', b'm v=1 1\nm v=2 2', 's'), ('other', b'm v=3 3', 'ns')])
+        self.assertEqual(second.backlog(), 0)
+
+        # The read offset is saved, so written records are not replayed again
+        self.assertEqual(self.open().backlog(), 0)
+
+    def test_truncated_at_invalid_checksum(self):
+        first = self.open()
+        for i in range(3):
+            first.append('bucket', f'm v={i} {i}'.encode(), 's')
+        first.sync()
+        # Corrupts the payload of the second record
+        path = self.path/'0000000000.seg'
+        data = bytearray(path.read_bytes())
+        data[record_size('bucket', b'm v=0 0') + RECORD_HEADER.size + len('bucket')] ^= 0xFF
+        path.write_bytes(data)
+
+        with self.assertLogs(spool.log, 'WARNING'):
+            segment = Segment(path)
+        self.assertEqual(segment.end, record_size('bucket', b'm v=0 0'))
+        self.assertEqual([payload for *_, payload in segment.read(0, segment.end)], [b'm v=0 0'])
+
+    def test_segment_rollover(self):
+        payload = b'm v=1 1'
+        size = record_size('bucket', payload)
+        segments = self.open(segment_size=2*size + 1)
+        for _ in range(5):
+            segments.append('bucket', payload, 'ns')
+        # A record larger than a segment gets a segment of its size
+        large = b'x'*(4*size)
+        segments.append('bucket', large, 'ns')
+
+        self.assertEqual(self.segment_names(), ['0000000000.seg', '0000000001.seg', '0000000002.seg', '0000000003.seg'])
+        self.assertEqual([segment.end for segment in segments._segments], [2*size, 2*size, size, record_size('bucket', large)])
+        self.assertEqual((self.path/'0000000003.seg').stat().st_size, record_size('bucket', large))
+        self.assertEqual(segments.backlog(), 5*size + record_size('bucket', large))
+
+    def test_acknowledged_segments_deleted(self):
+        payload = b'm v=1 1'
+        size = record_size('bucket', payload)
+        segments = Spool(self.path, 2*size)
+        with mock.patch.object(spool.atexit, 'register'):
+            segments.start()
+        for _ in range(5):
+            segments.append('bucket', payload, 'ns')
+
+        deadline = time.monotonic() + 5
+        while (segments.backlog() or len(self.segment_names()) > 1) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Only the segment which is appended to is kept
+        self.assertEqual(self.segment_names(), ['0000000002.seg'])
+        self.assertEqual(b'\n'.join(payload for _, payload, _ in self.written), b'\n'.join([payload]*5))
+        self.assertFalse(list(self.path.glob('0000000000.*')))
@@ -48,3 +48,14 @@ void SensorData::clear() {
   currentIndex = 0;
   sampleCount = 0;
 }
+
+void SensorData::removeFirst(uint8_t count) {
+  if (count >= sampleCount) {
+    clear();
+    return;
+  }
+  uint16_t removedSize = count * SAMPLE_SIZE;
+  memmove(buffer, &buffer[removedSize], currentIndex - removedSize);
+  currentIndex -= removedSize;
+  sampleCount -= count;
+}
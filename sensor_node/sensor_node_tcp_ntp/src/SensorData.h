@@ -40,4 +40,7 @@ public:
 
   // Clears the buffer and resets the sample count and current index
   void clear();
+
+  // Removes the first `count` samples and moves the remaining samples to the start of the buffer
+  void removeFirst(uint8_t count);
 };
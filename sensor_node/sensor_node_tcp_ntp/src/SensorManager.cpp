@@ -5,19 +5,24 @@ void SensorManager::doReadAndWrites() {
         int64_t _millis = millis();
         if (sensors[i]->isWriteReady(_millis)) {
             sensors[i]->readAndWrite(_millis);
-            if (sensors[i]->isMessageReady()) {
-                DataToSend dataToSend;
-                dataToSend.sensorId = i;
-                dataToSend.sampleCount = sensors[i]->data.getSampleCount();
-                memcpy(dataToSend.dataBuffer, sensors[i]->data.getBuffer(), sensors[i]->data.getCurrentByteSize());
-
-                xQueueSend(preSendBufferQueue, &dataToSend, portMAX_DELAY);
-                sensors[i]->data.clear();
-            }
+            queueReadyMessages(i);
         }
     }
 }
 
+void SensorManager::queueReadyMessages(uint8_t sensorId) {
+    // More than one message is ready only after samplesPerMessage was decreased
+    while (sensors[sensorId]->isMessageReady()) {
+        DataToSend dataToSend;
+        dataToSend.sensorId = sensorId;
+        dataToSend.sampleCount = sensors[sensorId]->getSamplesPerMessage();
+        memcpy(dataToSend.dataBuffer, sensors[sensorId]->data.getBuffer(), dataToSend.sampleCount * SAMPLE_SIZE);
+
+        xQueueSend(preSendBufferQueue, &dataToSend, portMAX_DELAY);
+        sensors[sensorId]->data.removeFirst(dataToSend.sampleCount);
+    }
+}
+
 SensorManager::SensorManager() {}
 
 SensorManager::~SensorManager() {
@@ -3,7 +3,7 @@
 #include <Arduino.h>       // Includes standard Arduino functions and definitions
 #include "Sensor.h"        // Includes the Sensor class declaration for managing individual sensor data
 
-#define MAX_SENSOR_COUNT 256           // Maximum number of sensors supported by SensorManager
+#define MAX_SENSOR_COUNT 255           // Maximum number of sensors supported by SensorManager (sensor ID 255 is reserved)
 #define QUEUE_SIZE_PER_SENSOR 10       // Maximum size of the send buffer queue for each sensor
 
 // Struct to hold sensor data for transmission
@@ -22,6 +22,9 @@ class SensorManager {
     // Method to handle reading and writing of sensor data
     void doReadAndWrites(); 
 
+    // Queues messages of samplesPerMessage samples while the sensor has enough samples
+    void queueReadyMessages(uint8_t sensorId); 
+
     // Checks if the sensor with the given ID is ready to write data
     bool isWriteReady(uint8_t sensorId); 
 
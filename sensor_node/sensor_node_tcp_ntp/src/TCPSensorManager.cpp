@@ -31,14 +31,22 @@ void TCPSensorManager::sendInfo() {
     }
 }
 
-void TCPSensorManager::receiveParams() {
-    byte received_bytes[getSensorCount() * SERVER_REQUEST_SIZE_PER_SENSOR];
-    while (!client.available()) {
+bool TCPSensorManager::readParams() {
+    uint16_t size = getSensorCount() * SERVER_REQUEST_SIZE_PER_SENSOR;
+    byte received_bytes[size];
+    uint16_t received = 0;
+    // Params can be split into more TCP segments
+    while (received < size) {
         if (!client.connected()) {
-            return;
+            return false;
+        }
+        if (client.available()) {
+            int read = client.read(&received_bytes[received], size - received);
+            if (read > 0) {
+                received += read;
+            }
         }
     }
-    client.read(received_bytes, getSensorCount() * SERVER_REQUEST_SIZE_PER_SENSOR);
     for (int i = 0; i < getSensorCount(); i++) {
         uint32_t samplePeriodMs;
         memcpy(&samplePeriodMs, &received_bytes[i * SERVER_REQUEST_SIZE_PER_SENSOR], sizeof(uint32_t));
@@ -51,14 +59,65 @@ void TCPSensorManager::receiveParams() {
             Serial.printf("Max samples per message exceted! - %d > %d (received > max)\n", samplesPerMessage, MAX_SAMPLES);
             samplesPerMessage = MAX_SAMPLES;
         }
+        if (samplesPerMessage < 1) {
+            samplesPerMessage = 1;
+        }
         Serial.printf("Samples per message: %d\n", samplesPerMessage);
 
-        sensors[i]->setSamplePeriodMillis(samplePeriodMs);
-        sensors[i]->setSamplesPerMessage(samplesPerMessage);
+        pendingSamplePeriods[i] = samplePeriodMs;
+        pendingSamplesPerMessage[i] = samplesPerMessage;
+    }
+    return true;
+}
+
+void TCPSensorManager::receiveParams() {
+    if (!readParams()) {
+        return;
+    }
+    for (int i = 0; i < getSensorCount(); i++) {
+        sensors[i]->setSamplePeriodMillis(pendingSamplePeriods[i]);
+        sensors[i]->setSamplesPerMessage(pendingSamplesPerMessage[i]);
     }
     set_initialized(true);  
 }
 
+void TCPSensorManager::receiveReconfiguration() {
+    // The server sends new params only after the previous ones are acknowledged
+    if (!client.available() || is_reconfiguration_pending()) {
+        return;
+    }
+    int messageType = client.read();
+    if (messageType != RECONFIGURE) {
+        Serial.printf("Unknown message type from server: %d\n", messageType);
+        return;
+    }
+    Serial.println("Reconfiguration received");
+    if (readParams()) {
+        set_reconfiguration_pending(true);
+    }
+}
+
+void TCPSensorManager::applyReconfiguration() {
+    if (!is_reconfiguration_pending()) {
+        return;
+    }
+    for (int i = 0; i < getSensorCount(); i++) {
+        sensors[i]->setSamplePeriodMillis(pendingSamplePeriods[i]);
+        sensors[i]->setSamplesPerMessage(pendingSamplesPerMessage[i]);
+    }
+    // Messages queued before the acknowledgement have sizes by the old params, the server swaps them at the acknowledgement
+    DataToSend acknowledgement;
+    acknowledgement.sensorId = RECONFIGURE_ACK;
+    acknowledgement.sampleCount = 0;
+    xQueueSend(preSendBufferQueue, &acknowledgement, portMAX_DELAY);
+    // Samples over the decreased samples per message are sent in messages by the new params, so no samples are lost
+    for (uint8_t i = 0; i < getSensorCount(); i++) {
+        queueReadyMessages(i);
+    }
+    set_reconfiguration_pending(false);
+    Serial.println("Reconfiguration applied");
+}
+
 bool TCPSensorManager::is_initialized() {
     if (xSemaphoreTake(initialized_mutex, portMAX_DELAY)) {
         bool _initialized = this->initialized;
@@ -79,6 +138,26 @@ void TCPSensorManager::set_initialized(bool state) {
     }
 }
 
+bool TCPSensorManager::is_reconfiguration_pending() {
+    if (xSemaphoreTake(reconfiguration_mutex, portMAX_DELAY)) {
+        bool _reconfigurationPending = this->reconfigurationPending;
+        xSemaphoreGive(reconfiguration_mutex);
+        return _reconfigurationPending;
+    } else {
+        Serial.println("Error: Failed to take reconfiguration_mutex semaphore\n");
+        return false;
+    }
+}
+
+void TCPSensorManager::set_reconfiguration_pending(bool state) {
+    if (xSemaphoreTake(reconfiguration_mutex, portMAX_DELAY)) {
+        reconfigurationPending = state;
+        xSemaphoreGive(reconfiguration_mutex);
+    } else {
+        Serial.println("Error: Failed to take reconfiguration_mutex semaphore\n");
+    }
+}
+
 void TCPSensorManager::sendAndClearSamples() {
     DataToSend dataToSend;
     while (uxQueueMessagesWaiting(preSendBufferQueue) > 0) {
@@ -108,6 +187,11 @@ void TCPSensorManager::begin(const char* serverIP, uint16_t serverPort, String n
         Serial.println("Mutex creation failed for SensorManager");
     }
     set_initialized(false);
+    reconfiguration_mutex = xSemaphoreCreateMutex();
+    if (reconfiguration_mutex == NULL) {
+        Serial.println("Mutex creation failed for SensorManager");
+    }
+    set_reconfiguration_pending(false);
     this->preSendBufferQueue = xQueueCreate(getSensorCount() * QUEUE_SIZE_PER_SENSOR, sizeof(DataToSend));
     xTaskCreatePinnedToCore(serverManagementTask, "ServerManagement", 10000, this, 1, NULL, 1);
     // client.setNoDelay(true);
@@ -119,6 +203,7 @@ void TCPSensorManager::begin(APConfig* apConfig, const char* ntpServer2, const c
 
 void TCPSensorManager::processData() {
     if (client.connected()) {
+        applyReconfiguration();
         doReadAndWrites();
     } else {
         clearAllSensors();
@@ -130,6 +215,7 @@ void TCPSensorManager::processData() {
 void TCPSensorManager::serverManage() {
     if (!client.connected()) {
             set_initialized(false);
+            set_reconfiguration_pending(false);
             Serial.println("Connecting to " + String(serverIP) + ":" + String(serverPort));
             while (!client.connected()) {
                 client.connect(serverIP, serverPort);
@@ -139,5 +225,6 @@ void TCPSensorManager::serverManage() {
             receiveParams();
         }
 
+        receiveReconfiguration();
         sendAndClearSamples();
 }
\ No newline at end of file
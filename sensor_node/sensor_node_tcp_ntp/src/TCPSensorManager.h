@@ -17,6 +17,11 @@
 // Number of bytes required per sensor request from the server
 #define SERVER_REQUEST_SIZE_PER_SENSOR 5
 
+// Type of the message with new params sent by the server on a live connection
+#define RECONFIGURE 0x01
+// Sent in place of a sensor ID after the last message with samples by the old params
+#define RECONFIGURE_ACK 0xFF
+
 // Default NTP server addresses for time synchronization
 #define DEFAULT_NTP_SERVER_2 "cz.pool.ntp.org"
 #define DEFAULT_NTP_SERVER_3 "tik.cesnet.cz"
@@ -25,14 +30,23 @@
 class TCPSensorManager : public SensorManager {
    private:
     bool initialized;    // Tracks if the sensor manager is initialized
+    bool reconfigurationPending; // Tracks if received params wait to be applied
+    uint32_t pendingSamplePeriods[MAX_SENSOR_COUNT];    // Params received from the server
+    uint8_t pendingSamplesPerMessage[MAX_SENSOR_COUNT];
 
     void sendInfo();          // Sends device information to the server
+    bool readParams();        // Reads params for all sensors from the server into the pending params
     void receiveParams();     // Receives configuration parameters from the server
+    void receiveReconfiguration(); // Receives new parameters sent by the server on the live connection
+    void applyReconfiguration();   // Applies received new parameters between messages and queues the acknowledgement
     void sendAndClearSamples(); // Sends collected sensor data and clears the buffer
     bool is_initialized();    // Checks if the manager is initialized
     void set_initialized(bool state); // Sets initialization state
+    bool is_reconfiguration_pending();    // Checks if received new parameters wait to be applied
+    void set_reconfiguration_pending(bool state); // Sets reconfiguration state
 
     SemaphoreHandle_t initialized_mutex; // Mutex for thread-safe access to initialization flag
+    SemaphoreHandle_t reconfiguration_mutex; // Mutex for thread-safe access to reconfiguration flag
     uint64_t unixTimeOffset; // Offset for Unix time synchronization
     WiFiClient client;       // TCP client for server communication
     const char* serverIP;    // Server IP address